@@ -0,0 +1,143 @@
+"""Compare metadata stripping with qpdf against the old PyPDF2 approach
+
+Each engine runs in a fresh Python process so that its peak RSS isn't
+polluted by the other engine. Each strips the PDF repeatedly and checks
+that the output hashes the same every time. Run it from the root of the repo:
+
+    python -m doctor.benchmarks.metadata path/to/big.pdf
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from statistics import median
+from tempfile import TemporaryDirectory
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "doctor.settings")
+
+from PyPDF2 import PdfMerger  # noqa: E402
+
+from doctor.lib.utils import strip_metadata  # noqa: E402
+
+
+def pypdf2_strip_metadata(path: str, output_path: str) -> None:
+    """Strip metadata the way we used to, for comparison"""
+    with open(path, "rb") as f:
+        pdf_merger = PdfMerger()
+        pdf_merger.append(io.BytesIO(f.read()))
+        pdf_merger.add_metadata({"/CreationDate": "", "/ModDate": ""})
+        byte_writer = io.BytesIO()
+        pdf_merger.write(byte_writer)
+    with open(output_path, "wb") as f:
+        f.write(byte_writer.getvalue())
+
+
+ENGINES = {
+    "qpdf": strip_metadata,
+    "pypdf2": pypdf2_strip_metadata,
+}
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def run_worker(args) -> None:
+    """Time one engine in this process and print the results as JSON"""
+    strip = ENGINES[args.worker]
+    timings = []
+    hashes = set()
+    with TemporaryDirectory() as directory:
+        output_path = os.path.join(directory, "stripped.pdf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            strip(args.filepath, output_path)
+            timings.append(time.perf_counter() - start)
+            hashes.add(hash_file(output_path))
+        output_size = os.path.getsize(output_path)
+
+    # ru_maxrss is in kilobytes on Linux
+    print(
+        json.dumps(
+            {
+                "engine": args.worker,
+                "median": median(timings),
+                "output_bytes": output_size,
+                "deterministic": len(hashes) == 1,
+                "max_rss_kb": resource.getrusage(
+                    resource.RUSAGE_SELF
+                ).ru_maxrss,
+            }
+        )
+    )
+
+
+def run_benchmark(args) -> None:
+    """Run each engine in its own process and print a table"""
+    input_mb = os.path.getsize(args.filepath) / 1024 / 1024
+    print(f"{args.filepath}: {input_mb:.1f} MB")
+    print(
+        f"{'engine':<8} {'median':>9} {'MB/s':>8} {'out MB':>7} "
+        f"{'rss MB':>7} {'stable':>7}"
+    )
+    for engine in args.engines:
+        process = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "doctor.benchmarks.metadata",
+                args.filepath,
+                "--worker",
+                engine,
+                "--repeat",
+                str(args.repeat),
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if process.returncode:
+            error = process.stderr.strip().splitlines()[-1:]
+            print(f"{engine:<8} failed: {''.join(error)}")
+            continue
+        result = json.loads(process.stdout)
+        print(
+            f"{engine:<8} {result['median']:>8.3f}s "
+            f"{input_mb / result['median']:>8.1f} "
+            f"{result['output_bytes'] / 1024 / 1024:>7.1f} "
+            f"{result['max_rss_kb'] / 1024:>7.1f} "
+            f"{'yes' if result['deterministic'] else 'no':>7}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("filepath", help="The PDF to strip")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per engine"
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        default=list(ENGINES),
+        choices=list(ENGINES),
+    )
+    parser.add_argument("--worker", choices=list(ENGINES))
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args)
+    else:
+        run_benchmark(args)
+
+
+if __name__ == "__main__":
+    main()
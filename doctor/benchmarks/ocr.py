@@ -0,0 +1,111 @@
+"""Measure what preprocessing scanned pages does to tesseract
+
+Every page is rendered at 300 DPI the way the recap extractor renders
+it, then each preprocessing step is timed, and tesseract is run on the
+page with and without preprocessing. Run it from the root of the repo:
+
+    python -m doctor.benchmarks.ocr doctor/test_assets/recap_extract/*.pdf
+
+Use the results to decide on OCR_PREPROCESS.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import time
+from statistics import mean, median
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "doctor.settings")
+
+import numpy as np  # noqa: E402
+import pdfplumber  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from doctor.lib.preprocess import (  # noqa: E402
+    binarize,
+    deskew,
+    estimate_skew,
+    remove_speckles,
+)
+from doctor.lib.text_extraction import (  # noqa: E402
+    convert_pdf_page_to_image,
+    ocr_image_to_data,
+)
+
+STEPS = ("binarize", "despeckle", "skew_estimate", "deskew")
+
+
+def timed(timings: dict, step: str, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    timings.setdefault(step, []).append(time.perf_counter() - start)
+    return result
+
+
+def preprocess_page(image: Image.Image, timings: dict) -> Image.Image:
+    """Preprocess a page like preprocess_image, timing every step"""
+    gray = np.asarray(image.convert("L"))
+    binary = timed(timings, "binarize", binarize, gray)
+    binary = timed(timings, "despeckle", remove_speckles, binary)
+    angle = timed(timings, "skew_estimate", estimate_skew, binary)
+    timings.setdefault("angle", []).append(angle)
+    if angle:
+        binary = timed(timings, "deskew", deskew, binary, angle)
+    return Image.fromarray(binary).convert("1", dither=Image.Dither.NONE)
+
+
+def ocr_page(image: Image.Image, timings: dict, label: str) -> None:
+    """Run tesseract on a page, recording its time and word confidence"""
+    blocks = timed(timings, label, ocr_image_to_data, image)
+    confidences = [conf for block in blocks for conf in block.conf]
+    timings.setdefault(f"{label}_words", []).append(len(confidences))
+    if confidences:
+        timings.setdefault(f"{label}_conf", []).append(mean(confidences))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "filepaths",
+        nargs="*",
+        default=sorted(glob.glob("doctor/test_assets/recap_extract/*.pdf")),
+        help="The PDFs to OCR",
+    )
+    args = parser.parse_args()
+    run_ocr = shutil.which("tesseract") is not None
+    if not run_ocr:
+        print("tesseract isn't installed, only timing preprocessing")
+
+    timings = {}
+    pages = 0
+    for filepath in args.filepaths:
+        with pdfplumber.open(filepath) as pdf:
+            for page in pdf.pages:
+                image = convert_pdf_page_to_image(page, strip_margin=False)
+                cleaned = preprocess_page(image, timings)
+                pages += 1
+                if run_ocr:
+                    ocr_page(image, timings, "tesseract")
+                    ocr_page(cleaned, timings, "tesseract_preprocessed")
+
+    print(f"{pages} pages from {len(args.filepaths)} PDFs")
+    print(f"{'step':<24} {'median':>9} {'total':>9}")
+    for step in STEPS + ("tesseract", "tesseract_preprocessed"):
+        if step in timings:
+            print(
+                f"{step:<24} {median(timings[step]):>8.3f}s "
+                f"{sum(timings[step]):>8.3f}s"
+            )
+    skewed = [abs(angle) for angle in timings["angle"] if angle]
+    print(f"{len(skewed)} pages deskewed, by up to {max(skewed, default=0)}°")
+    for label in ("tesseract", "tesseract_preprocessed"):
+        if f"{label}_conf" in timings:
+            print(
+                f"{label}: {sum(timings[f'{label}_words'])} words, mean "
+                f"confidence {mean(timings[f'{label}_conf']):.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Compare the thumbnail rendering backends on a PDF
+
+Each backend runs in a fresh Python process so that its peak RSS isn't
+polluted by the other backend, and the RSS of any child processes (i.e.,
+pdftoppm) is reported separately. Run it from the root of the repo:
+
+    python -m doctor.benchmarks.thumbnails path/to.pdf --pages 1-10
+
+Use the results to set THUMBNAIL_BACKEND (first page thumbnails) and
+THUMBNAIL_RANGE_BACKEND (zips of page ranges).
+
+The backends are timed with THUMBNAIL_IMAGE_FAST_PATH off, so that scans
+are really rendered. The fast path gets a row of its own, in front of the
+first backend, which it falls back to for pages that aren't scans. It
+only applies to first page thumbnails.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from statistics import median
+from tempfile import TemporaryDirectory
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "doctor.settings")
+
+from doctor.lib.render import (  # noqa: E402
+    RENDER_BACKENDS,
+    make_png_thumbnail_for_instance,
+    make_png_thumbnails,
+)
+
+
+def parse_pages(pages: str) -> list[int]:
+    """Parse a page range like 1-10
+
+    :param pages: The range, inclusive
+    :return: The page numbers
+    """
+    first, _, last = pages.partition("-")
+    return list(range(int(first), int(last or first) + 1))
+
+
+async def render_range(filepath: str, args, backend: str) -> int:
+    directory = TemporaryDirectory()
+    try:
+        thumbnails = make_png_thumbnails(
+            filepath,
+            args.max_dimension,
+            parse_pages(args.pages),
+            directory,
+            backend,
+        )
+        return len([path async for path in thumbnails])
+    finally:
+        directory.cleanup()
+
+
+def run_worker(args) -> None:
+    """Time one backend in this process and print the results as JSON"""
+    backend = args.worker
+    single, ranges = [], []
+    errors = []
+    pages = 0
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        _, err, returncode = asyncio.run(
+            make_png_thumbnail_for_instance(
+                args.filepath, args.max_dimension, backend
+            )
+        )
+        single.append(time.perf_counter() - start)
+        if returncode != "0":
+            errors.append(err)
+
+        if args.image_fast_path:
+            continue
+        start = time.perf_counter()
+        pages = asyncio.run(render_range(args.filepath, args, backend))
+        ranges.append(time.perf_counter() - start)
+
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(
+        json.dumps(
+            {
+                "backend": backend,
+                "single_median": median(single),
+                "range_median": median(ranges) if ranges else None,
+                "range_pages": pages,
+                "max_rss_kb": own,
+                "children_max_rss_kb": children,
+                "errors": errors[:1],
+            }
+        )
+    )
+
+
+def run_benchmark(args) -> None:
+    """Run each backend in its own process and print a table"""
+    print(
+        f"{'backend':<16} {'first page':>11} {'range':>9} {'pages':>6} "
+        f"{'rss MB':>7} {'child MB':>9}"
+    )
+    runs = [(backend, False) for backend in args.backends]
+    runs.append((args.backends[0], True))
+    for backend, image_fast_path in runs:
+        name = f"{backend}+image" if image_fast_path else backend
+        command = [
+            sys.executable,
+            "-m",
+            "doctor.benchmarks.thumbnails",
+            args.filepath,
+            "--worker",
+            backend,
+            "--pages",
+            args.pages,
+            "--max-dimension",
+            str(args.max_dimension),
+            "--repeat",
+            str(args.repeat),
+        ]
+        if image_fast_path:
+            command.append("--image-fast-path")
+        process = subprocess.run(
+            command,
+            capture_output=True,
+            text=True,
+            env={
+                **os.environ,
+                "THUMBNAIL_IMAGE_FAST_PATH": str(image_fast_path),
+            },
+        )
+        if process.returncode:
+            error = process.stderr.strip().splitlines()[-1:]
+            print(f"{name:<16} failed: {''.join(error)}")
+            continue
+        result = json.loads(process.stdout)
+        if result["range_median"] is None:
+            ranges = f"{'-':>9} {'-':>6}"
+        else:
+            ranges = (
+                f"{result['range_median']:>8.3f}s {result['range_pages']:>6}"
+            )
+        print(
+            f"{name:<16} {result['single_median']:>10.3f}s {ranges} "
+            f"{result['max_rss_kb'] / 1024:>7.1f} "
+            f"{result['children_max_rss_kb'] / 1024:>9.1f}"
+        )
+        if result["errors"]:
+            print(f"{'':<16} error: {result['errors'][0].strip()}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("filepath", help="The PDF to render")
+    parser.add_argument(
+        "--pages", default="1-10", help="The page range, e.g. 1-10"
+    )
+    parser.add_argument("--max-dimension", type=int, default=350)
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per backend"
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=list(RENDER_BACKENDS),
+        choices=list(RENDER_BACKENDS),
+    )
+    parser.add_argument("--worker", choices=list(RENDER_BACKENDS))
+    parser.add_argument("--image-fast-path", action="store_true")
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args)
+    else:
+        run_benchmark(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ from django import forms
 from django.core.exceptions import ValidationError
 from django.core.validators import FileExtensionValidator
 
+from doctor.lib.render import THUMBNAIL_FORMATS
+
 
 class BaseAudioFile(forms.Form):
     file = forms.FileField(label="document", required=True)
@@ -82,14 +84,85 @@ class ThumbnailForm(forms.Form):
     )
     max_dimension = forms.IntegerField(label="max-dimension", required=False)
     pages = forms.Field(label="pages", required=False)
+    max_dimensions = forms.Field(label="max-dimensions", required=False)
+    formats = forms.Field(label="formats", required=False)
 
     def clean(self):
-        """"""
+        """Parse the JSON lists and fill in defaults
+
+        If either max_dimensions or formats is given, the caller wants
+        variants, so the other one defaults to max_dimension or PNG.
+        Otherwise max_dimensions is None.
+        """
         if self.cleaned_data.get("pages"):
             self.cleaned_data["pages"] = json.loads(self.cleaned_data["pages"])
 
         if not self.cleaned_data["max_dimension"]:
             self.cleaned_data["max_dimension"] = 350
+
+        max_dimensions = self.cleaned_data.get("max_dimensions")
+        formats = self.cleaned_data.get("formats")
+        if not max_dimensions and not formats:
+            self.cleaned_data["max_dimensions"] = None
+            self.cleaned_data["formats"] = None
+            return self.cleaned_data
+        try:
+            max_dimensions = (
+                [int(d) for d in json.loads(max_dimensions)]
+                if max_dimensions
+                else [self.cleaned_data["max_dimension"]]
+            )
+            formats = (
+                [f.lower() for f in json.loads(formats)]
+                if formats
+                else ["png"]
+            )
+        except (ValueError, TypeError, AttributeError):
+            raise ValidationError("Unable to parse max_dimensions or formats.")
+        if not max_dimensions or any(d <= 0 for d in max_dimensions):
+            raise ValidationError("max_dimensions must be positive.")
+        if not formats or any(f not in THUMBNAIL_FORMATS for f in formats):
+            raise ValidationError(
+                f"formats must be some of: {', '.join(THUMBNAIL_FORMATS)}"
+            )
+        self.cleaned_data["max_dimensions"] = max_dimensions
+        self.cleaned_data["formats"] = list(dict.fromkeys(formats))
+        return self.cleaned_data
+
+
+class SpriteForm(forms.Form):
+    file = forms.FileField(
+        label="document",
+        required=True,
+        validators=[FileExtensionValidator(["pdf"])],
+    )
+    max_dimension = forms.IntegerField(
+        label="max-dimension", required=False, min_value=1
+    )
+    pages = forms.Field(label="pages", required=False)
+    columns = forms.IntegerField(label="columns", required=False, min_value=1)
+    format = forms.CharField(label="format", required=False)
+
+    def clean(self):
+        """Parse the pages and fill in defaults for a small sprite"""
+        if self.cleaned_data.get("pages"):
+            try:
+                self.cleaned_data["pages"] = [
+                    int(page)
+                    for page in json.loads(self.cleaned_data["pages"])
+                ]
+            except (ValueError, TypeError):
+                raise ValidationError("Unable to parse pages.")
+        if not self.cleaned_data.get("max_dimension"):
+            self.cleaned_data["max_dimension"] = 100
+        if not self.cleaned_data.get("columns"):
+            self.cleaned_data["columns"] = 10
+        sprite_format = (self.cleaned_data.get("format") or "jpeg").lower()
+        if sprite_format not in THUMBNAIL_FORMATS:
+            raise ValidationError(
+                f"format must be one of: {', '.join(THUMBNAIL_FORMATS)}"
+            )
+        self.cleaned_data["format"] = sprite_format
         return self.cleaned_data
 
 
@@ -98,6 +171,24 @@ class DocumentForm(BaseFileForm):
     mime = forms.BooleanField(label="mime", required=False)
     strip_margin = forms.BooleanField(label="strip-margin", required=False)
 
+
+class XrayForm(DocumentForm):
+    mode = forms.ChoiceField(
+        label="mode", choices=(("all", "all"), ("any", "any")), required=False
+    )
+    first_page = forms.IntegerField(
+        label="first-page", required=False, min_value=1
+    )
+    last_page = forms.IntegerField(
+        label="last-page", required=False, min_value=1
+    )
+
     def clean(self):
-        self.clean_file()
+        """Check the page range and default to every redaction"""
+        self.cleaned_data["mode"] = self.cleaned_data.get("mode") or "all"
+        first_page = self.cleaned_data.get("first_page") or 1
+        last_page = self.cleaned_data.get("last_page")
+        if last_page is not None and last_page < first_page:
+            raise ValidationError("last_page is before first_page.")
+        self.cleaned_data["first_page"] = first_page
         return self.cleaned_data
@@ -0,0 +1,480 @@
+import json
+import mmap
+import struct
+import subprocess
+from typing import NamedTuple
+
+from doctor.lib.identify import id3_size
+
+# How far past any ID3 tag to look for the first MPEG frame
+MP3_SYNC_BYTES = 64 * 1024
+# MP3s without a Xing or VBRI header are taken to be CBR if this many
+# frames in a row have the same bitrate
+CBR_CHECK_FRAMES = 8
+# An Ogg page is at most 65307 bytes, so the last one starts within this
+# much of the end
+OGG_TAIL_BYTES = 65536 + 1024
+
+# Bitrates in kbps by MPEG version (1, or 2 and 2.5) and layer, indexed by
+# the frame header's bitrate bits
+MPEG_BITRATES = {
+    key: [int(kbps) for kbps in table.split()]
+    for key, table in {
+        (1, 1): "0 32 64 96 128 160 192 224 256 288 320 352 384 416 448",
+        (1, 2): "0 32 48 56 64 80 96 112 128 160 192 224 256 320 384",
+        (1, 3): "0 32 40 48 56 64 80 96 112 128 160 192 224 256 320",
+        (2, 1): "0 32 48 56 64 80 96 112 128 144 160 176 192 224 256",
+        (2, 2): "0 8 16 24 32 40 48 56 64 80 96 112 128 144 160",
+        (2, 3): "0 8 16 24 32 40 48 56 64 80 96 112 128 144 160",
+    }.items()
+}
+MPEG_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+ASF_HEADER = bytes.fromhex("3026b2758e66cf11a6d900aa0062ce6c")
+ASF_FILE_PROPERTIES = bytes.fromhex("a1dcab8c47a9cf118ee400c00c205365")
+ASF_STREAM_PROPERTIES = bytes.fromhex("9107dcb7b7a9cf118ee600c00c205365")
+ASF_AUDIO_MEDIA = bytes.fromhex("409e69f84d5bcf11a8fd00805f5c442b")
+
+
+class AudioInfo(NamedTuple):
+    format: str
+    duration: float
+    sample_rate: int | None
+    channels: int | None
+    bit_rate: int | None
+
+
+class AudioProbeError(Exception):
+    """The audio's headers couldn't be read"""
+
+
+class MpegFrame(NamedTuple):
+    version: float
+    layer: int
+    bit_rate: int
+    sample_rate: int
+    channels: int
+    length: int
+    samples: int
+
+
+def parse_mpeg_frame(data: bytes | mmap.mmap, offset: int) -> MpegFrame | None:
+    """Parse the header of the MPEG audio frame at offset
+
+    :param data: The file
+    :param offset: Where the frame should start
+    :return: The frame, or None if there isn't a valid one there
+    """
+    header = data[offset : offset + 4]
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}.get(header[1] >> 3 & 0x3)
+    layer = {1: 3, 2: 2, 3: 1}.get(header[1] >> 1 & 0x3)
+    bit_rate_index = header[2] >> 4
+    sample_rate_index = header[2] >> 2 & 0x3
+    if (
+        version is None
+        or layer is None
+        or bit_rate_index in (0, 15)
+        or sample_rate_index == 3
+    ):
+        return None
+    bit_rate = MPEG_BITRATES[(min(version, 2), layer)][bit_rate_index] * 1000
+    sample_rate = MPEG_SAMPLE_RATES[version][sample_rate_index]
+    padding = header[2] >> 1 & 0x1
+    channels = 1 if header[3] >> 6 == 3 else 2
+    if layer == 1:
+        samples = 384
+        length = (12 * bit_rate // sample_rate + padding) * 4
+    elif layer == 2 or version == 1:
+        samples = 1152
+        length = 144 * bit_rate // sample_rate + padding
+    else:
+        samples = 576
+        length = 72 * bit_rate // sample_rate + padding
+    return MpegFrame(
+        version, layer, bit_rate, sample_rate, channels, length, samples
+    )
+
+
+def find_first_frame(data: bytes | mmap.mmap, start: int) -> int:
+    """Find the first MPEG frame, checking the one after it too
+
+    :param data: The file
+    :param start: Where to start looking, after any ID3 tag
+    :return: The offset of the frame
+    """
+    end = min(len(data), start + MP3_SYNC_BYTES)
+    offset = data.find(b"\xff", start, end)
+    while offset >= 0:
+        frame = parse_mpeg_frame(data, offset)
+        if frame and parse_mpeg_frame(data, offset + frame.length):
+            return offset
+        offset = data.find(b"\xff", offset + 1, end)
+    raise AudioProbeError("No MPEG frames")
+
+
+def vbr_header(
+    data: bytes | mmap.mmap, offset: int, frame: MpegFrame
+) -> tuple[bytes, int | None] | None:
+    """Find a Xing, Info or VBRI header in the first frame
+
+    Xing and VBRI headers mark VBR files. LAME writes the same header
+    tagged Info in CBR files.
+
+    :param data: The file
+    :param offset: The offset of the first frame
+    :param frame: The first frame
+    :return: The header's tag and the frame count, if it has one, or None
+    if there's no header
+    """
+    if frame.version == 1:
+        side_info = 17 if frame.channels == 1 else 32
+    else:
+        side_info = 9 if frame.channels == 1 else 17
+    xing = offset + 4 + side_info
+    tag = data[xing : xing + 4]
+    if tag in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[xing + 4 : xing + 8])[0]
+        if flags & 0x1:
+            return tag, struct.unpack(">I", data[xing + 8 : xing + 12])[0]
+        return tag, None
+    vbri = offset + 4 + 32
+    if data[vbri : vbri + 4] == b"VBRI":
+        return b"VBRI", struct.unpack(">I", data[vbri + 14 : vbri + 18])[0]
+    return None
+
+
+def vbr_frame_count(
+    data: bytes | mmap.mmap, offset: int, frame: MpegFrame
+) -> int | None:
+    """Get the frame count from a Xing, Info or VBRI header
+
+    :param data: The file
+    :param offset: The offset of the first frame, which holds the header
+    :param frame: The first frame
+    :return: The number of frames, or None if there's no header
+    """
+    header = vbr_header(data, offset, frame)
+    return header[1] if header else None
+
+
+def is_cbr_mp3(
+    data: bytes | mmap.mmap, sample_rate: int, bit_rate: int
+) -> bool:
+    """Check whether audio is a CBR MP3 at a sample rate and bitrate
+
+    Only the first frames are read, so the start of an upload will do.
+
+    :param data: The file, or its start
+    :param sample_rate: The sample rate it should have, in Hz
+    :param bit_rate: The bitrate it should have, in bits per second
+    :return: Whether it's an MPEG layer III file whose first frames all
+    have them, and it doesn't say it's VBR
+    """
+    try:
+        start = id3_size(data[:10]) if data[:3] == b"ID3" else 0
+        offset = find_first_frame(data, start)
+    except (AudioProbeError, IndexError):
+        return False
+    frame = parse_mpeg_frame(data, offset)
+    header = vbr_header(data, offset, frame)
+    if header:
+        if header[0] != b"Info":
+            return False
+        # LAME's Info frame is silent, and may have another bitrate
+        offset += frame.length
+    frames = 0
+    while frames < CBR_CHECK_FRAMES and (
+        frame := parse_mpeg_frame(data, offset)
+    ):
+        matches = (
+            frame.layer == 3
+            and frame.sample_rate == sample_rate
+            and frame.bit_rate == bit_rate
+        )
+        if not matches:
+            return False
+        frames += 1
+        offset += frame.length
+    return frames > 0
+
+
+def audio_end(data: bytes | mmap.mmap) -> int:
+    """Get where the audio ends, before any ID3v1 tag"""
+    if data[-128:-125] == b"TAG":
+        return len(data) - 128
+    return len(data)
+
+
+def scan_mp3_frames(data: bytes | mmap.mmap, offset: int) -> tuple[int, int]:
+    """Count the frames of an MP3 by walking from header to header
+
+    Only needed for VBR files without a Xing or VBRI header.
+
+    :param data: The file
+    :param offset: The offset of the first frame
+    :return: The number of samples and of audio bytes
+    """
+    samples = 0
+    start = offset
+    end = audio_end(data)
+    while offset < end and (frame := parse_mpeg_frame(data, offset)):
+        samples += frame.samples
+        offset += frame.length
+    return samples, offset - start
+
+
+def probe_mp3(data: bytes | mmap.mmap) -> AudioInfo:
+    """From a Xing or VBRI header, a constant bitrate, or every frame"""
+    start = id3_size(data[:10]) if data[:3] == b"ID3" else 0
+    offset = find_first_frame(data, start)
+    frame = parse_mpeg_frame(data, offset)
+    frames = vbr_frame_count(data, offset, frame)
+    if frames is not None:
+        duration = frames * frame.samples / frame.sample_rate
+        audio_bytes = audio_end(data) - offset
+        bit_rate = round(audio_bytes * 8 / duration) if duration else None
+    else:
+        bit_rates = set()
+        position = offset
+        for _ in range(CBR_CHECK_FRAMES):
+            next_frame = parse_mpeg_frame(data, position)
+            if not next_frame:
+                break
+            bit_rates.add(next_frame.bit_rate)
+            position += next_frame.length
+        if len(bit_rates) == 1:
+            bit_rate = frame.bit_rate
+            duration = (audio_end(data) - offset) * 8 / bit_rate
+        else:
+            samples, audio_bytes = scan_mp3_frames(data, offset)
+            duration = samples / frame.sample_rate
+            bit_rate = round(audio_bytes * 8 / duration) if duration else None
+    return AudioInfo(
+        "mp3", duration, frame.sample_rate, frame.channels, bit_rate
+    )
+
+
+class WavLayout(NamedTuple):
+    channels: int
+    sample_rate: int
+    byte_rate: int
+    block_align: int
+    data_offset: int
+    data_size: int
+
+
+def wav_layout(data: bytes | mmap.mmap) -> WavLayout:
+    """Find the format and the samples of a WAV from its chunks
+
+    :param data: The file
+    :return: The fmt chunk's fields, and where the data chunk's samples
+    are
+    """
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(data):
+        chunk_id = data[offset : offset + 4]
+        size = struct.unpack("<I", data[offset + 4 : offset + 8])[0]
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack("<HHIIH", data[offset + 8 : offset + 22])
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise AudioProbeError("No fmt chunk before the data")
+            if not fmt[3]:
+                raise AudioProbeError("The fmt chunk has no byte rate")
+            # Streamed WAVs leave the size at 0 or 0xFFFFFFFF
+            available = len(data) - offset - 8
+            if size in (0, 0xFFFFFFFF) or size > available:
+                size = available
+            return WavLayout(*fmt[1:], offset + 8, size)
+        offset += 8 + size + size % 2
+    raise AudioProbeError("No data chunk")
+
+
+def probe_wav(data: bytes | mmap.mmap) -> AudioInfo:
+    """From the fmt chunk and the size of the data chunk"""
+    layout = wav_layout(data)
+    return AudioInfo(
+        "wav",
+        layout.data_size / layout.byte_rate,
+        layout.sample_rate,
+        layout.channels,
+        layout.byte_rate * 8,
+    )
+
+
+def last_granule(data: bytes | mmap.mmap, serial: bytes) -> int:
+    """Get the granule position of the last Ogg page of a stream
+
+    :param data: The file
+    :param serial: The stream's serial number, as in its pages
+    :return: The granule position
+    """
+    tail_start = max(0, len(data) - OGG_TAIL_BYTES)
+    offset = data.rfind(b"OggS", tail_start)
+    while offset >= 0:
+        granule = struct.unpack("<q", data[offset + 6 : offset + 14])[0]
+        if data[offset + 14 : offset + 18] == serial and granule >= 0:
+            return granule
+        offset = data.rfind(b"OggS", tail_start, offset)
+    raise AudioProbeError("No last Ogg page")
+
+
+def probe_ogg(data: bytes | mmap.mmap) -> AudioInfo:
+    """From the codec header and the last page's granule position"""
+    segments = data[26]
+    packet = data[27 + segments : 27 + segments + 30]
+    serial = data[14:18]
+    if packet.startswith(b"OpusHead"):
+        channels = packet[9]
+        pre_skip = struct.unpack("<H", packet[10:12])[0]
+        # Opus granule positions are always at 48kHz
+        samples = last_granule(data, serial) - pre_skip
+        duration = max(samples, 0) / 48000
+        sample_rate = struct.unpack("<I", packet[12:16])[0] or 48000
+    elif packet.startswith(b"\x01vorbis"):
+        channels = packet[11]
+        sample_rate = struct.unpack("<I", packet[12:16])[0]
+        if not sample_rate:
+            raise AudioProbeError("The Vorbis header has no sample rate")
+        duration = last_granule(data, serial) / sample_rate
+    else:
+        raise AudioProbeError("Unsupported Ogg codec")
+    bit_rate = round(len(data) * 8 / duration) if duration else None
+    return AudioInfo("ogg", duration, sample_rate, channels, bit_rate)
+
+
+def probe_asf(data: bytes | mmap.mmap) -> AudioInfo:
+    """From the file properties and audio stream properties objects"""
+    count = struct.unpack("<I", data[24:28])[0]
+    offset = 30
+    duration = None
+    sample_rate = channels = bit_rate = None
+    for _ in range(count):
+        guid = data[offset : offset + 16]
+        size = struct.unpack("<Q", data[offset + 16 : offset + 24])[0]
+        if size < 24:
+            raise AudioProbeError("Malformed ASF header")
+        if guid == ASF_FILE_PROPERTIES:
+            play, _, preroll = struct.unpack(
+                "<QQQ", data[offset + 64 : offset + 88]
+            )
+            # Play duration is in 100ns units and includes the preroll
+            duration = max(play / 10_000_000 - preroll / 1000, 0)
+        elif (
+            guid == ASF_STREAM_PROPERTIES
+            and data[offset + 24 : offset + 40] == ASF_AUDIO_MEDIA
+        ):
+            # A WAVEFORMATEX follows the fixed fields
+            channels, sample_rate, byte_rate = struct.unpack(
+                "<HII", data[offset + 80 : offset + 90]
+            )
+            bit_rate = byte_rate * 8
+        offset += size
+    if duration is None:
+        raise AudioProbeError("No ASF file properties")
+    return AudioInfo("wma", duration, sample_rate, channels, bit_rate)
+
+
+def probe_audio(data: bytes | mmap.mmap) -> AudioInfo:
+    """Get the duration and stream details of audio from its headers
+
+    MP3, WAV, Ogg (Opus or Vorbis) and WMA are read from their headers,
+    which takes microseconds however long the recording. Only MP3s with
+    neither a VBR header nor a constant bitrate need every frame header
+    read.
+
+    :param data: The audio file
+    :return: What we found
+    :raises AudioProbeError: If the format isn't one of those, or its
+    headers are broken
+    """
+    try:
+        if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+            return probe_wav(data)
+        if data[:4] == b"OggS":
+            return probe_ogg(data)
+        if data[:16] == ASF_HEADER:
+            return probe_asf(data)
+        return probe_mp3(data)
+    except (struct.error, IndexError) as e:
+        raise AudioProbeError(f"Truncated header: {e}") from e
+    except ZeroDivisionError as e:
+        raise AudioProbeError(f"Malformed header: {e}") from e
+
+
+def estimate_duration(head: bytes, size: int) -> float:
+    """Estimate how long a recording is from its start and its size
+
+    For audio that's still being uploaded. WMAs and MP3s with a Xing or
+    VBRI header state their length. The rest are assumed to go on at the
+    bitrate of their start.
+
+    :param head: The start of the file
+    :param size: The size of the whole file, or more
+    :return: The duration, in seconds
+    :raises AudioProbeError: If the start can't be understood
+    """
+    info = probe_audio(head)
+    try:
+        if info.format == "wav":
+            layout = wav_layout(head)
+            return (size - layout.data_offset) / layout.byte_rate
+        if info.format == "mp3":
+            start = id3_size(head[:10]) if head[:3] == b"ID3" else 0
+            offset = find_first_frame(head, start)
+            frame = parse_mpeg_frame(head, offset)
+            if vbr_frame_count(head, offset, frame) is not None:
+                return info.duration
+            return (size - offset) * 8 / info.bit_rate
+    except (struct.error, IndexError, ZeroDivisionError) as e:
+        raise AudioProbeError(f"Truncated header: {e}") from e
+    if info.format == "ogg" and info.bit_rate:
+        return size * 8 / info.bit_rate
+    return info.duration
+
+
+def ffprobe(path: str) -> AudioInfo:
+    """Get the duration and stream details of audio with ffprobe
+
+    For formats probe_audio doesn't know, or headers it can't read.
+
+    :param path: The audio file
+    :return: What ffprobe found
+    :raises AudioProbeError: If ffprobe can't read the file either
+    """
+    process = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "format=format_name,duration,bit_rate:stream=sample_rate,channels",
+            "-of",
+            "json",
+            path,
+        ],
+        capture_output=True,
+    )
+    if process.returncode:
+        raise AudioProbeError(process.stderr.decode(errors="replace").strip())
+    result = json.loads(process.stdout)
+    container = result.get("format", {})
+    stream = (result.get("streams") or [{}])[0]
+    if "duration" not in container:
+        raise AudioProbeError("ffprobe found no duration")
+    return AudioInfo(
+        container.get("format_name", "unknown"),
+        float(container["duration"]),
+        int(stream["sample_rate"]) if "sample_rate" in stream else None,
+        stream.get("channels"),
+        int(container["bit_rate"]) if "bit_rate" in container else None,
+    )
@@ -0,0 +1,283 @@
+import struct
+import zlib
+from collections.abc import Iterator
+from itertools import islice
+from pathlib import Path
+from typing import NamedTuple
+
+from doctor.lib.audio_info import audio_end, find_first_frame, parse_mpeg_frame
+from doctor.lib.identify import id3_size
+
+# Each segment is encoded with this much of its neighbours' audio on either
+# side, so the encoder's state at the joins matches a single encode's. Opus
+# needs 80ms to converge, MP3 a couple of frames.
+PRE_ROLL_SECONDS = 0.25
+
+# Ogg pages of the joined audio hold about this many 48kHz samples
+OGG_PAGE_SAMPLES = 48000
+
+# Bit-reversed bytes, for computing Ogg's CRC with zlib
+BIT_REVERSE = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+
+class SegmentError(Exception):
+    """The encoded segments don't fit together"""
+
+
+class Segment(NamedTuple):
+    """Part of a recording to encode on its own
+
+    All are sample offsets into the whole recording. The audio from start
+    to end is encoded, and the frames that begin from keep_from up to
+    keep_to are kept. The last segment keeps everything after keep_from,
+    including the encoder's padding.
+    """
+
+    start: int
+    end: int
+    keep_from: int
+    keep_to: int | None
+
+
+def plan_segments(
+    samples: int, frame: int, count: int, pre_roll: int
+) -> list[Segment]:
+    """Split a recording into segments that join on frame boundaries
+
+    Every segment starts on a multiple of the codec's frame size, so its
+    frames line up with those of a single encode of the whole recording.
+
+    :param samples: The length of the recording, in samples
+    :param frame: The codec's samples per frame
+    :param count: The most segments to split it into
+    :param pre_roll: The frames of context to encode before and after each
+    segment
+    :return: The segments, in order
+    """
+    frames = -(-samples // frame)
+    per = -(-frames // max(1, min(count, frames)))
+    bounds = [i * frame for i in range(0, frames, per)] + [samples]
+    context = pre_roll * frame
+    segments = []
+    for keep_from, keep_to in zip(bounds, bounds[1:]):
+        last = keep_to == samples
+        segments.append(
+            Segment(
+                max(0, keep_from - context),
+                samples if last else min(samples, keep_to + context),
+                keep_from,
+                None if last else keep_to,
+            )
+        )
+    return segments
+
+
+def kept(units: Iterator[tuple[int, int, bytes]], segment: Segment):
+    """Pick the frames or packets of a segment that make it into the join
+
+    :param units: Each frame's offset in the segment and length in
+    samples, and the frame itself
+    :param segment: The segment they were encoded from
+    :return: The frames to keep, with their lengths
+    :raises SegmentError: If they don't cover the segment
+    """
+    covered = segment.keep_from
+    for position, length, unit in units:
+        position += segment.start
+        if position < segment.keep_from:
+            continue
+        if segment.keep_to is not None and position >= segment.keep_to:
+            break
+        if position != covered:
+            raise SegmentError(f"Frame at sample {position}, not {covered}")
+        covered += length
+        yield length, unit
+    if segment.keep_to is not None and covered != segment.keep_to:
+        raise SegmentError(f"Segment ends at {covered}, not {segment.keep_to}")
+
+
+def mpeg_frames(data: bytes) -> Iterator[tuple[int, int, bytes]]:
+    """Walk the frames of an MP3
+
+    :param data: The MP3
+    :return: Each frame's offset in samples, length in samples and bytes
+    """
+    start = id3_size(data[:10]) if data[:3] == b"ID3" else 0
+    offset = find_first_frame(data, start)
+    end = audio_end(data)
+    position = 0
+    while offset < end and (frame := parse_mpeg_frame(data, offset)):
+        yield position, frame.samples, data[offset : offset + frame.length]
+        position += frame.samples
+        offset += frame.length
+
+
+def join_mp3(paths: list[str], segments: list[Segment], output_path: str):
+    """Join MP3 segments into one MP3, frame for frame
+
+    The segments must be CBR, without a bit reservoir, so that no frame
+    borrows bits from a frame of another segment, and without ID3 tags or
+    Xing headers.
+
+    :param paths: The encoded segments
+    :param segments: What each was encoded from
+    :param output_path: Where to write the MP3
+    """
+    with open(output_path, "wb") as output:
+        for path, segment in zip(paths, segments):
+            data = Path(path).read_bytes()
+            for _, frame in kept(mpeg_frames(data), segment):
+                output.write(frame)
+
+
+def ogg_crc(data: bytes) -> int:
+    """Ogg's CRC32: unreflected, with no initial value or final XOR
+
+    :param data: The page, with its checksum zeroed
+    :return: The checksum
+    """
+    crc = zlib.crc32(data.translate(BIT_REVERSE), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f"{crc:032b}"[::-1], 2)
+
+
+def ogg_packets(data: bytes) -> Iterator[bytes]:
+    """Read the packets of the first logical stream of an Ogg file
+
+    :param data: The file
+    :return: Its packets, in order
+    """
+    offset = 0
+    serial = data[14:18]
+    packet = b""
+    while data[offset : offset + 4] == b"OggS":
+        segments = data[offset + 26]
+        lacing = data[offset + 27 : offset + 27 + segments]
+        body = offset + 27 + segments
+        if data[offset + 14 : offset + 18] == serial:
+            for size in lacing:
+                packet += data[body : body + size]
+                body += size
+                if size < 255:
+                    yield packet
+                    packet = b""
+        offset = offset + 27 + segments + sum(lacing)
+
+
+def opus_packet_samples(packet: bytes) -> int:
+    """Get how many 48kHz samples an Opus packet decodes to, from its TOC
+
+    :param packet: The packet
+    :return: The number of samples
+    """
+    config = packet[0] >> 3
+    if config < 12:
+        # SILK: 10, 20, 40 or 60ms
+        frame = (480, 960, 1920, 2880)[config % 4]
+    elif config < 16:
+        # Hybrid: 10 or 20ms
+        frame = (480, 960)[config % 2]
+    else:
+        # CELT: 2.5, 5, 10 or 20ms
+        frame = (120, 240, 480, 960)[config % 4]
+    code = packet[0] & 0x3
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F
+    return frame * frames
+
+
+def opus_packets(data: bytes) -> Iterator[tuple[int, int, bytes]]:
+    """Walk the audio packets of an Ogg Opus file
+
+    :param data: The file
+    :return: Each packet's offset in samples, length in samples and bytes
+    """
+    position = 0
+    # Skip the OpusHead and OpusTags packets
+    for packet in islice(ogg_packets(data), 2, None):
+        length = opus_packet_samples(packet)
+        yield position, length, packet
+        position += length
+
+
+def ogg_page(
+    flags: int, granule: int, serial: int, sequence: int, packets: list
+) -> bytes:
+    """Make an Ogg page of whole packets
+
+    :param flags: 2 for the first page of the stream, 4 for the last
+    :param granule: The granule position after the page's last packet
+    :param serial: The stream's serial number
+    :param sequence: The page's number in the stream
+    :param packets: The packets
+    :return: The page
+    """
+    lacing = bytearray()
+    for packet in packets:
+        lacing += b"\xff" * (len(packet) // 255) + bytes([len(packet) % 255])
+    page = bytearray(
+        struct.pack(
+            "<4sBBqIIIB",
+            b"OggS",
+            0,
+            flags,
+            granule,
+            serial,
+            sequence,
+            0,
+            len(lacing),
+        )
+    )
+    page += lacing
+    for packet in packets:
+        page += packet
+    page[22:26] = struct.pack("<I", ogg_crc(bytes(page)))
+    return bytes(page)
+
+
+def join_opus(
+    paths: list[str], segments: list[Segment], output_path: str, samples: int
+):
+    """Join Ogg Opus segments into one stream, packet for packet
+
+    The first segment's headers are kept. The packets are put in new pages
+    with granule positions counted from the start of the recording, and
+    the last page's trims the encoder's padding.
+
+    :param paths: The encoded segments
+    :param segments: What each was encoded from
+    :param output_path: Where to write the Ogg file
+    :param samples: The length of the recording at 48kHz
+    """
+    first = Path(paths[0]).read_bytes()
+    serial = struct.unpack("<I", first[14:18])[0]
+    head, tags = islice(ogg_packets(first), 2)
+    pre_skip = struct.unpack("<H", head[10:12])[0]
+    with open(output_path, "wb") as output:
+        output.write(ogg_page(2, 0, serial, 0, [head]))
+        output.write(ogg_page(0, 0, serial, 1, [tags]))
+        sequence = 2
+        granule = 0
+        page = []
+        page_samples = 0
+        for path, segment in zip(paths, segments):
+            data = first if path == paths[0] else Path(path).read_bytes()
+            for length, packet in kept(opus_packets(data), segment):
+                lacing = sum(len(p) // 255 + 1 for p in page)
+                if page and (
+                    page_samples >= OGG_PAGE_SAMPLES
+                    or lacing + len(packet) // 255 + 1 > 255
+                ):
+                    output.write(ogg_page(0, granule, serial, sequence, page))
+                    sequence += 1
+                    page = []
+                    page_samples = 0
+                page.append(packet)
+                page_samples += length
+                granule += length
+        if granule < pre_skip + samples:
+            raise SegmentError("The segments are shorter than the recording")
+        output.write(ogg_page(4, pre_skip + samples, serial, sequence, page))
@@ -0,0 +1,192 @@
+import hashlib
+import os
+from functools import cache, lru_cache
+from tempfile import NamedTemporaryFile
+
+import requests
+from django.conf import settings
+from seal_rookery.search import ImageSizes, seal
+
+from doctor.lib.metrics import (
+    SEAL_DOWNLOADS,
+    THUMBNAIL_CACHE_EVICTIONS,
+    THUMBNAIL_CACHE_HITS,
+    THUMBNAIL_CACHE_MISSES,
+)
+
+
+def hash_upload(upload) -> str:
+    """Hash the content of an uploaded file without reading it all at once
+
+    :param upload: A django UploadedFile
+    :return: The hex sha256 digest of the file
+    """
+    sha256 = hashlib.sha256()
+    for chunk in upload.chunks():
+        sha256.update(chunk)
+    upload.seek(0)
+    return sha256.hexdigest()
+
+
+class ThumbnailCache:
+    """A disk-backed LRU cache of rendered thumbnails
+
+    Entries live as files in a single directory that every worker shares.
+    Reading an entry bumps its mtime. Measuring the directory means
+    statting every entry, so each worker only does it after writing a
+    sixteenth of max_bytes, and if the directory is near max_bytes, the
+    entries with the oldest mtimes are deleted until there's room for
+    another sixteenth.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.slack = max_bytes // 16
+        # Measure the directory on the first write
+        self.written = self.slack
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(
+        pdf_hash: str,
+        page: int,
+        max_dimension: int,
+        backend: str,
+        image_fast_path: bool,
+    ) -> str:
+        """Make the cache key (and ETag) for a thumbnail
+
+        :param pdf_hash: The sha256 of the PDF
+        :param page: The page the thumbnail is of
+        :param max_dimension: The longest edge of the thumbnail
+        :param backend: The backend that rendered it, since backends don't
+        produce identical bytes
+        :param image_fast_path: Whether scans are thumbnailed from their
+        embedded image, which doesn't match a rendering either
+        :return: A key that is safe to use as a file name
+        """
+        return hashlib.sha256(
+            f"{pdf_hash}:{page}:{max_dimension}:{backend}:"
+            f"{image_fast_path}".encode()
+        ).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get(self, key: str) -> bytes | None:
+        """Get a thumbnail from the cache
+
+        :param key: The key from make_key
+        :return: The thumbnail, or None on a miss
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # Either never cached or evicted by another worker
+            THUMBNAIL_CACHE_MISSES.inc()
+            return None
+        THUMBNAIL_CACHE_HITS.inc()
+        return data
+
+    def set(self, key: str, data: bytes) -> None:
+        """Add a thumbnail to the cache, evicting old entries if needed
+
+        :param key: The key from make_key
+        :param data: The thumbnail
+        :return: None
+        """
+        # Write to a temp file and rename it into place so that other
+        # workers never read a partially written thumbnail.
+        with NamedTemporaryFile(
+            dir=self.directory, suffix=".tmp", delete=False
+        ) as f:
+            f.write(data)
+        os.replace(f.name, self._path(key))
+        self.written += len(data)
+        if self.written > self.slack:
+            self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently used entries until we're a sixteenth
+        under max_bytes, if we aren't already
+
+        :return: None
+        """
+        self.written = 0
+        limit = self.max_bytes - self.slack
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".png"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= limit:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another worker got there first
+                continue
+            THUMBNAIL_CACHE_EVICTIONS.inc()
+            total -= size
+            if total <= limit:
+                break
+
+
+@cache
+def get_thumbnail_cache() -> ThumbnailCache | None:
+    """Get the thumbnail cache for this process
+
+    :return: The cache, or None if it's disabled
+    """
+    if not settings.THUMBNAIL_CACHE_MAX_BYTES:
+        return None
+    return ThumbnailCache(
+        settings.THUMBNAIL_CACHE_DIR, settings.THUMBNAIL_CACHE_MAX_BYTES
+    )
+
+
+@lru_cache(maxsize=256)
+def get_seal(court: str, size: ImageSizes = ImageSizes.MEDIUM) -> bytes | None:
+    """Get the image of a court's seal, downloading it at most once
+
+    Seals are kept in memory by each process and on disk in
+    SEAL_CACHE_DIR for every worker, so only the first request for a
+    court's seal does any network I/O. Failed downloads aren't cached.
+
+    :param court: The CL court ID, e.g. ca9
+    :param size: The size of the seal
+    :return: The PNG, or None if the court has no seal
+    :raises requests.RequestException: If the download fails
+    """
+    url = seal(court=court, size=size)
+    if not url:
+        return None
+    path = os.path.join(settings.SEAL_CACHE_DIR, f"{court}-{size.value}.png")
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    response = requests.get(url, timeout=30)
+    response.raise_for_status()
+    SEAL_DOWNLOADS.inc()
+    os.makedirs(settings.SEAL_CACHE_DIR, exist_ok=True)
+    # Rename into place so other workers never read half a seal
+    with NamedTemporaryFile(
+        dir=settings.SEAL_CACHE_DIR, suffix=".tmp", delete=False
+    ) as f:
+        f.write(response.content)
+    os.replace(f.name, path)
+    return response.content
@@ -0,0 +1,151 @@
+import asyncio
+import os
+import threading
+from functools import cache
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class DownloadError(Exception):
+    """A file could not be downloaded"""
+
+
+class DownloadTooLarge(DownloadError):
+    """A download went over one of the byte limits"""
+
+
+class ByteBudget:
+    """Track the bytes downloaded by a group of concurrent downloads
+
+    Downloads run in threads that can't be cancelled, so once the group
+    fails they check the budget between chunks and give up.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def take(self, size: int) -> None:
+        """Count size more bytes against the budget
+
+        :param size: The number of bytes just downloaded
+        :return: None
+        """
+        with self._lock:
+            if self.cancelled:
+                raise DownloadError("Download cancelled")
+            self.used += size
+            if self.used > self.max_bytes:
+                raise DownloadTooLarge(
+                    f"Downloads exceeded {self.max_bytes} bytes in total"
+                )
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+
+
+@cache
+def get_session() -> requests.Session:
+    """Get the session that downloads share in this process
+
+    Its connection pool holds as many connections per host as the most
+    downloads a request may run at once, and it retries connection errors
+    and overloaded servers with exponential backoff.
+
+    :return: The session
+    """
+    retry = Retry(
+        total=settings.DOWNLOAD_RETRIES,
+        backoff_factor=settings.DOWNLOAD_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_maxsize=settings.DOWNLOAD_CONCURRENCY, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_to_file(
+    url: str, path: str, budget: ByteBudget | None = None
+) -> str:
+    """Stream a URL to a file, enforcing the download limits
+
+    :param url: The URL to download
+    :param path: Where to write it
+    :param budget: The budget shared with other downloads, if any
+    :return: The path
+    """
+    max_bytes = settings.DOWNLOAD_MAX_BYTES
+    try:
+        with get_session().get(
+            url,
+            stream=True,
+            timeout=(
+                settings.DOWNLOAD_CONNECT_TIMEOUT,
+                settings.DOWNLOAD_READ_TIMEOUT,
+            ),
+        ) as response:
+            response.raise_for_status()
+            content_length = response.headers.get("Content-Length")
+            if content_length and int(content_length) > max_bytes:
+                raise DownloadTooLarge(
+                    f"{url} is larger than {max_bytes} bytes"
+                )
+            size = 0
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise DownloadTooLarge(
+                            f"{url} is larger than {max_bytes} bytes"
+                        )
+                    if budget:
+                        budget.take(len(chunk))
+                    f.write(chunk)
+    except requests.RequestException as e:
+        raise DownloadError(f"Unable to download {url}: {e}") from e
+    return path
+
+
+async def download_files(urls: list[str], directory: str) -> list[str]:
+    """Download URLs to scratch files, a few at a time
+
+    At most settings.DOWNLOAD_CONCURRENCY downloads run at once, and
+    together they may not exceed settings.DOWNLOAD_MAX_TOTAL_BYTES. If
+    any download fails, the rest are abandoned.
+
+    :param urls: The URLs to download
+    :param directory: The directory to write the files to
+    :return: The paths of the files, in the same order as urls
+    """
+    semaphore = asyncio.Semaphore(settings.DOWNLOAD_CONCURRENCY)
+    budget = ByteBudget(settings.DOWNLOAD_MAX_TOTAL_BYTES)
+
+    async def download(i: int, url: str) -> str:
+        async with semaphore:
+            return await sync_to_async(
+                download_to_file, thread_sensitive=False
+            )(url, os.path.join(directory, f"download-{i}"), budget)
+
+    tasks = [
+        asyncio.create_task(download(i, url)) for i, url in enumerate(urls)
+    ]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        budget.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,186 @@
+import mimetypes
+import mmap
+import re
+from contextlib import contextmanager
+
+import magic
+from django.core.files.uploadedfile import TemporaryUploadedFile
+
+from doctor.lib.page_count import (
+    TAIL_BYTES,
+    PdfObjects,
+    PdfStructureError,
+    count_pages,
+)
+
+# libmagic is only shown the start of a file. This is enough for every
+# format we see except MP3s with big ID3 tags, whose audio we look for
+# after the tag.
+HEAD_BYTES = 64 * 1024
+
+# libmagic handles are slow to open, so share them. Each has a lock.
+DESCRIBE = magic.Magic()
+MIME = magic.Magic(mime=True)
+
+PDF_VERSION_RE = re.compile(rb"%PDF-([0-9]+(?:\.[0-9]+)?)")
+
+EXTENSION_FIXES = {
+    ".htm": ".html",
+    ".xml": ".html",
+    ".wsdl": ".html",
+    ".ksh": ".txt",
+    ".asf": ".wma",
+    ".dot": ".doc",
+}
+
+
+@contextmanager
+def open_upload(upload):
+    """Get at the bytes of an upload without copying it
+
+    :param upload: A file from request.FILES
+    :return: A memory map of the file Django spooled it to, or the bytes
+    of a small upload that's already in memory
+    """
+    if isinstance(upload, TemporaryUploadedFile) and upload.size:
+        with (
+            open(upload.temporary_file_path(), "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+        ):
+            yield data
+    else:
+        upload.seek(0)
+        yield upload.read()
+
+
+def id3_size(head: bytes) -> int:
+    """Get the length of the ID3v2 tag at the start of an MP3
+
+    :param head: The start of the file
+    :return: The length, including the header and any footer
+    """
+    size = 0
+    for byte in head[6:10]:
+        size = size << 7 | byte & 0x7F
+    has_footer = head[5] & 0x10
+    return 10 + size + (10 if has_footer else 0)
+
+
+def sniff(data: bytes | mmap.mmap) -> tuple[str, str]:
+    """Ask libmagic what a file is, from its first HEAD_BYTES
+
+    :param data: The file
+    :return: libmagic's description of the file and its mime type
+    """
+    head = data[:HEAD_BYTES]
+    description = DESCRIBE.from_buffer(head)
+    mime = MIME.from_buffer(head)
+    if head.startswith(b"ID3") and mime == "application/octet-stream":
+        # Cover art and the like pushed the audio out of the head
+        start = id3_size(head)
+        audio = data[start : start + HEAD_BYTES]
+        contains = DESCRIBE.from_buffer(audio)
+        description = f"{description}, contains: {contains}"
+        mime = MIME.from_buffer(audio)
+    return description, mime
+
+
+def trusted_mime(description: str, mime: str) -> str:
+    """A handful of workarounds for mime types libmagic gets wrong
+
+    :param description: libmagic's description of the file
+    :param mime: libmagic's mime type for the file
+    :return: The mime type to believe
+    """
+    if description.startswith("Composite Document File V2 Document"):
+        # Workaround for issue with libmagic1==5.09-2 in Ubuntu 12.04. Fixed
+        # in libmagic 5.11-2.
+        return "application/msword"
+    elif description == "(Corel/WP)":
+        return "application/vnd.wordperfect"
+    elif description == "C source, ASCII text":
+        return "text/plain"
+    elif description.startswith("WordPerfect document"):
+        return "application/vnd.wordperfect"
+    elif re.findall(
+        r"(Audio file with ID3.*MPEG.*layer III)|(.*Audio Media.*)",
+        description,
+    ):
+        return "audio/mpeg"
+    # No workaround necessary
+    return mime
+
+
+def trusted_extension(mime: str, head: bytes) -> str:
+    """Get an extension we can trust for a mime type
+
+    :param mime: The mime type from trusted_mime
+    :param head: The start of the file
+    :return: The extension, with its dot
+    """
+    extension = mimetypes.guess_extension(mime)
+    if extension == ".obj":
+        # It could be a wpd, if it's not a PDF
+        if b"PDF" in head[0:40]:
+            # Does 'PDF' appear in the beginning of the content?
+            extension = ".pdf"
+        else:
+            extension = ".wpd"
+
+    # The extension is .bin, look in the content if we can infer the
+    # content type as pdf. See: https://bugs.astron.com/view.php?id=446
+    # Check if %PDF-X.X is in the first 1024 bytes of content
+    if extension == ".bin" and PDF_VERSION_RE.search(head[:1024]):
+        # Document contains a pdf version, so the file must be a pdf
+        extension = ".pdf"
+
+    # guess_extension gives None for types it doesn't know
+    extension = extension or ""
+    return EXTENSION_FIXES.get(extension, extension).lower()
+
+
+def is_encrypted(data: bytes | mmap.mmap) -> bool:
+    """Check whether a PDF is encrypted, from its trailer
+
+    :param data: The PDF
+    :return: Whether the trailer has an /Encrypt dictionary
+    """
+    try:
+        trailer = PdfObjects(data).trailer
+    except PdfStructureError:
+        trailer = data[-TAIL_BYTES:]
+    return b"/Encrypt" in trailer
+
+
+def identify(data: bytes | mmap.mmap) -> dict:
+    """Work out what a file is, reading as little of it as possible
+
+    :param data: The file
+    :return: Its mime type, libmagic's description, an extension we can
+    trust and, for PDFs, the version, whether it's encrypted, and the
+    page count if the page tree can be found without parsing the PDF
+    """
+    head = data[:HEAD_BYTES]
+    description, mime = sniff(data)
+    mime = trusted_mime(description, mime)
+    extension = trusted_extension(mime, head)
+    result = {
+        "mimetype": mime,
+        "description": description,
+        "extension": extension,
+        "pdf_version": None,
+        "encrypted": None,
+        "page_count": None,
+    }
+    if extension != ".pdf":
+        return result
+
+    result["mimetype"] = "application/pdf"
+    if version := PDF_VERSION_RE.search(head[:1024]):
+        result["pdf_version"] = version.group(1).decode()
+    result["encrypted"] = is_encrypted(data)
+    try:
+        result["page_count"] = count_pages(data)
+    except PdfStructureError:
+        pass
+    return result
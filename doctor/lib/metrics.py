@@ -0,0 +1,220 @@
+import asyncio
+import inspect
+import os
+import time
+from functools import wraps
+
+from django.utils.decorators import sync_and_async_middleware
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Conversions range from milliseconds (page counts) to more than an hour
+# (OCR of long scans, en banc audio), so the buckets are wide.
+LATENCY_BUCKETS = (
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+    1800,
+    3600,
+)
+BYTES_BUCKETS = tuple(10**n for n in range(3, 11))
+PAGE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+REQUESTS = Counter(
+    "doctor_requests",
+    "Requests handled, by endpoint and status code.",
+    ["endpoint", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "doctor_request_duration_seconds",
+    "Time spent handling a request, by endpoint.",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_BYTES = Histogram(
+    "doctor_request_input_bytes",
+    "Size of the request body, by endpoint.",
+    ["endpoint"],
+    buckets=BYTES_BUCKETS,
+)
+REQUEST_PAGES = Histogram(
+    "doctor_request_pages",
+    "Pages in the documents sent to an endpoint.",
+    ["endpoint"],
+    buckets=PAGE_BUCKETS,
+)
+STAGE_LATENCY = Histogram(
+    "doctor_stage_duration_seconds",
+    "Time spent in a pipeline stage.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+OCR_PAGES = Counter(
+    "doctor_ocr_pages",
+    "Pages run through tesseract, by pipeline.",
+    ["pipeline"],
+)
+THUMBNAIL_CACHE_HITS = Counter(
+    "doctor_thumbnail_cache_hits",
+    "Thumbnails served from the thumbnail cache.",
+)
+THUMBNAIL_CACHE_MISSES = Counter(
+    "doctor_thumbnail_cache_misses",
+    "Thumbnails that had to be rendered.",
+)
+THUMBNAIL_CACHE_EVICTIONS = Counter(
+    "doctor_thumbnail_cache_evictions",
+    "Thumbnails deleted from the thumbnail cache to make room.",
+)
+SEAL_DOWNLOADS = Counter(
+    "doctor_seal_downloads",
+    "Court seals downloaded because they weren't in the seal cache.",
+)
+
+
+def endpoint_name(request) -> str:
+    """Get the label to use for a request's endpoint
+
+    :param request: The request object
+    :return: The name of the matched URL pattern, or "unknown"
+    """
+    match = getattr(request, "resolver_match", None)
+    if match is None or not match.url_name:
+        return "unknown"
+    return match.url_name
+
+
+def observe_pages(request, page_count: int | None) -> None:
+    """Record the number of pages in the document sent to an endpoint
+
+    :param request: The request object
+    :param page_count: The number of pages, if known
+    :return: None
+    """
+    if page_count:
+        REQUEST_PAGES.labels(endpoint_name(request)).observe(page_count)
+
+
+def timed_stage(stage: str):
+    """Decorate a function to record how long a pipeline stage takes
+
+    Works on plain functions, coroutine functions and async generators.
+    An async generator is timed while it produces items, but not while it
+    waits at yield for the consumer to ask for the next one.
+
+    :param stage: The name of the stage, e.g. "pdftotext"
+    :return: The decorator
+    """
+    histogram = STAGE_LATENCY.labels(stage)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time():
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        if inspect.isasyncgenfunction(func):
+
+            @wraps(func)
+            async def async_gen_wrapper(*args, **kwargs):
+                # Only count the time spent producing each item, not the
+                # time the consumer keeps us suspended at yield
+                elapsed = 0.0
+                items = func(*args, **kwargs)
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = await anext(items)
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            elapsed += time.perf_counter() - start
+                        yield item
+                finally:
+                    await items.aclose()
+                    histogram.observe(elapsed)
+
+            return async_gen_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time():
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _observe_request(request, response, start: float) -> None:
+    endpoint = endpoint_name(request)
+    REQUESTS.labels(endpoint, str(response.status_code)).inc()
+    REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+    try:
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        content_length = 0
+    if content_length:
+        REQUEST_BYTES.labels(endpoint).observe(content_length)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Record request counts, latency and input size for every endpoint"""
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            _observe_request(request, response, start)
+            return response
+
+    else:
+
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            _observe_request(request, response, start)
+            return response
+
+    return middleware
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Render the metrics in the Prometheus text format
+
+    When gunicorn runs several workers, each one writes its samples to
+    PROMETHEUS_MULTIPROC_DIR, and we aggregate them all here so that the
+    answer doesn't depend on which worker serves the scrape.
+
+    :return: A tuple of the rendered metrics and their content type
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
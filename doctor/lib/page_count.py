@@ -0,0 +1,381 @@
+import mmap
+import os
+import re
+import zlib
+
+import numpy as np
+
+# How far from the end of the file to look for startxref, and how much of a
+# trailer or object dictionary to read before giving up on finding a key
+TAIL_BYTES = 4096
+DICT_BYTES = 4096
+# How far a cross-reference section can be from where it's said to be
+OFFSET_SLACK = 64
+# The biggest file we'll scan whole for its catalog when the
+# cross-reference data is broken. Bigger files are left to PyPDF2.
+SCAN_BYTES = 16 * 1024 * 1024
+
+STARTXREF_RE = re.compile(rb"startxref\s+(\d+)")
+XREF_SUBSECTION_RE = re.compile(rb"\s*(\d+)\s+(\d+)[ \t]*\r?\n?")
+XREF_ENTRY_RE = re.compile(rb"(\d{10}) (\d{5}) ([nf])")
+OBJ_HEADER_RE = re.compile(rb"\s*(\d+)\s+(\d+)\s+obj\b")
+INT_RE = re.compile(rb"\s*(\d+)(?:\s+(\d+)\s+R)?")
+DICT_TOKEN_RE = re.compile(rb"<<|>>|/Count\b")
+XREF_SECTION_RE = re.compile(rb"(?<![a-z])xref\b|(?<!\d)\d+\s+\d+\s+obj\b")
+CATALOG_RE = re.compile(rb"/Type\s*/Catalog\b")
+
+
+class PdfStructureError(Exception):
+    """The PDF isn't laid out the way its cross-reference data says"""
+
+
+def starts_with(data: bytes | mmap.mmap, offset: int, prefix: bytes) -> bool:
+    return data[offset : offset + len(prefix)] == prefix
+
+
+def ref_re(key: bytes) -> re.Pattern:
+    return re.compile(rb"/" + key + rb"\s+(\d+)\s+(\d+)\s+R")
+
+
+ROOT_RE = ref_re(b"Root")
+PAGES_RE = ref_re(b"Pages")
+PREV_RE = re.compile(rb"/Prev\s+(\d+)")
+XREFSTM_RE = re.compile(rb"/XRefStm\s+(\d+)")
+LENGTH_RE = re.compile(rb"/Length\s+(\d+)(\s+\d+\s+R)?")
+W_RE = re.compile(rb"/W\s*\[\s*(\d+)\s+(\d+)\s+(\d+)\s*\]")
+INDEX_RE = re.compile(rb"/Index\s*\[([\d\s]*)\]")
+SIZE_RE = re.compile(rb"/Size\s+(\d+)")
+PREDICTOR_RE = re.compile(rb"/Predictor\s+(\d+)")
+FIRST_RE = re.compile(rb"/First\s+(\d+)")
+N_RE = re.compile(rb"/N\s+(\d+)")
+
+
+class PdfObjects:
+    """Find objects in a PDF from its cross-reference data, lazily
+
+    Only the sections of the cross-reference tables or streams needed to
+    find an object are parsed, so looking up the handful of objects that
+    lead to the page count takes microseconds even in huge files.
+    """
+
+    def __init__(self, data: bytes | mmap.mmap):
+        self.data = data
+        tail_start = max(0, len(data) - TAIL_BYTES)
+        matches = list(STARTXREF_RE.finditer(data, tail_start))
+        if not matches:
+            raise PdfStructureError("No startxref")
+        self.start = self.locate_section(int(matches[-1].group(1)))
+        self.trailer = self.read_trailer(self.start)
+
+    def locate_section(self, offset: int) -> int:
+        """Find a cross-reference section at or near where it should be
+
+        Plenty of writers get offsets a few bytes wrong, so look around.
+        """
+        if starts_with(self.data, offset, b"xref") or OBJ_HEADER_RE.match(
+            self.data, offset
+        ):
+            return offset
+        window_start = max(0, offset - OFFSET_SLACK)
+        window = self.data[window_start : offset + OFFSET_SLACK]
+        candidates = [
+            match.start() for match in XREF_SECTION_RE.finditer(window)
+        ]
+        if not candidates:
+            raise PdfStructureError(f"No xref at {offset}")
+        nearest = min(candidates, key=lambda c: abs(window_start + c - offset))
+        return window_start + nearest
+
+    def read_trailer(self, offset: int) -> bytes:
+        """Get the trailer dictionary of a cross-reference section"""
+        if starts_with(self.data, offset, b"xref"):
+            start = self.data.find(b"trailer", offset)
+            if start < 0:
+                raise PdfStructureError("No trailer")
+            return self.data[start : start + DICT_BYTES]
+        return self.read_xref_stream_dict(offset)
+
+    def read_xref_stream_dict(self, offset: int) -> bytes:
+        header = OBJ_HEADER_RE.match(self.data, offset)
+        if not header:
+            raise PdfStructureError(f"No xref at {offset}")
+        start = header.end()
+        end = self.data.find(b"stream", start, start + DICT_BYTES)
+        if end < 0:
+            raise PdfStructureError(f"No xref stream at {offset}")
+        return self.data[start:end]
+
+    def iter_sections(self):
+        """Yield the offset of each cross-reference section, newest first"""
+        seen = set()
+        offset = self.start
+        while offset not in seen:
+            seen.add(offset)
+            yield offset
+            trailer = self.read_trailer(offset)
+            if xref_stream := XREFSTM_RE.search(trailer):
+                # A hybrid file, with compressed objects only listed here
+                yield self.locate_section(int(xref_stream.group(1)))
+            prev = PREV_RE.search(trailer)
+            if not prev:
+                return
+            offset = self.locate_section(int(prev.group(1)))
+
+    def find(self, number: int) -> tuple[int, int]:
+        """Find where an object is
+
+        :param number: The object number
+        :return: A tuple of 1 and the offset of the object, or of 2, the
+        number of the object stream it's in and its index in that stream
+        """
+        for offset in self.iter_sections():
+            if starts_with(self.data, offset, b"xref"):
+                entry = self.find_in_table(offset, number)
+            else:
+                entry = self.find_in_stream(offset, number)
+            if entry is not None:
+                return entry
+        raise PdfStructureError(f"Object {number} isn't in the xref")
+
+    def find_in_table(self, offset: int, number: int) -> tuple | None:
+        position = offset + len(b"xref")
+        while True:
+            subsection = XREF_SUBSECTION_RE.match(self.data, position)
+            if not subsection:
+                return None
+            first, count = map(int, subsection.groups())
+            position = subsection.end()
+            if first <= number < first + count:
+                entry = XREF_ENTRY_RE.match(
+                    self.data, position + 20 * (number - first)
+                )
+                if not entry:
+                    raise PdfStructureError("Malformed xref entry")
+                if entry.group(3) == b"f":
+                    return None
+                return 1, int(entry.group(1))
+            position += 20 * count
+
+    def find_in_stream(self, offset: int, number: int) -> tuple | None:
+        dictionary = self.read_xref_stream_dict(offset)
+        widths = W_RE.search(dictionary)
+        if not widths:
+            raise PdfStructureError("No /W in xref stream")
+        widths = [int(width) for width in widths.groups()]
+        if index := INDEX_RE.search(dictionary):
+            ranges = list(map(int, index.group(1).split()))
+        else:
+            ranges = [0, int(SIZE_RE.search(dictionary).group(1))]
+        row = 0
+        for first, count in zip(ranges[::2], ranges[1::2]):
+            if first <= number < first + count:
+                row += number - first
+                break
+            row += count
+        else:
+            return None
+
+        rows = self.read_stream(offset, dictionary)
+        predictor = PREDICTOR_RE.search(dictionary)
+        row_size = sum(widths)
+        if predictor and int(predictor.group(1)) >= 10:
+            rows = undo_png_up_predictor(rows, row_size, row)
+        else:
+            rows = rows[row * row_size : (row + 1) * row_size]
+        fields = []
+        position = 0
+        for width in widths:
+            fields.append(int.from_bytes(rows[position : position + width]))
+            position += width
+        kind = fields[0] if widths[0] else 1
+        if kind == 0:
+            return None
+        return kind, fields[1]
+
+    def read_stream(self, offset: int, dictionary: bytes) -> bytes:
+        """Read the stream of the object at offset, inflated if need be"""
+        start = self.data.find(b"stream", offset) + len(b"stream")
+        if starts_with(self.data, start, b"\r\n"):
+            start += 2
+        elif starts_with(self.data, start, b"\n"):
+            start += 1
+        length = LENGTH_RE.search(dictionary)
+        if length and not length.group(2):
+            end = start + int(length.group(1))
+        else:
+            end = self.data.find(b"endstream", start)
+        if b"/Filter" not in dictionary:
+            return self.data[start:end]
+        if b"/FlateDecode" not in dictionary:
+            raise PdfStructureError("Unsupported stream filter")
+        return zlib.decompress(self.data[start:end])
+
+    def get(self, number: int) -> bytes:
+        """Get the start of an object, up to DICT_BYTES long
+
+        :param number: The object number
+        :return: The object's bytes, from just after its header
+        """
+        kind, location = self.find(number)
+        if kind == 1:
+            header = OBJ_HEADER_RE.match(self.data, location)
+            if not header or int(header.group(1)) != number:
+                raise PdfStructureError(f"Object {number} isn't at {location}")
+            return self.data[header.end() : header.end() + DICT_BYTES]
+        return self.get_compressed(location, number)
+
+    def get_compressed(self, stream_number: int, number: int) -> bytes:
+        if b"/Encrypt" in self.trailer:
+            raise PdfStructureError("Encrypted object stream")
+        kind, offset = self.find(stream_number)
+        if kind != 1:
+            raise PdfStructureError("Object stream inside an object stream")
+        header = OBJ_HEADER_RE.match(self.data, offset)
+        if not header:
+            raise PdfStructureError(f"No object stream at {offset}")
+        dictionary = self.data[
+            header.end() : self.data.find(b"stream", header.end())
+        ]
+        content = self.read_stream(offset, dictionary)
+        first = int(FIRST_RE.search(dictionary).group(1))
+        count = int(N_RE.search(dictionary).group(1))
+        numbers = list(map(int, content[:first].split()))[: count * 2]
+        for i in range(0, len(numbers), 2):
+            if numbers[i] == number:
+                start = first + numbers[i + 1]
+                end = first + numbers[i + 3] if i + 3 < len(numbers) else None
+                return content[start:end]
+        raise PdfStructureError(f"Object {number} isn't in its stream")
+
+
+def undo_png_up_predictor(data: bytes, row_size: int, row: int) -> bytes:
+    """Decode one row of an xref stream that uses the PNG Up predictor
+
+    Each row is the sum of the differences in every row up to it, so only
+    those rows are decoded.
+
+    :param data: The inflated stream
+    :param row_size: The bytes in a row, without the predictor byte
+    :param row: Which row to decode
+    :return: The decoded row
+    """
+    rows = np.frombuffer(
+        data, dtype=np.uint8, count=(row + 1) * (row_size + 1)
+    ).reshape(row + 1, row_size + 1)
+    predictors = rows[:, 0]
+    if not np.isin(predictors, (0, 2)).all():
+        raise PdfStructureError("Unsupported PNG predictor")
+    # Rows without a predictor restart the sum
+    raw = np.flatnonzero(predictors == 0)
+    start = raw[-1] if len(raw) else 0
+    return (
+        (rows[start:, 1:].sum(axis=0, dtype=np.uint64) % 256)
+        .astype(np.uint8)
+        .tobytes()
+    )
+
+
+def top_level_count(dictionary: bytes) -> tuple[int, int | None]:
+    """Find /Count in a dictionary, skipping any in nested dictionaries
+
+    :param dictionary: The bytes of the object, from its opening <<
+    :return: The count, and its object number if it's a reference
+    """
+    depth = 0
+    for token in DICT_TOKEN_RE.finditer(dictionary):
+        if token.group() == b"<<":
+            depth += 1
+        elif token.group() == b">>":
+            depth -= 1
+            if depth == 0:
+                break
+        elif depth == 1:
+            value = INT_RE.match(dictionary, token.end())
+            if value:
+                if value.group(2) is not None:
+                    return 0, int(value.group(1))
+                return int(value.group(1)), None
+    raise PdfStructureError("No /Count in the page tree")
+
+
+def count_from_xref(data: bytes | mmap.mmap) -> int:
+    """Count pages by following the trailer to the page tree's /Count"""
+    objects = PdfObjects(data)
+    root = ROOT_RE.search(objects.trailer)
+    if not root:
+        raise PdfStructureError("No /Root in the trailer")
+    pages = PAGES_RE.search(objects.get(int(root.group(1))))
+    if not pages:
+        raise PdfStructureError("No /Pages in the catalog")
+    count, reference = top_level_count(objects.get(int(pages.group(1))))
+    if reference is not None:
+        count = int(INT_RE.match(objects.get(reference)).group(1))
+    return count
+
+
+def count_from_scan(data: bytes | mmap.mmap) -> int:
+    """Count pages by finding the catalog and page tree without the xref
+
+    For files whose cross-reference data is damaged. The last catalog in
+    the file wins, as the latest update, and so does the last copy of the
+    page tree root. That takes a pass over the whole file, so files over
+    SCAN_BYTES aren't scanned at all; the caller falls through to PyPDF2,
+    which has to rebuild the cross-reference data anyway.
+    """
+    if len(data) > SCAN_BYTES:
+        raise PdfStructureError("Too big to scan for the catalog")
+    catalogs = list(CATALOG_RE.finditer(data))
+    if not catalogs:
+        raise PdfStructureError("No catalog")
+    start = data.rfind(b"obj", 0, catalogs[-1].start())
+    end = data.find(b"endobj", catalogs[-1].start())
+    pages = PAGES_RE.search(data, start, end)
+    if not pages:
+        raise PdfStructureError("No /Pages in the catalog")
+    number, generation = pages.groups()
+    headers = list(
+        re.finditer(
+            rb"(?<!\d)" + number + rb"\s+" + generation + rb"\s+obj\b", data
+        )
+    )
+    if not headers:
+        raise PdfStructureError("No page tree")
+    start = headers[-1].end()
+    count, reference = top_level_count(data[start : start + DICT_BYTES])
+    if reference is not None:
+        raise PdfStructureError("Indirect /Count")
+    return count
+
+
+def count_pages(data: bytes | mmap.mmap) -> int:
+    """Count the pages of a PDF that's in memory
+
+    :param data: The PDF
+    :return: The number of pages
+    :raises PdfStructureError: If the page tree can't be found
+    """
+    try:
+        return count_from_xref(data)
+    except (PdfStructureError, ValueError, AttributeError, zlib.error):
+        return count_from_scan(data)
+
+
+def count_pdf_pages(path: str) -> int:
+    """Count the pages of a PDF without parsing it
+
+    The page tree's root says how many pages there are, so we map the
+    file into memory and follow the trailer to it, reading only the few
+    objects on the way. If the cross-reference data is broken, we look
+    for the catalog instead.
+
+    :param path: The PDF
+    :return: The number of pages
+    :raises PdfStructureError: If neither way works
+    """
+    if not os.path.getsize(path):
+        raise PdfStructureError("Empty file")
+    with (
+        open(path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+    ):
+        return count_pages(data)
@@ -0,0 +1,506 @@
+import io
+import struct
+import zlib
+from collections.abc import Iterator
+from typing import BinaryIO
+
+from PIL import Image, TiffTags
+from PIL.TiffImagePlugin import ImageFileDirectory_v2, TiffImageFile
+
+from doctor.lib.metrics import timed_stage
+
+# img2pdf's default, for images that don't say how big they are
+DEFAULT_DPI = 96
+
+# TIFF tags
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC_INTERPRETATION = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+
+# How many rows of an uncompressed strip to decode at a time
+UNCOMPRESSED_BAND_ROWS = 256
+
+# Tall TIFFs are cut into pages of this height to width ratio, and laid out
+# at this resolution
+TIFF_PAGE_ASPECT = 1046 / 792
+TIFF_DPI = 100
+
+
+class PdfImageWriter:
+    """Write a PDF of full-page images to a file, one page at a time
+
+    Each page is written out as soon as it's added, so memory is bounded
+    by the largest page instead of the whole document. The PDF has no
+    document information dictionary or XMP metadata, so its bytes depend
+    only on the images, and there's nothing to strip afterwards.
+
+    Use it as a context manager, or call close() to finish the file.
+    """
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        # Object numbers 1 and 2 are saved for the catalog and the page tree,
+        # which can't be written until we know every page.
+        self.offsets = {}
+        self.pages = []
+        self.next_object = 3
+        self.position = 0
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def _write(self, data: bytes) -> None:
+        self.file.write(data)
+        self.position += len(data)
+
+    def _write_object(
+        self, body: bytes, stream: bytes | None = None, number: int = 0
+    ) -> int:
+        if not number:
+            number = self.next_object
+            self.next_object += 1
+        self.offsets[number] = self.position
+        self._write(b"%d 0 obj\n" % number + body)
+        if stream is not None:
+            self._write(b"\nstream\n")
+            self._write(stream)
+            self._write(b"\nendstream")
+        self._write(b"\nendobj\n")
+        return number
+
+    def add_encoded_image(
+        self,
+        data: bytes,
+        width: int,
+        height: int,
+        color_space: str,
+        bits: int,
+        image_filter: str,
+        dpi: tuple[float, float],
+        decode_parms: str = "",
+    ) -> None:
+        """Add a page holding one already encoded image
+
+        :param data: The encoded image
+        :param width: The width of the image, in pixels
+        :param height: The height of the image, in pixels
+        :param color_space: The PDF color space, e.g. "DeviceGray"
+        :param bits: Bits per component
+        :param image_filter: The PDF filter the data is encoded with
+        :param dpi: The horizontal and vertical resolution of the image
+        :param decode_parms: The body of a DecodeParms dictionary, if any
+        :return: None
+        """
+        image = self._write_object(
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+            b"/ColorSpace /%s /BitsPerComponent %d /Filter /%s "
+            b"%s/Length %d >>"
+            % (
+                width,
+                height,
+                color_space.encode(),
+                bits,
+                image_filter.encode(),
+                b"/DecodeParms << %s >> " % decode_parms.encode()
+                if decode_parms
+                else b"",
+                len(data),
+            ),
+            data,
+        )
+        page_width = width * 72 / dpi[0]
+        page_height = height * 72 / dpi[1]
+        content = b"q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (
+            page_width,
+            page_height,
+        )
+        contents = self._write_object(
+            b"<< /Length %d >>" % len(content), content
+        )
+        self.pages.append(
+            self._write_object(
+                b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] "
+                b"/Resources << /XObject << /Im0 %d 0 R >> >> "
+                b"/Contents %d 0 R >>"
+                % (page_width, page_height, image, contents)
+            )
+        )
+
+    def add_image(
+        self, image: Image.Image, dpi: tuple[float, float] | None = None
+    ) -> None:
+        """Add a page holding a decoded image
+
+        Bilevel images are encoded with CCITT G4, like a fax, and everything
+        else with Flate. Both are lossless.
+
+        :param image: The image
+        :param dpi: The resolution of the image, if not the one it says
+        :return: None
+        """
+        dpi = dpi or image_dpi(image)
+        if image.mode == "1":
+            data, black_is_1 = encode_ccitt_g4(image)
+            self.add_encoded_image(
+                data,
+                image.width,
+                image.height,
+                "DeviceGray",
+                1,
+                "CCITTFaxDecode",
+                dpi,
+                f"/K -1 /Columns {image.width} /Rows {image.height} "
+                f"/BlackIs1 {'true' if black_is_1 else 'false'}",
+            )
+            return
+        image = pdf_image_mode(image)
+        color_space, bits = {
+            "1": ("DeviceGray", 1),
+            "L": ("DeviceGray", 8),
+            "RGB": ("DeviceRGB", 8),
+        }[image.mode]
+        self.add_encoded_image(
+            zlib.compress(image.tobytes(), 6),
+            image.width,
+            image.height,
+            color_space,
+            bits,
+            "FlateDecode",
+            dpi,
+        )
+
+    def add_jpeg(self, path: str, image: Image.Image) -> None:
+        """Add a page holding a JPEG, without decoding or re-encoding it
+
+        :param path: The JPEG file
+        :param image: The JPEG, opened but not loaded
+        :return: None
+        """
+        color_space = {"L": "DeviceGray", "RGB": "DeviceRGB"}[image.mode]
+        with open(path, "rb") as f:
+            data = f.read()
+        self.add_encoded_image(
+            data,
+            image.width,
+            image.height,
+            color_space,
+            8,
+            "DCTDecode",
+            image_dpi(image),
+        )
+
+    def add_image_file(self, path: str) -> None:
+        """Add a page for each image in a file
+
+        JPEGs are copied as they are. Everything else is decoded a frame
+        at a time and compressed losslessly.
+
+        :param path: The image file
+        :return: None
+        """
+        with Image.open(path) as image:
+            if image.format == "JPEG" and image.mode in ("L", "RGB"):
+                self.add_jpeg(path, image)
+                return
+            for frame in range(getattr(image, "n_frames", 1)):
+                image.seek(frame)
+                self.add_image(image)
+
+    def close(self) -> None:
+        """Write the page tree, the catalog and the cross reference table
+
+        :return: None
+        """
+        kids = b" ".join(b"%d 0 R" % page for page in self.pages)
+        self._write_object(
+            b"<< /Type /Pages /Kids [%s] /Count %d >>"
+            % (kids, len(self.pages)),
+            number=2,
+        )
+        self._write_object(b"<< /Type /Catalog /Pages 2 0 R >>", number=1)
+        xref = self.position
+        self._write(b"xref\n0 %d\n" % self.next_object)
+        self._write(b"0000000000 65535 f \n")
+        for number in range(1, self.next_object):
+            self._write(b"%010d 00000 n \n" % self.offsets[number])
+        self._write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (self.next_object, xref)
+        )
+
+
+def pdf_image_mode(image: Image.Image) -> Image.Image:
+    """Convert an image to a mode that PDFs can hold directly
+
+    :param image: The image
+    :return: The image in mode 1, L or RGB
+    """
+    if image.mode in ("1", "L", "RGB"):
+        return image
+    return image.convert("L" if image.mode in ("LA", "I;16") else "RGB")
+
+
+def encode_ccitt_g4(image: Image.Image) -> tuple[bytes, bool]:
+    """Encode a bilevel image with CCITT G4
+
+    libtiff does the encoding. We ask for a single strip, since the PDF
+    filter wants one continuous G4 stream, and pull it out of the TIFF.
+
+    :param image: An image in mode 1
+    :return: A tuple of the encoded image and the value of the PDF
+    filter's BlackIs1 parameter that decodes it
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, "TIFF", compression="group4", strip_size=2**31)
+    buffer.seek(0)
+    with Image.open(buffer) as tiff:
+        (offset,) = tiff.tag_v2[STRIP_OFFSETS]
+        (count,) = tiff.tag_v2[STRIP_BYTE_COUNTS]
+        # libtiff codes the runs of 0 bits as white, so when 0 is black
+        # (BlackIsZero, as Pillow writes mode 1) the colors are swapped
+        black_is_1 = tiff.tag_v2.get(PHOTOMETRIC_INTERPRETATION, 0) == 1
+    return buffer.getvalue()[offset : offset + count], black_is_1
+
+
+def image_dpi(image: Image.Image) -> tuple[float, float]:
+    """Get the resolution of an image, falling back to DEFAULT_DPI
+
+    :param image: The image
+    :return: The horizontal and vertical resolution
+    """
+    dpi = image.info.get("dpi") or (DEFAULT_DPI, DEFAULT_DPI)
+    return tuple(float(d) if d and d > 1 else DEFAULT_DPI for d in dpi[:2])
+
+
+@timed_stage("pdf_assembly")
+def images_to_pdf_file(paths: list[str], output_path: str) -> None:
+    """Assemble image files into a PDF without metadata, a page at a time
+
+    :param paths: The image files, in page order
+    :param output_path: Where to write the PDF
+    :return: None
+    """
+    with open(output_path, "wb") as f, PdfImageWriter(f) as writer:
+        for path in paths:
+            writer.add_image_file(path)
+
+
+def make_tiff_block(
+    image: Image.Image, offset: int, count: int, width: int, height: int
+) -> bytes:
+    """Make a TIFF holding one strip or tile of a bigger TIFF
+
+    The strip or tile keeps its encoding, so that Pillow can decode it by
+    itself without decoding the rest of the image.
+
+    :param image: The bigger TIFF, opened but not loaded
+    :param offset: Where the strip or tile starts in the file
+    :param count: How many bytes it is
+    :param width: Its width in pixels
+    :param height: Its height in pixels
+    :return: The bytes of the new TIFF
+    """
+    tags = image.tag_v2
+    ifd = ImageFileDirectory_v2(prefix=tags.prefix)
+    for tag, value in tags.items():
+        if tag in (TILE_WIDTH, TILE_LENGTH, TILE_OFFSETS, TILE_BYTE_COUNTS):
+            continue
+        ifd[tag] = value
+        ifd.tagtype[tag] = tags.tagtype[tag]
+    # A tile is encoded just like a strip of the tile's size
+    for tag, value in (
+        (IMAGE_WIDTH, width),
+        (IMAGE_LENGTH, height),
+        (ROWS_PER_STRIP, height),
+        # Pillow points this past the IFD, where we put the data
+        (STRIP_OFFSETS, (0,)),
+        (STRIP_BYTE_COUNTS, (count,)),
+    ):
+        ifd[tag] = value
+        ifd.tagtype[tag] = TiffTags.LONG
+    byte_order = "<" if tags.prefix == b"II" else ">"
+    image.fp.seek(offset)
+    return (
+        tags.prefix
+        + struct.pack(f"{byte_order}HL", 42, 8)
+        + ifd.tobytes(8)
+        + image.fp.read(count)
+    )
+
+
+def decode_tiff_block(
+    image: Image.Image, offset: int, count: int, width: int, height: int
+) -> Image.Image:
+    with Image.open(
+        io.BytesIO(make_tiff_block(image, offset, count, width, height))
+    ) as block:
+        block.load()
+        return pdf_image_mode(block)
+
+
+def open_tiff(path: str) -> Image.Image:
+    """Open a TIFF without Pillow's limit on its size in pixels
+
+    The limit guards against decoding a huge image at once, but a TIFF is
+    decoded a strip at a time and each strip is checked against it by
+    itself. Files that aren't TIFFs are opened as usual, with the limit.
+
+    :param path: The image file
+    :return: The image, opened but not loaded
+    """
+    try:
+        return TiffImageFile(path)
+    except SyntaxError:
+        return Image.open(path)
+
+
+def check_pixel_limit(image: Image.Image) -> None:
+    """Refuse to decode an image whole if Pillow would refuse to open it
+
+    :param image: The image, opened but not loaded
+    :return: None
+    :raises DecompressionBombError: If the image is over twice
+    Image.MAX_IMAGE_PIXELS, as Image.open does
+    """
+    width, height = image.size
+    if Image.MAX_IMAGE_PIXELS and width * height > 2 * Image.MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(
+            f"Image size ({width * height} pixels) exceeds limit of "
+            f"{2 * Image.MAX_IMAGE_PIXELS} pixels"
+        )
+
+
+def iter_tiff_bands(image: Image.Image) -> Iterator[tuple[int, Image.Image]]:
+    """Decode a TIFF a strip, or a row of tiles, at a time
+
+    TIFFs we can't decode piecemeal (multi-page, planar, old-style JPEG,
+    or not TIFF at all) are decoded whole, as a single band. Compressed
+    strips can't be cut, so a TIFF that is one compressed strip (as G4
+    and LZW scans often are) is decoded whole too. Anything decoded at
+    once is held to Pillow's pixel limit.
+
+    :param image: The image, opened but not loaded
+    :return: An iterator of (top row, band) tuples, from top to bottom
+    """
+    tags = getattr(image, "tag_v2", {})
+    width, height = image.size
+    if (
+        image.format != "TIFF"
+        or getattr(image, "n_frames", 1) != 1
+        or tags.get(PLANAR_CONFIGURATION, 1) != 1
+        or tags.get(COMPRESSION, 1) == 6
+    ):
+        check_pixel_limit(image)
+        image.load()
+        yield 0, pdf_image_mode(image)
+        return
+
+    if TILE_OFFSETS in tags:
+        tile_width, tile_length = tags[TILE_WIDTH], tags[TILE_LENGTH]
+        across = -(-width // tile_width)
+        tiles = list(zip(tags[TILE_OFFSETS], tags[TILE_BYTE_COUNTS]))
+        for row, y in enumerate(range(0, height, tile_length)):
+            band = None
+            for column in range(across):
+                offset, count = tiles[row * across + column]
+                tile = decode_tiff_block(
+                    image, offset, count, tile_width, tile_length
+                )
+                if band is None:
+                    band = Image.new(
+                        tile.mode, (width, min(tile_length, height - y))
+                    )
+                band.paste(tile, (column * tile_width, 0))
+            yield y, band
+        return
+
+    rows_per_strip = min(tags.get(ROWS_PER_STRIP, height), height)
+    uncompressed = tags.get(COMPRESSION, 1) == 1
+    bits = tags.get(BITS_PER_SAMPLE, 1)
+    bits = sum(bits) if isinstance(bits, tuple) else bits
+    stride = -(-width * bits // 8)
+    strips = zip(tags[STRIP_OFFSETS], tags[STRIP_BYTE_COUNTS])
+    for top, (offset, count) in zip(range(0, height, rows_per_strip), strips):
+        rows = min(rows_per_strip, height - top)
+        if not uncompressed:
+            yield top, decode_tiff_block(image, offset, count, width, rows)
+            continue
+        # Uncompressed TIFFs are often one huge strip, but they can be cut
+        # on any row
+        for y in range(0, rows, UNCOMPRESSED_BAND_ROWS):
+            band_rows = min(UNCOMPRESSED_BAND_ROWS, rows - y)
+            yield (
+                top + y,
+                decode_tiff_block(
+                    image,
+                    offset + y * stride,
+                    band_rows * stride,
+                    width,
+                    band_rows,
+                ),
+            )
+
+
+@timed_stage("pdf_assembly")
+def tiff_to_pdf_file(path: str, output_path: str) -> None:
+    """Split one tall TIFF into letter-shaped pages of a PDF
+
+    Financial disclosures are sometimes a single TIFF many pages tall.
+    It's decoded a strip or a row of tiles at a time, and each page is
+    written out as soon as it's complete, so memory is bounded by a page
+    plus the largest strip. Two limits follow from that:
+
+    - A compressed strip is decoded whole, so a TIFF that is one strip
+      (RowsPerStrip equal to its height) takes memory for the whole image.
+    - Pillow's pixel limit (Image.MAX_IMAGE_PIXELS) applies to each strip,
+      or to the whole image when it can't be decoded piecemeal, rather
+      than to the TIFF as a whole. A strip over twice the limit raises
+      DecompressionBombError.
+
+    Bilevel pages are encoded with CCITT G4 and others with Flate.
+
+    :param path: The TIFF
+    :param output_path: Where to write the PDF
+    :return: None
+    """
+    with (
+        open_tiff(path) as image,
+        open(output_path, "wb") as f,
+        PdfImageWriter(f) as writer,
+    ):
+        width, height = image.size
+        page_height = round(TIFF_PAGE_ASPECT * width)
+        page, page_top = None, 0
+        for band_top, band in iter_tiff_bands(image):
+            y = band_top
+            while y < band_top + band.height:
+                if page is None:
+                    page = Image.new(
+                        band.mode, (width, min(page_height, height - page_top))
+                    )
+                rows = min(band_top + band.height, page_top + page.height) - y
+                page.paste(
+                    band.crop((0, y - band_top, width, y - band_top + rows)),
+                    (0, y - page_top),
+                )
+                y += rows
+                if y == page_top + page.height:
+                    writer.add_image(page, (TIFF_DPI, TIFF_DPI))
+                    page_top += page.height
+                    page = None
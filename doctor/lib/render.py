@@ -0,0 +1,596 @@
+import asyncio
+import io
+import os
+import threading
+from collections.abc import AsyncIterator, Iterable
+from pathlib import Path
+from typing import NamedTuple
+
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from PIL import Image
+
+from doctor.lib.metrics import timed_stage
+from doctor.lib.utils import run_subprocess
+
+# The formats thumbnails can be encoded as, mapped to their PIL names
+THUMBNAIL_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+# Encoder options for the lossy formats
+THUMBNAIL_SAVE_OPTIONS = {
+    "jpeg": {"quality": 85, "optimize": True},
+    "webp": {"quality": 80, "method": 4},
+}
+
+# The longest edge each format can encode
+THUMBNAIL_FORMAT_MAX_DIMENSIONS = {
+    "png": 2**31 - 1,
+    "jpeg": 65535,
+    "webp": 16383,
+}
+
+# pdfium isn't thread safe, so only one thread may call into it at a time
+pdfium_lock = threading.Lock()
+
+
+@timed_stage("pdftoppm")
+async def pdftoppm_render_page(
+    filepath: str, page: int, max_dimension: int
+) -> tuple[bytes, str, str]:
+    """Render one page to a PNG with pdftoppm
+
+    :param filepath: The location of the PDF
+    :param page: The page to render
+    :param max_dimension: The longest you want any edge to be
+    :return: A tuple of the PNG bytes, stderr and the return code
+    """
+    command = [
+        "pdftoppm",
+        "-singlefile",
+        "-f",
+        str(page),
+        "-scale-to",
+        str(max_dimension),
+        filepath,
+        "-png",
+    ]
+    stdout, stderr, returncode = await run_subprocess(command)
+    return stdout, stderr.decode("utf-8"), str(returncode)
+
+
+def group_page_runs(pages, max_run_length: int) -> list[tuple[int, int]]:
+    """Collapse page numbers into runs of contiguous pages
+
+    Runs are capped at max_run_length pages so that a long range can still
+    be split across several workers.
+
+    :param pages: The page numbers
+    :param max_run_length: The most pages to put into one run
+    :return: A list of (first, last) tuples, inclusive
+    """
+    runs = []
+    for page in sorted({int(page) for page in pages}):
+        if runs:
+            first, last = runs[-1]
+            if page == last + 1 and page - first < max_run_length:
+                runs[-1] = (first, page)
+                continue
+        runs.append((page, page))
+    return runs
+
+
+async def render_page_run(
+    filepath: str, max_dimension: int, first: int, last: int, directory: str
+) -> list[str]:
+    """Render a run of pages with one pdftoppm process
+
+    pdftoppm names its output after the prefix and a zero-padded page
+    number, so rename each file to thumb-{page}.png once it's done.
+
+    :param filepath: The location of the PDF
+    :param max_dimension: The longest you want any edge to be
+    :param first: The first page of the run
+    :param last: The last page of the run, inclusive
+    :param directory: The directory to write the thumbnails to
+    :return: The paths of the thumbnails, in page order
+    """
+    prefix = f"{directory}/run-{first}"
+    command = [
+        "pdftoppm",
+        "-f",
+        str(first),
+        "-l",
+        str(last),
+        "-scale-to",
+        str(max_dimension),
+        filepath,
+        "-png",
+        prefix,
+    ]
+    await run_subprocess(command)
+    thumbnails = {}
+    for path in Path(directory).glob(f"run-{first}-*.png"):
+        page = int(path.stem.rsplit("-", 1)[1])
+        thumbnails[page] = path.rename(f"{directory}/thumb-{page}.png")
+    return [str(thumbnails[page]) for page in sorted(thumbnails)]
+
+
+@timed_stage("pdftoppm")
+async def pdftoppm_render_pages(
+    filepath: str, max_dimension: int, pages, directory: str
+) -> AsyncIterator[str]:
+    """Render pages to PNG files with pdftoppm
+
+    Contiguous pages are rendered by a single pdftoppm process so that the
+    PDF is parsed once per run instead of once per page, and the runs are
+    spread across at most settings.THUMBNAIL_WORKERS processes at a time.
+    Thumbnails are yielded as soon as their run is done, so they don't
+    arrive in page order.
+
+    :param filepath: The location of the PDF
+    :param max_dimension: The longest you want any edge to be
+    :param pages: The page numbers to render
+    :param directory: The directory to write the thumbnails to
+    :return: An async iterator of thumbnail paths
+    """
+    workers = settings.THUMBNAIL_WORKERS
+    max_run_length = max(1, -(-len(pages) // workers))
+    semaphore = asyncio.Semaphore(workers)
+
+    async def render(first: int, last: int) -> list[str]:
+        async with semaphore:
+            return await render_page_run(
+                filepath, max_dimension, first, last, directory
+            )
+
+    tasks = [
+        asyncio.create_task(render(first, last))
+        for first, last in group_page_runs(pages, max_run_length)
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            for path in await task:
+                yield path
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def pdfium_render_png(
+    pdf: pdfium.PdfDocument, page: int, max_dimension: int
+) -> bytes:
+    """Render a page of an open document to PNG bytes
+
+    :param pdf: The open document
+    :param page: The page to render
+    :param max_dimension: The longest you want any edge to be
+    :return: The PNG bytes
+    """
+    with pdfium_lock:
+        pdf_page = pdf[page - 1]
+        width, height = pdf_page.get_size()
+        image = pdf_page.render(scale=max_dimension / max(width, height))
+        image = image.to_pil()
+        pdf_page.close()
+    # Encoding doesn't touch pdfium, so do it outside the lock
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def find_page_image(pdf_page: pdfium.PdfPage) -> pdfium.PdfImage | None:
+    """Find the image that makes up a whole page, as in most scans
+
+    The page may also hold invisible text, like an OCR layer, but nothing
+    else. The image has to cover almost all of the page, upright and
+    unflipped, and be gray or RGB so that we can decode it faithfully.
+
+    :param pdf_page: The page to check
+    :return: The image, or None if the page needs a full rendering
+    """
+    image = None
+    for obj in pdf_page.get_objects(max_depth=1):
+        if obj.type == pdfium_c.FPDF_PAGEOBJ_IMAGE and image is None:
+            image = obj
+        elif obj.type == pdfium_c.FPDF_PAGEOBJ_TEXT and (
+            pdfium_c.FPDFTextObj_GetTextRenderMode(obj.raw)
+            == pdfium_c.FPDF_TEXTRENDERMODE_INVISIBLE
+        ):
+            continue
+        else:
+            return None
+    if image is None:
+        return None
+
+    matrix = image.get_matrix()
+    if matrix.b or matrix.c or matrix.a <= 0 or matrix.d <= 0:
+        return None
+    left, bottom, right, top = image.get_bounds()
+    page_left, page_bottom, page_right, page_top = pdf_page.get_cropbox()
+    covered = max(0, min(right, page_right) - max(left, page_left)) * max(
+        0, min(top, page_top) - max(bottom, page_bottom)
+    )
+    page_area = (page_right - page_left) * (page_top - page_bottom)
+    if covered < 0.95 * page_area:
+        return None
+    if image.get_metadata().bits_per_pixel not in (1, 8, 24):
+        # CMYK, 16 bit and other oddities
+        return None
+    return image
+
+
+def extract_page_image(
+    filepath: str, page: int, max_dimension: int
+) -> bytes | None:
+    """Make a thumbnail of a scanned page from its embedded image
+
+    Scans are usually a single JPEG or CCITT fax image per page. Decoding
+    that image and shrinking it is far cheaper than rendering the page,
+    especially for JPEGs, which are decoded in draft mode so the decoder
+    can skip most of the work of a full size decode.
+
+    :param filepath: The location of the PDF
+    :param page: The page to make a thumbnail of
+    :param max_dimension: The longest you want any edge to be
+    :return: The PNG bytes, or None if the page isn't a single image
+    """
+    try:
+        with pdfium_lock:
+            pdf = pdfium.PdfDocument(filepath)
+            try:
+                pdf_page = pdf[page - 1]
+                image_obj = find_page_image(pdf_page)
+                if image_obj is None:
+                    return None
+                filters = image_obj.get_filters()
+                if filters not in (["DCTDecode"], ["CCITTFaxDecode"]):
+                    # Decoding anything else costs about as much as
+                    # rendering the page, so there's nothing to gain
+                    return None
+                rotation = pdf_page.get_rotation()
+                if filters == ["DCTDecode"]:
+                    jpeg = bytes(image_obj.get_data(decode_simple=False))
+                    image = None
+                else:
+                    # The PIL image shares the bitmap's memory, so keep a
+                    # reference to the bitmap until we're done with it
+                    bitmap = image_obj.get_bitmap(render=False)
+                    image = bitmap.to_pil()
+            finally:
+                pdf.close()
+    except (pdfium.PdfiumError, OSError, IndexError):
+        return None
+
+    if image is None:
+        image = Image.open(io.BytesIO(jpeg))
+        if image.mode not in ("L", "RGB"):
+            return None
+        width, height = image.size
+        scale = max_dimension / max(width, height)
+        image.draft(image.mode, (width * scale, height * scale))
+    width, height = image.size
+    scale = max_dimension / max(width, height)
+    image = image.resize(
+        (max(1, round(width * scale)), max(1, round(height * scale))),
+        Image.Resampling.LANCZOS,
+        # Shrink by whole factors first, which is much faster on big scans
+        reducing_gap=3.0,
+    )
+    if rotation:
+        # PDF rotation is clockwise, PIL's is counterclockwise
+        image = image.rotate(-rotation, expand=True)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def pdfium_open(filepath: str) -> pdfium.PdfDocument:
+    with pdfium_lock:
+        return pdfium.PdfDocument(filepath)
+
+
+def pdfium_close(pdf: pdfium.PdfDocument) -> None:
+    with pdfium_lock:
+        pdf.close()
+
+
+def pdfium_render_file_page(
+    filepath: str, page: int, max_dimension: int
+) -> bytes:
+    pdf = pdfium_open(filepath)
+    try:
+        return pdfium_render_png(pdf, page, max_dimension)
+    finally:
+        pdfium_close(pdf)
+
+
+@timed_stage("pdfium")
+async def pdfium_render_page(
+    filepath: str, page: int, max_dimension: int
+) -> tuple[bytes, str, str]:
+    """Render one page to a PNG in process with pdfium
+
+    :param filepath: The location of the PDF
+    :param page: The page to render
+    :param max_dimension: The longest you want any edge to be
+    :return: A tuple of the PNG bytes, an error message and a return code,
+    to match pdftoppm_render_page
+    """
+    try:
+        png = await sync_to_async(
+            pdfium_render_file_page, thread_sensitive=False
+        )(filepath, page, max_dimension)
+    except (pdfium.PdfiumError, OSError, IndexError) as e:
+        return b"", str(e), "1"
+    return png, "", "0"
+
+
+def pdfium_write_png(
+    pdf: pdfium.PdfDocument, page: int, max_dimension: int, path: str
+) -> None:
+    png = pdfium_render_png(pdf, page, max_dimension)
+    with open(path, "wb") as f:
+        f.write(png)
+
+
+@timed_stage("pdfium")
+async def pdfium_render_pages(
+    filepath: str, max_dimension: int, pages, directory: str
+) -> AsyncIterator[str]:
+    """Render pages to PNG files in process with pdfium
+
+    The document is opened once and every page is rendered from that
+    handle, in page order.
+
+    :param filepath: The location of the PDF
+    :param max_dimension: The longest you want any edge to be
+    :param pages: The page numbers to render
+    :param directory: The directory to write the thumbnails to
+    :return: An async iterator of thumbnail paths
+    """
+    try:
+        pdf = await sync_to_async(pdfium_open, thread_sensitive=False)(
+            filepath
+        )
+    except (pdfium.PdfiumError, OSError):
+        return
+    try:
+        for page in sorted({int(page) for page in pages}):
+            # Like pdftoppm, skip pages that don't exist
+            if not 1 <= page <= len(pdf):
+                continue
+            path = f"{directory}/thumb-{page}.png"
+            await sync_to_async(pdfium_write_png, thread_sensitive=False)(
+                pdf, page, max_dimension, path
+            )
+            yield path
+    finally:
+        await sync_to_async(pdfium_close, thread_sensitive=False)(pdf)
+
+
+class RenderBackend(NamedTuple):
+    render_page: callable
+    render_pages: callable
+
+
+RENDER_BACKENDS = {
+    "pdftoppm": RenderBackend(pdftoppm_render_page, pdftoppm_render_pages),
+    "pdfium": RenderBackend(pdfium_render_page, pdfium_render_pages),
+}
+
+
+def get_render_backend(name: str) -> RenderBackend:
+    """Look up a rendering backend by name
+
+    :param name: The name of the backend, e.g. "pdfium"
+    :return: The backend
+    """
+    try:
+        return RENDER_BACKENDS[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"Unknown render backend {name!r}. Choose one of: "
+            f"{', '.join(RENDER_BACKENDS)}"
+        )
+
+
+async def make_png_thumbnail_for_instance(
+    filepath, max_dimension, backend="pdftoppm", page=1
+):
+    """Abstract function for making a thumbnail for a PDF
+
+    Pages that are a single image, like most scans, are thumbnailed from
+    that image without rendering the page, unless that's turned off with
+    settings.THUMBNAIL_IMAGE_FAST_PATH.
+
+    :param filepath: The attr where the PDF is located on the item
+    :param max_dimension: The longest you want any edge to be
+    :param backend: The name of the rendering backend to use
+    :param page: The page to make a thumbnail of
+    :return: A tuple of the PNG bytes, any error and the return code
+    """
+    render_page = get_render_backend(backend).render_page
+    if settings.THUMBNAIL_IMAGE_FAST_PATH:
+        png = await timed_stage("embedded_image")(
+            sync_to_async(extract_page_image, thread_sensitive=False)
+        )(filepath, page, max_dimension)
+        if png:
+            return png, "", "0"
+    return await render_page(filepath, page, max_dimension)
+
+
+def make_png_thumbnails(
+    filepath, max_dimension, pages, directory, backend="pdftoppm"
+) -> AsyncIterator[str]:
+    """Abstract function for making thumbnails of several pages of a PDF
+
+    Thumbnails are written to directory as thumb-{page}.png and yielded as
+    they're done, which isn't necessarily in page order.
+
+    :param filepath: The attr where the PDF is located on the item
+    :param max_dimension: The longest you want any edge to be
+    :param pages: The page numbers to make thumbnails for
+    :param directory: The TemporaryDirectory to write the thumbnails to
+    :param backend: The name of the rendering backend to use
+    :return: An async iterator of thumbnail paths
+    """
+    render_pages = get_render_backend(backend).render_pages
+    return render_pages(filepath, max_dimension, pages, directory.name)
+
+
+def encode_thumbnail(image: Image.Image, thumbnail_format: str) -> bytes:
+    """Encode an image in one of THUMBNAIL_FORMATS
+
+    :param image: The image to encode
+    :param thumbnail_format: A key of THUMBNAIL_FORMATS, e.g. "webp"
+    :return: The encoded image
+    """
+    if thumbnail_format == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(
+        buffer,
+        THUMBNAIL_FORMATS[thumbnail_format],
+        **THUMBNAIL_SAVE_OPTIONS.get(thumbnail_format, {}),
+    )
+    return buffer.getvalue()
+
+
+@timed_stage("thumbnail_variants")
+def make_thumbnail_variants(
+    png: bytes, max_dimensions: Iterable[int], formats: Iterable[str]
+) -> dict[tuple[int, str], bytes]:
+    """Make every size and format of a thumbnail from one rendering
+
+    The page should be rendered once at the largest of max_dimensions.
+    Each smaller size is downscaled from the next larger one, which is
+    much cheaper than rasterizing the page again.
+
+    :param png: The page rendered as a PNG at the largest size
+    :param max_dimensions: The longest edges wanted, in pixels
+    :param formats: The keys of THUMBNAIL_FORMATS wanted
+    :return: A dict of the encoded thumbnails, keyed by (max_dimension,
+    format)
+    """
+    image = Image.open(io.BytesIO(png))
+    image.load()
+    dimensions = sorted(set(max_dimensions), reverse=True)
+    variants = {}
+    for dimension in dimensions:
+        if dimension != dimensions[0]:
+            image = image.copy()
+            image.thumbnail((dimension, dimension), Image.Resampling.LANCZOS)
+        for thumbnail_format in formats:
+            if dimension == dimensions[0] and thumbnail_format == "png":
+                # Already what the renderer gave us
+                variants[(dimension, thumbnail_format)] = png
+                continue
+            variants[(dimension, thumbnail_format)] = encode_thumbnail(
+                image, thumbnail_format
+            )
+    return variants
+
+
+def variant_name(page: int, dimension: int, thumbnail_format: str) -> str:
+    return f"thumb-{page}-{dimension}.{thumbnail_format}"
+
+
+def write_thumbnail_variants(
+    path: str, max_dimensions: list[int], formats: list[str]
+) -> list[str]:
+    """Replace a rendered thumbnail with all of its variants
+
+    :param path: A thumb-{page}.png file rendered at the largest size
+    :param max_dimensions: The longest edges wanted, in pixels
+    :param formats: The keys of THUMBNAIL_FORMATS wanted
+    :return: The paths of the variants, named thumb-{page}-{size}.{format}
+    """
+    page = int(Path(path).stem.rsplit("-", 1)[1])
+    with open(path, "rb") as f:
+        png = f.read()
+    os.remove(path)
+    paths = []
+    variants = make_thumbnail_variants(png, max_dimensions, formats)
+    for (dimension, thumbnail_format), data in variants.items():
+        variant_path = os.path.join(
+            os.path.dirname(path),
+            variant_name(page, dimension, thumbnail_format),
+        )
+        with open(variant_path, "wb") as f:
+            f.write(data)
+        paths.append(variant_path)
+    return paths
+
+
+async def make_thumbnail_variant_files(
+    thumbnails: AsyncIterator[str],
+    max_dimensions: list[int],
+    formats: list[str],
+) -> AsyncIterator[str]:
+    """Turn each rendered thumbnail into files for every size and format
+
+    :param thumbnails: An async iterator of thumbnail paths, as from
+    make_png_thumbnails rendered at the largest size
+    :param max_dimensions: The longest edges wanted, in pixels
+    :param formats: The keys of THUMBNAIL_FORMATS wanted
+    :return: An async iterator of the paths of the variants
+    """
+    async for path in thumbnails:
+        paths = await sync_to_async(
+            write_thumbnail_variants, thread_sensitive=False
+        )(path, max_dimensions, formats)
+        for variant_path in paths:
+            yield variant_path
+
+
+@timed_stage("sprite")
+def make_sprite(
+    thumbnails: dict[int, str], columns: int, sprite_format: str
+) -> tuple[bytes, dict]:
+    """Tile page thumbnails into one sprite image
+
+    Pages are laid out left to right, top to bottom, in page order, in
+    cells as big as the largest thumbnail. Each thumbnail sits in the top
+    left corner of its cell.
+
+    :param thumbnails: The paths of the thumbnails, keyed by page number
+    :param columns: The number of cells in each row
+    :param sprite_format: A key of THUMBNAIL_FORMATS
+    :return: A tuple of the encoded sprite and a dict describing it, with
+    the offset and size of each page keyed by page number
+    """
+    images = {}
+    for page in sorted(thumbnails):
+        with Image.open(thumbnails[page]) as image:
+            images[page] = image.convert("RGB")
+    cell_width = max(image.width for image in images.values())
+    cell_height = max(image.height for image in images.values())
+    columns = min(columns, len(images))
+    rows = -(-len(images) // columns)
+    width, height = columns * cell_width, rows * cell_height
+    if max(width, height) > THUMBNAIL_FORMAT_MAX_DIMENSIONS[sprite_format]:
+        raise ValueError(
+            f"A {width}x{height} sprite is too large for {sprite_format}"
+        )
+
+    sprite = Image.new("RGB", (width, height), "white")
+    tiles = {}
+    for i, (page, image) in enumerate(images.items()):
+        x = (i % columns) * cell_width
+        y = (i // columns) * cell_height
+        sprite.paste(image, (x, y))
+        tiles[page] = {
+            "x": x,
+            "y": y,
+            "width": image.width,
+            "height": image.height,
+        }
+    return encode_thumbnail(sprite, sprite_format), {
+        "width": width,
+        "height": height,
+        "format": sprite_format,
+        "pages": tiles,
+    }
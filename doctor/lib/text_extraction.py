@@ -3,10 +3,14 @@ import re
 import pandas as pd
 import pdfplumber
 import pytesseract
+from django.conf import settings
 from pdfplumber.ctm import CTM
 from PIL import Image
 from pytesseract import Output
 
+from doctor.lib.metrics import OCR_PAGES, timed_stage
+from doctor.lib.preprocess import preprocess_image
+
 
 def is_skewed(obj: dict) -> bool:
     """Check if a PDF plumber dict is skewed
@@ -29,6 +33,7 @@ def is_skewed(obj: dict) -> bool:
     return my_char_ctm.skew_x == 0
 
 
+@timed_stage("pdfplumber_layout")
 def get_page_text(page: pdfplumber.PDF.pages, strip_margin: bool) -> str:
     """Extract page text
 
@@ -172,6 +177,7 @@ def convert_pdf_page_to_image(
     return image
 
 
+@timed_stage("tesseract")
 def ocr_image_to_data(image: Image) -> list[pd.DataFrame]:
     """Perform OCR on an image to extract data
 
@@ -222,7 +228,10 @@ def extract_with_ocr(page: pdfplumber.pdf.Page, strip_margin: bool) -> str:
     """
 
     image = convert_pdf_page_to_image(page, strip_margin)
+    if settings.OCR_PREPROCESS:
+        image = preprocess_image(image)
     data = ocr_image_to_data(image)
+    OCR_PAGES.labels("recap").inc()
     content = ""
     prev = {}
     for words in data:
@@ -0,0 +1,186 @@
+import io
+from typing import NamedTuple
+
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
+import pytesseract
+from PIL import Image
+from PyPDF2 import PageObject, PdfReader
+from pytesseract import Output
+from reportlab.pdfgen import canvas
+
+from doctor.lib.metrics import OCR_PAGES
+from doctor.lib.render import pdfium_lock
+
+
+class OcrWord(NamedTuple):
+    text: str
+    left: int
+    top: int
+    height: int
+
+
+def page_has_text_layer(pdf_page: pdfium.PdfPage) -> bool:
+    """Check whether a page already has text that can be selected
+
+    Born digital pages have text and no images, and scans that have been
+    OCRed have invisible text over the image. Scans with some visible
+    text, like the header stamped on every page of a RECAP document,
+    still need OCR.
+
+    :param pdf_page: The page to check
+    :return: Whether to leave the page alone
+    """
+    has_text = has_image = False
+    for obj in pdf_page.get_objects():
+        if obj.type == pdfium_c.FPDF_PAGEOBJ_IMAGE:
+            has_image = True
+        elif obj.type == pdfium_c.FPDF_PAGEOBJ_TEXT:
+            if (
+                pdfium_c.FPDFTextObj_GetTextRenderMode(obj.raw)
+                == pdfium_c.FPDF_TEXTRENDERMODE_INVISIBLE
+            ):
+                return True
+            has_text = True
+    return has_text and not has_image
+
+
+def find_pages_to_ocr(path: str) -> list[int]:
+    """Find the pages of a PDF that don't have a text layer yet
+
+    :param path: The PDF
+    :return: The page numbers, starting from 1
+    """
+    with pdfium_lock:
+        pdf = pdfium.PdfDocument(path)
+        try:
+            return [
+                i + 1
+                for i, pdf_page in enumerate(pdf)
+                if not page_has_text_layer(pdf_page)
+            ]
+        finally:
+            pdf.close()
+
+
+def get_ocr_words(data: dict) -> list[OcrWord]:
+    """Pick the words out of tesseract's data for a page
+
+    :param data: The dict from pytesseract.image_to_data
+    :return: The words, without the rows for blocks, lines and so on
+    """
+    return [
+        OcrWord(text, int(left), int(top), int(height))
+        for text, left, top, height in zip(
+            data["text"], data["left"], data["top"], data["height"]
+        )
+        if text.strip()
+    ]
+
+
+def make_page_with_text(
+    words: list[OcrWord],
+    image_size: tuple[int, int],
+    page_size: tuple[float, float],
+) -> io.BytesIO:
+    """Make a page of invisible text to lay over a scanned page
+
+    :param words: The words tesseract found on the page
+    :param image_size: The width and height of the image tesseract read
+    :param page_size: The width and height of the page as displayed, in
+    points
+    :return: The page as a PDF
+    """
+    packet = io.BytesIO()
+    page_width, page_height = page_size
+    x_scale = page_width / image_size[0]
+    y_scale = page_height / image_size[1]
+    can = canvas.Canvas(packet, pagesize=page_size)
+    # Set to a standard size and font for now.
+    can.setFont("Helvetica", 9)
+    # Make the text transparent
+    can.setFillAlpha(0)
+    for word in words:
+        can.drawString(
+            word.left * x_scale,
+            page_height - (word.top + word.height) * y_scale,
+            word.text,
+        )
+    can.showPage()
+    can.save()
+    packet.seek(0)
+    return packet
+
+
+def displayed_size(page: PageObject) -> tuple[float, float]:
+    """Get the width and height of a page as displayed, after any rotation
+
+    :param page: The page
+    :return: The width and height in points
+    """
+    width, height = float(page.mediabox.width), float(page.mediabox.height)
+    if page.rotation % 180:
+        return height, width
+    return width, height
+
+
+def display_to_page_matrix(
+    rotation: int, left: float, bottom: float, width: float, height: float
+) -> tuple[float, ...]:
+    """Map points on a page as displayed to the page's own coordinates
+
+    :param rotation: The page's /Rotate, clockwise
+    :param left: The left of the media box
+    :param bottom: The bottom of the media box
+    :param width: The width of the media box, unrotated
+    :param height: The height of the media box, unrotated
+    :return: The transformation matrix
+    """
+    return {
+        0: (1, 0, 0, 1, left, bottom),
+        90: (0, 1, -1, 0, left + width, bottom),
+        180: (-1, 0, 0, -1, left + width, bottom + height),
+        270: (0, -1, 1, 0, left, bottom + height),
+    }[rotation % 360]
+
+
+def merge_text_layer(page: PageObject, layer_pdf: io.BytesIO) -> None:
+    """Lay a text layer from make_page_with_text over a page
+
+    :param page: The page, which may be rotated or have its media box
+    anywhere
+    :param layer_pdf: The text layer, drawn as the page is displayed
+    :return: None
+    """
+    mediabox = page.mediabox
+    layer = PdfReader(layer_pdf).pages[0]
+    layer.add_transformation(
+        display_to_page_matrix(
+            page.rotation,
+            float(mediabox.left),
+            float(mediabox.bottom),
+            float(mediabox.width),
+            float(mediabox.height),
+        ),
+        # merge_page clips to the layer's box, so move it too
+        expand=True,
+    )
+    page.merge_page(layer)
+
+
+def ocr_text_layer(
+    tiff_path: str, frame: int, page_size: tuple[float, float]
+) -> io.BytesIO:
+    """OCR one page of a rasterized PDF and make its text layer
+
+    :param tiff_path: The multipage TIFF of the pages to OCR
+    :param frame: Which page of the TIFF to OCR
+    :param page_size: The width and height of the page as displayed
+    :return: The text layer as a PDF
+    """
+    with Image.open(tiff_path) as image:
+        image.seek(frame)
+        data = pytesseract.image_to_data(image, output_type=Output.DICT)
+        image_size = image.size
+    OCR_PAGES.labels("embed").inc()
+    return make_page_with_text(get_ocr_words(data), image_size, page_size)
@@ -0,0 +1,172 @@
+import os
+import subprocess
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile, TemporaryFile
+
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import (
+    FileUploadHandler,
+    StopFutureHandlers,
+)
+
+from doctor.lib.metrics import timed_stage
+
+# How much of a failed command's stderr to keep for the error message
+STDERR_TAIL = 2000
+
+
+class PipedUpload(UploadedFile):
+    """An upload that went to a command's stdin instead of to a file
+
+    :ivar returncode: How the command exited
+    :ivar stderr: The end of what it wrote to stderr
+    """
+
+    def __init__(self, name, content_type, size, returncode, stderr):
+        super().__init__(None, name, content_type, size)
+        self.returncode = returncode
+        self.stderr = stderr
+
+    def open(self, mode=None):
+        raise ValueError("A piped upload can't be read again")
+
+
+class PipeUploadHandler(FileUploadHandler):
+    """Feed a file field to a command's stdin while it's being uploaded
+
+    Each chunk goes to the command as soon as Django reads it off the
+    socket, so the command works while the rest of the upload arrives.
+    When the command falls behind, the pipe fills up and reading the
+    upload waits for it, so only the pipe's buffer and one chunk are ever
+    held in memory. Other fields are left to the next handlers.
+
+    Install it before request.POST or request.FILES is touched:
+
+        request.upload_handlers.insert(0, PipeUploadHandler(request, cmd))
+
+    :param spool_if: A function of the start of the file that says to
+    leave the file to the next handlers after all, instead of piping it.
+    It's given the first chunk, and then more for as long as it returns
+    None, which means it can't tell yet.
+    :param stage: The metrics stage to time the command under. Only the
+    time it takes to finish once the upload is over is counted, since
+    until then it's waiting on the client.
+    """
+
+    def __init__(
+        self,
+        request,
+        command: list[str],
+        field_name="file",
+        spool_if=None,
+        stage: str | None = None,
+    ):
+        super().__init__(request)
+        self.command = command
+        self.piped_field = field_name
+        self.spool_if = spool_if
+        self.stage = stage
+        self.head = b""
+        self.process = None
+        self.piping = False
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.piping = field_name == self.piped_field and self.process is None
+        if not self.piping or self.spool_if is not None:
+            # With spool_if, the next handlers get ready for the file too,
+            # until its first chunk decides who gets it
+            return
+        self.start_process()
+        raise StopFutureHandlers()
+
+    def start_process(self):
+        # Closed in file_complete or upload_interrupted
+        self.stderr = TemporaryFile()  # noqa: SIM115
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=self.stderr,
+            close_fds=True,
+        )
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.piping:
+            return raw_data
+        if self.process is None:
+            self.head += raw_data
+            spool = self.spool_if(self.head)
+            if spool is None:
+                return None
+            raw_data, self.head = self.head, b""
+            if spool:
+                self.piping = False
+                return raw_data
+            self.start_process()
+        self.write(raw_data)
+        return None
+
+    def write(self, raw_data):
+        try:
+            self.process.stdin.write(raw_data)
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            # The command gave up. Read the rest of the upload anyway, and
+            # let its return code tell the view.
+            pass
+
+    def file_complete(self, file_size):
+        if not self.piping:
+            return None
+        self.piping = False
+        if self.process is None:
+            # An empty file, or one spool_if couldn't make up its mind about
+            self.start_process()
+            self.write(self.head)
+        if self.stage:
+            returncode = timed_stage(self.stage)(self.finish_process)()
+        else:
+            returncode = self.finish_process()
+        self.stderr.seek(0)
+        stderr = self.stderr.read().decode(errors="replace")[-STDERR_TAIL:]
+        self.stderr.close()
+        return PipedUpload(
+            self.file_name, self.content_type, file_size, returncode, stderr
+        )
+
+    def finish_process(self) -> int:
+        """Tell the command the upload is over and wait for it to finish
+
+        :return: Its return code
+        """
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return self.process.wait()
+
+    def upload_interrupted(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+            self.stderr.close()
+
+
+@contextmanager
+def upload_path(upload):
+    """Get a path to an upload, for commands that want a file
+
+    :param upload: A file from request.FILES
+    :return: The file Django spooled it to, or for a small upload held in
+    memory, a temporary copy with the same extension
+    """
+    if isinstance(upload, TemporaryUploadedFile):
+        yield upload.temporary_file_path()
+        return
+    suffix = os.path.splitext(upload.name or "")[1]
+    with NamedTemporaryFile(suffix=suffix) as tmp:
+        for chunk in upload.chunks():
+            tmp.write(chunk)
+        tmp.flush()
+        yield tmp.name
@@ -1,18 +1,26 @@
+import asyncio
 import datetime
 import io
 import logging
 import os
 import re
-import subprocess
+import threading
 import warnings
+import zipfile
 from collections import namedtuple
+from collections.abc import AsyncIterator, Iterator
 from decimal import Decimal
 from pathlib import Path
+from queue import Full, Queue
 from typing import Any
 
+import pikepdf
 import six
-from PyPDF2 import PdfMerger
-from reportlab.pdfgen import canvas
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, StreamingHttpResponse
+
+from doctor.lib.metrics import timed_stage
 
 
 class DoctorUnicodeDecodeError(UnicodeDecodeError):
@@ -163,60 +171,226 @@ def ignore_warnings(test_func):
     return do_test
 
 
-def make_png_thumbnail_for_instance(filepath, max_dimension):
-    """Abstract function for making a thumbnail for a PDF
-
-    See helper functions below for how to use this in a simple way.
+async def run_subprocess(
+    command: list[str], stdin: bytes | None = None
+) -> tuple[bytes, bytes, int]:
+    """Run a command without blocking the event loop
 
-    :param filepath: The attr where the PDF is located on the item
-    :param max_dimension: The longest you want any edge to be
-    :param response: Flask response object
+    :param command: The command and its arguments
+    :param stdin: Bytes to send to the process on stdin, if any
+    :return: A tuple of stdout, stderr and the return code
     """
-    command = [
-        "pdftoppm",
-        "-singlefile",
-        "-f",
-        "1",
-        "-scale-to",
-        str(max_dimension),
-        filepath,
-        "-png",
-    ]
-    p = subprocess.Popen(
-        command, close_fds=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=(
+            asyncio.subprocess.PIPE
+            if stdin is not None
+            else asyncio.subprocess.DEVNULL
+        ),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        close_fds=True,
     )
-    stdout, stderr = p.communicate()
-    return stdout, stderr.decode("utf-8"), str(p.returncode)
+    try:
+        stdout, stderr = await process.communicate(stdin)
+    except asyncio.CancelledError:
+        # Don't leave the process running if nobody wants its output
+        process.kill()
+        await process.wait()
+        raise
+    return stdout, stderr, process.returncode
+
+
+def write_upload(upload, path: str) -> None:
+    """Write an uploaded file to disk one chunk at a time
+
+    :param upload: A django UploadedFile
+    :param path: Where to write the file
+    :return: None
+    """
+    with open(path, "wb") as f:
+        for chunk in upload.chunks():
+            f.write(chunk)
+
 
+async def awrite_upload(upload, path: str) -> None:
+    """Write an uploaded file to disk without blocking the event loop
 
-def make_png_thumbnails(filepath, max_dimension, pages, directory):
-    """Abstract function for making a thumbnail for a PDF
+    :param upload: A django UploadedFile
+    :param path: Where to write the file
+    :return: None
+    """
+    await sync_to_async(write_upload, thread_sensitive=False)(upload, path)
 
-    See helper functions below for how to use this in a simple way.
 
-    :param filepath: The attr where the PDF is located on the item
-    :param max_dimension: The longest you want any edge to be
-    :param response: Flask response object
+class StreamBuffer(io.RawIOBase):
+    """A write-only buffer that hands over its contents as it fills up
+
+    zipfile treats it as an unseekable stream, so it writes each entry's
+    sizes after its data and never needs to go back.
     """
-    for page in pages:
-        command = [
-            "pdftoppm",
-            "-singlefile",
-            "-f",
-            str(page),
-            "-scale-to",
-            str(max_dimension),
-            filepath,
-            "-png",
-            f"{directory.name}/thumb-{page}",
-        ]
-        p = subprocess.Popen(
-            command,
-            close_fds=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        p.communicate()
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self) -> bytes:
+        """Take everything written since the last call"""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def stream_zip(paths: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    """Build a zip file on the fly from files as they become available
+
+    Entries are stored without compression because our payloads (PNGs) are
+    already compressed.
+
+    :param paths: An async iterator of the files to put in the zip
+    :return: An async iterator of the bytes of the zip file
+    """
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as zf:
+        async for path in paths:
+            await sync_to_async(zf.write, thread_sensitive=False)(
+                path, os.path.basename(path)
+            )
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+async def aiter_file(
+    file, chunk_size: int = 256 * 1024
+) -> AsyncIterator[bytes]:
+    """Read an open file in chunks without blocking the event loop
+
+    Django buffers synchronous iterators under ASGI, so use this instead of
+    a FileResponse to stream big files. The file is closed at the end.
+
+    :param file: A file opened in binary mode
+    :param chunk_size: How much to read at a time
+    :return: An async iterator of the file's bytes
+    """
+    try:
+        while chunk := await sync_to_async(file.read, thread_sensitive=False)(
+            chunk_size
+        ):
+            yield chunk
+    finally:
+        file.close()
+
+
+def iter_async(
+    chunks: AsyncIterator[bytes], buffer: int = 4
+) -> Iterator[bytes]:
+    """Iterate over an async iterator from synchronous code, as it goes
+
+    The async iterator runs on its own event loop in another thread, which
+    hands over each chunk as soon as it's made. Once buffer chunks are
+    waiting for the client, it waits too, so a slow client doesn't make us
+    hold the whole response in memory. If the client goes away, the async
+    iterator is closed.
+
+    :param chunks: The async iterator, not yet started
+    :param buffer: How many chunks may wait for the client
+    :return: An iterator of the same chunks
+    """
+    queue = Queue(maxsize=buffer)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                if not await asyncio.to_thread(put, chunk):
+                    return
+            put(end)
+        except Exception as e:
+            put(e)
+        finally:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+
+    thread = threading.Thread(target=asyncio.run, args=(produce(),))
+    thread.start()
+    try:
+        while (item := queue.get()) is not end:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def streaming_response(
+    request, chunks: AsyncIterator[bytes], **kwargs
+) -> StreamingHttpResponse:
+    """Stream an async iterator to the client, under ASGI or WSGI
+
+    Django's WSGI handler reads an async iterator to the end before it
+    sends any of it, so under WSGI it's sent through iter_async instead.
+
+    :param request: The request being answered
+    :param chunks: The body of the response
+    :param kwargs: Anything else for the StreamingHttpResponse
+    :return: The response
+    """
+    if not isinstance(request, ASGIRequest):
+        chunks = iter_async(chunks)
+    return StreamingHttpResponse(chunks, **kwargs)
+
+
+def file_response(
+    request, file, **kwargs
+) -> FileResponse | StreamingHttpResponse:
+    """Send an open file to the client without reading it into memory
+
+    Under WSGI that's a FileResponse, which the server can send with
+    sendfile. Under ASGI a FileResponse would be read in the event loop, so
+    the file is read in a thread with aiter_file instead.
+
+    :param request: The request being answered
+    :param file: A file opened in binary mode, closed once it's sent
+    :param kwargs: Anything else for the response
+    :return: The response
+    """
+    if not isinstance(request, ASGIRequest):
+        return FileResponse(file, **kwargs)
+    return StreamingHttpResponse(
+        aiter_file(file),
+        headers={"Content-Length": os.fstat(file.fileno()).st_size},
+        **kwargs,
+    )
+
+
+def make_zip(files: dict[str, bytes]) -> bytes:
+    """Build an uncompressed zip file in memory
+
+    :param files: The content of each file, keyed by its name in the zip
+    :return: The bytes of the zip file
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    return buffer.getvalue()
 
 
 def pdf_bytes_from_image_array(image_list, output_path) -> None:
@@ -237,37 +411,33 @@ def pdf_bytes_from_image_array(image_list, output_path) -> None:
     del image_list
 
 
-def strip_metadata_from_path(file_path):
-    """Convert PDF file into PDF and remove metadata from it
-
-    Stripping the metadata allows us to hash the PDFs
-
-    :param pdf_bytes: PDF as binary content
-    :return: PDF bytes with metadata removed.
-    """
-    with open(file_path, "rb") as f:
-        pdf_merger = PdfMerger()
-        pdf_merger.append(io.BytesIO(f.read()))
-        pdf_merger.add_metadata({"/CreationDate": "", "/ModDate": ""})
-        byte_writer = io.BytesIO()
-        pdf_merger.write(byte_writer)
-        return force_bytes(byte_writer.getvalue())
+@timed_stage("metadata_strip")
+def strip_metadata(path: str, output_path: str) -> None:
+    """Copy a PDF without its metadata, so that it can be hashed
 
+    The Info dictionary and the XMP metadata are dropped and everything
+    else is copied as is, with its streams still compressed. qpdf only
+    reads objects as it writes them out, so the PDF is never held in
+    memory, and the file ID is a hash of the contents, so the same PDF
+    always comes out byte for byte the same.
 
-def strip_metadata_from_bytes(pdf_bytes):
-    """Convert PDF bytes into PDF and remove metadata from it
-
-    Stripping the metadata allows us to hash the PDFs
-
-    :param pdf_bytes: PDF as binary content
-    :return: PDF bytes with metadata removed.
+    :param path: The PDF to strip
+    :param output_path: Where to write the stripped PDF
+    :return: None
     """
-    pdf_merger = PdfMerger()
-    pdf_merger.append(io.BytesIO(pdf_bytes))
-    pdf_merger.add_metadata({"/CreationDate": "", "/ModDate": ""})
-    byte_writer = io.BytesIO()
-    pdf_merger.write(byte_writer)
-    return force_bytes(byte_writer.getvalue())
+    with pikepdf.open(path, access_mode=pikepdf.AccessMode.stream) as pdf:
+        if "/Info" in pdf.trailer:
+            del pdf.trailer["/Info"]
+        if "/Metadata" in pdf.Root:
+            del pdf.Root["/Metadata"]
+        pdf.save(
+            output_path,
+            deterministic_id=True,
+            compress_streams=False,
+            stream_decode_level=pikepdf.StreamDecodeLevel.none,
+            object_stream_mode=pikepdf.ObjectStreamMode.preserve,
+            fix_metadata_version=False,
+        )
 
 
 def cleanup_form(form):
@@ -314,48 +484,6 @@ def ocr_needed(path: str, content: str) -> bool:
     return content.strip() == "" or pdf_has_images(path)
 
 
-def make_page_with_text(page, data, h, w):
-    """Make a page with text
-
-    :param page:
-    :param data:
-    :param h:
-    :param w:
-    :return:
-    """
-    packet = io.BytesIO()
-    can = canvas.Canvas(packet, pagesize=(w, h))
-    # Set to a standard size and font for now.
-    can.setFont("Helvetica", 9)
-    # Make the text transparent
-    can.setFillAlpha(0)
-    for i in range(len(data["level"])):
-        try:
-            letter, (x, y, _, hh), pg = (
-                data["text"][i],
-                (
-                    data["left"][i],
-                    data["top"][i],
-                    data["width"][i],
-                    data["height"][i],
-                ),
-                data["page_num"][i],
-            )
-        except Exception:
-            continue
-        # Adjust the text to an 8.5 by 11 inch page
-        sub = ((11 * 72) / h) * int(hh)
-        x = ((8.5 * 72) / w) * int(x)
-        y = ((11 * 72) / h) * int(y)
-        yy = (11 * 72) - y
-        if int(page) == int(pg):
-            can.drawString(x, yy - sub, letter)
-    can.showPage()
-    can.save()
-    packet.seek(0)
-    return packet
-
-
 def log_sentry_event(
     logger: logging.Logger,
     level: int,
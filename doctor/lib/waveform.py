@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+
+
+def waveform_peaks(
+    pcm_path: str, sample_rate: int, samples_per_pixel: int
+) -> dict:
+    """Reduce decoded audio to the min and max of each pixel's samples
+
+    The result is in audiowaveform's JSON format, which players like
+    peaks.js draw without decoding any audio.
+
+    :param pcm_path: Mono, 16 bit, little endian samples
+    :param sample_rate: Their sample rate
+    :param samples_per_pixel: How many samples each min and max covers
+    :return: The peaks, as 8 bit values interleaved min, max, min, max...
+    """
+    if os.path.getsize(pcm_path) < 2:
+        samples = np.zeros(0, dtype="<i2")
+    else:
+        samples = np.memmap(pcm_path, dtype="<i2", mode="r")
+    whole = len(samples) // samples_per_pixel * samples_per_pixel
+    pixels = samples[:whole].reshape(-1, samples_per_pixel)
+    mins = pixels.min(axis=1)
+    maxs = pixels.max(axis=1)
+    if whole < len(samples):
+        mins = np.append(mins, samples[whole:].min())
+        maxs = np.append(maxs, samples[whole:].max())
+    data = np.empty(len(mins) * 2, dtype=np.int8)
+    # Keep the high byte of each sample
+    data[0::2] = mins >> 8
+    data[1::2] = maxs >> 8
+    return {
+        "version": 2,
+        "channels": 1,
+        "sample_rate": sample_rate,
+        "samples_per_pixel": samples_per_pixel,
+        "bits": 8,
+        "length": len(mins),
+        "data": data.tolist(),
+    }
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 import environ
@@ -23,9 +24,69 @@ DEBUG = env.bool("DEBUG", default=False)
 SECRET_KEY = "this-is-a-not-so-secret-key"
 ALLOWED_HOSTS = ["doctor", "0.0.0.0", "localhost"]
 INSTALLED_APPS = []
+MIDDLEWARE = ["doctor.lib.metrics.metrics_middleware"]
 ROOT_URLCONF = "doctor.urls"
 WSGI_APPLICATION = "doctor.wsgi.application"
+ASGI_APPLICATION = "doctor.asgi.application"
+USE_TZ = True
 
+# The most pdftoppm processes a single thumbnails request may run at once
+THUMBNAIL_WORKERS = env.int("THUMBNAIL_WORKERS", default=os.cpu_count() or 1)
+
+# How to render thumbnails, per endpoint: "pdftoppm" runs the poppler
+# binary in a subprocess, "pdfium" renders in process. See
+# doctor/benchmarks/thumbnails.py to compare them on your own documents.
+THUMBNAIL_BACKEND = env("THUMBNAIL_BACKEND", default="pdftoppm")
+THUMBNAIL_RANGE_BACKEND = env("THUMBNAIL_RANGE_BACKEND", default="pdftoppm")
+
+# Thumbnail pages that are a single image (i.e., scans) by shrinking that
+# image instead of rendering the page
+THUMBNAIL_IMAGE_FAST_PATH = env.bool("THUMBNAIL_IMAGE_FAST_PATH", default=True)
+
+# The most pages a request may OCR at once when embedding a text layer
+OCR_WORKERS = env.int("OCR_WORKERS", default=os.cpu_count() or 1)
+
+# Bad redaction checks of more than XRAY_SHARD_PAGES pages are split into
+# shards of that many pages, inspected by up to XRAY_WORKERS processes
+XRAY_SHARD_PAGES = env.int("XRAY_SHARD_PAGES", default=50)
+XRAY_WORKERS = env.int("XRAY_WORKERS", default=os.cpu_count() or 1)
+
+# Binarize, despeckle and deskew scanned pages before running tesseract
+OCR_PREPROCESS = env.bool("OCR_PREPROCESS", default=False)
+
+# Limits for downloading the images that images_to_pdf combines. Timeouts
+# are in seconds, and failed connections and 429/5xx responses are retried
+# with exponential backoff.
+DOWNLOAD_CONCURRENCY = env.int("DOWNLOAD_CONCURRENCY", default=8)
+DOWNLOAD_CONNECT_TIMEOUT = env.float("DOWNLOAD_CONNECT_TIMEOUT", default=10)
+DOWNLOAD_READ_TIMEOUT = env.float("DOWNLOAD_READ_TIMEOUT", default=60)
+DOWNLOAD_RETRIES = env.int("DOWNLOAD_RETRIES", default=3)
+DOWNLOAD_BACKOFF = env.float("DOWNLOAD_BACKOFF", default=0.5)
+DOWNLOAD_MAX_BYTES = env.int("DOWNLOAD_MAX_BYTES", default=100 * 1024 * 1024)
+DOWNLOAD_MAX_TOTAL_BYTES = env.int(
+    "DOWNLOAD_MAX_TOTAL_BYTES", default=1024 * 1024 * 1024
+)
+
+# Rendered thumbnails are cached on disk, keyed by the PDF's hash, the page,
+# the max dimension, the backend and THUMBNAIL_IMAGE_FAST_PATH. Set the size
+# to 0 to disable the cache.
+THUMBNAIL_CACHE_DIR = env(
+    "THUMBNAIL_CACHE_DIR", default="/tmp/doctor-thumbnails"
+)
+THUMBNAIL_CACHE_MAX_BYTES = env.int(
+    "THUMBNAIL_CACHE_MAX_BYTES", default=256 * 1024 * 1024
+)
+
+# Audio recordings longer than AUDIO_SEGMENT_SECONDS are decoded once, split
+# into up to AUDIO_WORKERS segments that are encoded at the same time, and
+# joined. Shorter ones are piped into one ffmpeg as they're uploaded. Set it
+# to 0 to pipe every upload.
+AUDIO_SEGMENT_SECONDS = env.int("AUDIO_SEGMENT_SECONDS", default=1800)
+AUDIO_WORKERS = env.int("AUDIO_WORKERS", default=os.cpu_count() or 1)
+
+# Court seals for MP3 cover art are downloaded once and kept here, shared by
+# every worker, keyed by court and size
+SEAL_CACHE_DIR = env("SEAL_CACHE_DIR", default="/tmp/doctor-seals")
 
 SENTRY_DSN = env("SENTRY_DSN", default="")
 if SENTRY_DSN:
@@ -1,77 +1,85 @@
-import asyncio
 import base64
 import io
+import json
+import logging
+import math
+import mmap
 import os
 import re
+import shutil
 import subprocess
-from collections.abc import ByteString
-from tempfile import NamedTemporaryFile
+from concurrent.futures import (
+    BrokenExecutor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 from typing import Any, AnyStr
 
 import eyed3
 import magic
 import pdfplumber
 import requests
-import xray
+from django.conf import settings
 from eyed3 import id3
+from fitz import Document
 from lxml.html.clean import Cleaner
-from PIL.Image import Image
-from PyPDF2 import PdfMerger, PdfReader
+from PyPDF2 import PdfReader, PdfWriter
 from PyPDF2.errors import PdfReadError
-from seal_rookery.search import ImageSizes, seal
-
+from seal_rookery.search import ImageSizes
+from xray.pdf_utils import get_bad_redactions
+from xray.text_utils import check_if_all_dates, looks_like_a_date
+
+from doctor.lib.audio_info import (
+    AudioProbeError,
+    estimate_duration,
+    is_cbr_mp3,
+    wav_layout,
+)
+from doctor.lib.audio_segments import (
+    PRE_ROLL_SECONDS,
+    Segment,
+    join_mp3,
+    join_opus,
+    plan_segments,
+)
+from doctor.lib.cache import get_seal
+from doctor.lib.fetch import download_files
+from doctor.lib.identify import id3_size
+from doctor.lib.metrics import OCR_PAGES, timed_stage
 from doctor.lib.mojibake import fix_mojibake
+from doctor.lib.page_count import (
+    PdfStructureError,
+    count_pages,
+    count_pdf_pages,
+)
+from doctor.lib.preprocess import preprocess_tiff
 from doctor.lib.text_extraction import (
     extract_with_ocr,
     get_page_text,
     page_needs_ocr,
     remove_excess_whitespace,
 )
+from doctor.lib.text_layer import (
+    displayed_size,
+    find_pages_to_ocr,
+    merge_text_layer,
+    ocr_text_layer,
+)
 from doctor.lib.utils import (
     DoctorUnicodeDecodeError,
-    force_bytes,
     force_text,
     ocr_needed,
     smart_text,
 )
+from doctor.lib.waveform import waveform_peaks
 
-
-def strip_metadata_from_bytes(pdf_bytes):
-    """Convert PDF bytes into PDF and remove metadata from it
-
-    Stripping the metadata allows us to hash the PDFs
-
-    :param pdf_bytes: PDF as binary content
-    :return: PDF bytes with metadata removed.
-    """
-    pdf_merger = PdfMerger()
-    pdf_merger.append(io.BytesIO(pdf_bytes))
-    pdf_merger.add_metadata({"/CreationDate": "", "/ModDate": ""})
-    byte_writer = io.BytesIO()
-    pdf_merger.write(byte_writer)
-    return force_bytes(byte_writer.getvalue())
-
-
-def pdf_bytes_from_images(image_list: list[Image]):
-    """Make a pdf given an array of Image files
-
-    :param image_list: List of images
-    :type image_list: list
-    :return: PDF as bytes
-    """
-    with io.BytesIO() as output:
-        image_list[0].save(
-            output,
-            "PDF",
-            resolution=100.0,
-            save_all=True,
-            append_images=image_list[1:],
-        )
-        pdf_data = output.getvalue()
-
-    return pdf_data
+logger = logging.getLogger(__name__)
 
 
+@timed_stage("pdftotext")
 def make_pdftotext_process(path):
     """Make a subprocess to hand to higher-level code.
 
@@ -89,13 +97,17 @@ def make_pdftotext_process(path):
     return content.decode(), err, process.returncode
 
 
-def rasterize_pdf(path, destination):
+@timed_stage("gs_rasterize")
+def rasterize_pdf(path, destination, pages: list[int] | None = None):
     """Convert the PDF into a multipage Tiff file.
 
     This function uses ghostscript for processing and borrows heavily from:
 
         https://github.com/jbarlow83/OCRmyPDF/blob/636d1903b35fed6b07a01af53769fea81f388b82/ocrmypdf/ghostscript.py#L11
 
+    :param path: The PDF
+    :param destination: Where to write the Tiff
+    :param pages: The pages to rasterize, in order, or None for all of them
     """
     # gs docs, see: http://ghostscript.com/doc/7.07/Use.htm
     # gs devices, see: http://ghostscript.com/doc/current/Devices.htm
@@ -119,6 +131,8 @@ def rasterize_pdf(path, destination):
         destination,
         path,
     ]
+    if pages is not None:
+        gs.insert(-3, f"-sPageList={','.join(map(str, pages))}")
 
     p = subprocess.Popen(
         gs,
@@ -131,28 +145,209 @@ def rasterize_pdf(path, destination):
     return stdout, stderr, p.returncode
 
 
-def get_xray(path):
+def has_bad_redaction(redactions: dict[int, list]) -> bool:
+    """Check whether any redaction found so far survives the date filter
+
+    xray throws away all of a document's redactions if every one of them
+    is a date, so the first one that isn't a date settles the question.
+
+    :param redactions: Redactions by page, as found by xray
+    :return: Whether any of them isn't a date
+    """
+    return any(
+        not looks_like_a_date(redaction["text"])
+        for page_redactions in redactions.values()
+        for redaction in page_redactions
+    )
+
+
+def inspect_pages(
+    path: str,
+    first_page: int,
+    last_page: int,
+    stop_at_first: bool = False,
+    stop_path: str | None = None,
+) -> dict[int, list]:
+    """Find the bad redactions in a range of pages, like xray.inspect
+
+    The date filter isn't applied, since it needs the whole document.
+
+    :param path: A path to the PDF
+    :param first_page: The first page to inspect, starting from 1
+    :param last_page: The last page to inspect, inclusive
+    :param stop_at_first: Whether to stop after the first page with a
+    redaction that isn't a date
+    :param stop_path: A file that, once it exists, means the results are no
+    longer wanted, checked between pages
+    :return: The redactions by page number, up to wherever we stopped
+    """
+    bad_redactions = {}
+    with Document(path) as pdf:
+        for page_number in range(first_page, last_page + 1):
+            if stop_path and os.path.exists(stop_path):
+                break
+            redactions = get_bad_redactions(pdf[page_number - 1])
+            if not redactions:
+                continue
+            bad_redactions[page_number] = redactions
+            if stop_at_first and has_bad_redaction({page_number: redactions}):
+                break
+    return bad_redactions
+
+
+# Every xray request in a process shares these processes, so concurrent
+# checks of long documents queue for the same XRAY_WORKERS cores
+xray_executor = None
+
+
+def get_xray_executor() -> ProcessPoolExecutor:
+    """Get the processes that inspect shards of long documents
+
+    :return: The executor, started on first use
+    """
+    global xray_executor
+    if xray_executor is None:
+        xray_executor = ProcessPoolExecutor(settings.XRAY_WORKERS)
+    return xray_executor
+
+
+def inspect_shards(
+    path: str, shards: list[tuple[int, int]], stop_at_first: bool
+) -> dict[int, list]:
+    """Inspect shards of a document in parallel
+
+    When we stop early, shards that haven't started are cancelled, and
+    the ones that are running see a stop file and give up after the page
+    they're on, so they don't hold the shared processes any longer.
+
+    :param path: A path to the PDF
+    :param shards: The first and last page of each shard
+    :param stop_at_first: Whether to stop as soon as any shard finds a bad
+    redaction that isn't a date
+    :return: The redactions by page number
+    """
+    global xray_executor
+    executor = get_xray_executor()
+    with TemporaryDirectory() as directory:
+        stop_path = f"{directory}/stop"
+        futures = [
+            executor.submit(
+                inspect_pages, path, *shard, stop_at_first, stop_path
+            )
+            for shard in shards
+        ]
+        bad_redactions = {}
+        try:
+            for future in as_completed(futures):
+                shard_redactions = future.result()
+                bad_redactions.update(shard_redactions)
+                if stop_at_first and has_bad_redaction(shard_redactions):
+                    break
+        except BrokenExecutor:
+            # A worker died. Start new ones for the next request.
+            xray_executor = None
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+            open(stop_path, "w").close()
+            # Running shards stop after their current page. Wait for them
+            # so the stop file is still there when they look for it.
+            wait(futures)
+    return dict(sorted(bad_redactions.items()))
+
+
+def get_xray(
+    path: str,
+    first_page: int = 1,
+    last_page: int | None = None,
+    stop_at_first: bool = False,
+) -> dict:
     """Get bad redactions
 
-    :param path: A path to the file
+    Big ranges are split into shards of settings.XRAY_SHARD_PAGES pages
+    that are inspected in parallel, by up to settings.XRAY_WORKERS
+    processes shared by every request, and put back together in page
+    order.
 
+    :param path: A path to the file
+    :param first_page: The first page to inspect, starting from 1
+    :param last_page: The last page to inspect, or None for the last page
+    of the document
+    :param stop_at_first: Whether to stop as soon as there's any bad
+    redaction, for when you only need to know if there is one
     :return: dictionary of bounding boxes.
+    :raises BrokenExecutor: If a shard's process died
     """
     try:
-        bad_redactions = xray.inspect(path)
-        return bad_redactions
+        with Document(path) as pdf:
+            page_count = pdf.page_count
+        if first_page > page_count:
+            return {
+                "error": True,
+                "msg": f"first_page is past the last page, {page_count}",
+            }
+        last_page = min(last_page or page_count, page_count)
+        size = settings.XRAY_SHARD_PAGES
+        shards = [
+            (start, min(start + size - 1, last_page))
+            for start in range(first_page, last_page + 1, size)
+        ]
+        if len(shards) == 1 or settings.XRAY_WORKERS == 1:
+            bad_redactions = inspect_pages(
+                path, first_page, last_page, stop_at_first
+            )
+        else:
+            bad_redactions = inspect_shards(path, shards, stop_at_first)
+        return check_if_all_dates(bad_redactions)
+    except BrokenExecutor:
+        raise
     except (
         OSError,
         ValueError,
         TypeError,
         KeyError,
         AssertionError,
+        RuntimeError,
         PdfReadError,
     ):
+        logger.exception("Unable to check %s for bad redactions", path)
         return {"error": True, "msg": "Exception"}
-    except Exception:
-        return {"error": True, "msg": "Exception"}
-    # not reached
+
+
+def get_pdf_page_count(source: str | bytes) -> int:
+    """Count the pages of a PDF, quickly if it's well formed
+
+    :param source: The path of the PDF, or the PDF itself
+    :return: The number of pages, or 0 if the PDF can't be read
+    """
+    try:
+        if isinstance(source, bytes):
+            return count_pages(source)
+        return count_pdf_pages(source)
+    except (OSError, PdfStructureError):
+        # Damaged beyond what the quick count copes with. Let PyPDF2
+        # try to repair it.
+        pass
+    try:
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        reader = PdfReader(source)
+        return len(reader.pages)
+    except (
+        OSError,
+        ValueError,
+        TypeError,
+        KeyError,
+        AssertionError,
+        PdfReadError,
+    ):
+        # IOError: File doesn't exist. My bad.
+        # ValueError: Didn't get an int for the page count. Their bad.
+        # TypeError: NumberObject has no attribute '__getitem__'. Ugh.
+        # KeyError, AssertionError: assert xrefstream["/Type"] == "/XRef". WTF?
+        # PdfReadError: Something else. I have no words.
+        return 0
 
 
 def get_page_count(path, extension):
@@ -163,24 +358,7 @@ def get_page_count(path, extension):
     :return: The number of pages if possible, else return None
     """
     if extension == "pdf":
-        try:
-            reader = PdfReader(path)
-            return len(reader.pages)
-        except (
-            OSError,
-            ValueError,
-            TypeError,
-            KeyError,
-            AssertionError,
-            PdfReadError,
-        ):
-            # IOError: File doesn't exist. My bad.
-            # ValueError: Didn't get an int for the page count. Their bad.
-            # TypeError: NumberObject has no attribute '__getitem__'. Ugh.
-            # KeyError, AssertionError: assert xrefstream["/Type"] == "/XRef". WTF?
-            # PdfReadError: Something else. I have no words.
-            return 0
-
+        return get_pdf_page_count(path)
     elif extension == "wpd":
         # Best solution appears to be to dig into the binary format
         pass
@@ -245,12 +423,60 @@ def extract_by_ocr(path: str) -> (bool, str):
         if returncode != 0:
             return False, fail_msg
 
-        txt = convert_file_to_txt(tmp.name)
+        if settings.OCR_PREPROCESS:
+            with TemporaryDirectory() as directory:
+                txt = convert_file_to_txt(preprocess_tiff(tmp.name, directory))
+        else:
+            txt = convert_file_to_txt(tmp.name)
+        # tesseract ends every page of a multipage tiff with a form feed
+        OCR_PAGES.labels("pdf").inc(txt.count("\f"))
         txt = cleanup_ocr_text(txt)
 
     return True, txt
 
 
+@timed_stage("embed_text")
+def embed_text_layer(path: str, output_path: str) -> None:
+    """Make a scanned PDF searchable by laying OCRed text over its pages
+
+    Only the pages without a text layer are rasterized and OCRed, a few
+    at a time, and each text layer is sized to its own page.
+
+    :param path: The PDF
+    :param output_path: Where to write the searchable PDF
+    :return: None
+    """
+    pages = find_pages_to_ocr(path)
+    if not pages:
+        shutil.copyfile(path, output_path)
+        return
+
+    with open(path, "rb") as f, NamedTemporaryFile(suffix=".tiff") as tiff:
+        reader = PdfReader(f)
+        rasterize_pdf(path, tiff.name, pages)
+        sizes = [displayed_size(reader.pages[page - 1]) for page in pages]
+        with ThreadPoolExecutor(settings.OCR_WORKERS) as executor:
+            layers = dict(
+                zip(
+                    pages,
+                    executor.map(
+                        ocr_text_layer,
+                        [tiff.name] * len(pages),
+                        range(len(pages)),
+                        sizes,
+                    ),
+                )
+            )
+
+        output = PdfWriter()
+        for i, page in enumerate(reader.pages, start=1):
+            if i in layers:
+                merge_text_layer(page, layers[i])
+            output.add_page(page)
+        with open(output_path, "wb") as output_file:
+            output.write(output_file)
+
+
 def cleanup_ocr_text(txt: str) -> str:
     """Do some basic cleanup to make OCR text better.
 
@@ -268,6 +494,7 @@ def cleanup_ocr_text(txt: str) -> str:
     return txt
 
 
+@timed_stage("tesseract")
 def convert_file_to_txt(path: str) -> str:
     tesseract_command = [
         "tesseract",
@@ -284,26 +511,6 @@ def convert_file_to_txt(path: str) -> str:
     return p.communicate()[0].decode()
 
 
-def convert_tiff_to_pdf_bytes(single_tiff_image: Image) -> ByteString:
-    """Split long tiff into page sized image
-
-    :param single_tiff_image: One long tiff file
-    :return: PDF Bytes
-    """
-    width, height = single_tiff_image.size
-    image_list = []
-    i, page_width, page_height = 0, width, (1046 * (float(width) / 792))
-    while i < (height / page_height):
-        single_page = single_tiff_image.crop(
-            (0, (i * page_height), page_width, (i + 1) * page_height)
-        )
-        image_list.append(single_page)
-        i += 1
-
-    pdf_bytes = pdf_bytes_from_images(image_list)
-    return pdf_bytes
-
-
 def extract_from_doc(path):
     """Extract text from docs.
 
@@ -433,29 +640,16 @@ def extract_from_wpd(path: str) -> tuple[str, bytes, int]:
     return content, err, process.returncode
 
 
-def download_images(sorted_urls) -> list:
-    """Download images and convert to list of PIL images
+async def download_images(sorted_urls, directory: str) -> list[str]:
+    """Download images to scratch files
 
-    Once in an array of PIL.images we can easily convert this to a PDF.
+    Once on disk, img2pdf can easily convert them to a PDF.
 
     :param sorted_urls: List of sorted URLs for split financial disclosure
-    :return: image_list
+    :param directory: The directory to download the images to
+    :return: The paths of the images, in the same order as the URLs
     """
-
-    async def main(urls):
-        image_list = []
-        loop = asyncio.get_event_loop()
-        futures = [
-            loop.run_in_executor(None, requests.get, url) for url in urls
-        ]
-        for response in await asyncio.gather(*futures):
-            image_list.append(response.content)
-        return image_list
-
-    loop = asyncio.get_event_loop()
-    image_list = loop.run_until_complete(main(sorted_urls))
-
-    return image_list
+    return await download_files(sorted_urls, directory)
 
 
 # Audio
@@ -463,52 +657,33 @@ def download_images(sorted_urls) -> list:
 root = os.path.dirname(os.path.realpath(__file__))
 assets_dir = os.path.join(root, "assets")
 
-
-def convert_to_mp3(output_path: AnyStr, media: Any) -> None:
-    """Convert audio bytes to mp3 at temporary path
-
-    :param output_path: Audio file bytes sent to Doctor
-    :param media: Temporary filepath for output of audioprocess
-    :return:
-    """
-    av_command = [
-        "ffmpeg",
-        "-i",
-        "/dev/stdin",
+# Every MP3 gets the FLP logo, so read it once
+with open(os.path.join(assets_dir, "producer-300x300.png"), "rb") as f:
+    COVER_ART = f.read()
+
+
+# MP3s are 22.05 kHz, 48 kbps CBR. Uploads that already are aren't
+# encoded again, just retagged.
+MP3_SAMPLE_RATE = 22050
+MP3_BIT_RATE = 48000
+# To tell from the start of an upload, wait for its ID3 tag and this much
+# audio after it, unless the tag is bigger than MAX_ID3_BYTES
+MP3_CHECK_BYTES = 16 * 1024
+MAX_ID3_BYTES = 1024 * 1024
+
+# What ffmpeg makes of the audio for each output format. For ogg, that's a
+# single channel of 8 kbps opus tuned for voice (-application voip), without
+# the input's metadata.
+AUDIO_OUTPUT_OPTIONS = {
+    "mp3": [
         "-ar",
-        "22050",
+        str(MP3_SAMPLE_RATE),
         "-ab",
-        "48k",
+        str(MP3_BIT_RATE),
         "-f",
         "mp3",
-        output_path,
-    ]
-
-    ffmpeg_cmd = subprocess.Popen(
-        av_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=False
-    )
-    ffmpeg_cmd.communicate(media.read())
-    return output_path
-
-
-def convert_to_ogg(output_path: AnyStr, media: Any) -> None:
-    """Converts audio data to the ogg format (.ogg)
-
-    This function uses ffmpeg to convert the audio data provided in `media` to
-    the ogg format with the following specifications:
-
-    * Single audio channel (`-ac 1`)
-    * 8 kHz sampling rate (`-b:a 8k`)
-    * Optimized for voice over IP applications (`-application voip`)
-
-    :param output_path: Audio file bytes sent to Doctor
-    :param media: Temporary filepath for output of audioprocess
-    :return:
-    """
-    av_command = [
-        "ffmpeg",
-        "-i",
-        "/dev/stdin",
+    ],
+    "ogg": [
         "-vn",
         "-map_metadata",
         "-1",
@@ -522,14 +697,263 @@ def convert_to_ogg(output_path: AnyStr, media: Any) -> None:
         "voip",
         "-f",
         "ogg",
-        output_path,
-    ]
+    ],
+}
+
+
+# How each output format is decoded before it's split into segments, and
+# encoded after. Segments are mono 48kHz for Opus, like the whole file.
+PCM_OPTIONS = {
+    "mp3": ["-ar", str(MP3_SAMPLE_RATE)],
+    "ogg": ["-ac", "1", "-ar", "48000"],
+}
+SEGMENT_OPTIONS = {
+    # No bit reservoir, Xing header or ID3 tag, so the frames of one
+    # segment don't depend on another's and can be joined as they are
+    "mp3": [
+        *AUDIO_OUTPUT_OPTIONS["mp3"],
+        "-c:a",
+        "libmp3lame",
+        "-reservoir",
+        "0",
+        "-write_xing",
+        "0",
+        "-id3v2_version",
+        "0",
+    ],
+    "ogg": AUDIO_OUTPUT_OPTIONS["ogg"],
+}
+# Samples per frame: MPEG-2 layer III, and Opus's default 20ms packets
+SEGMENT_FRAMES = {"mp3": 576, "ogg": 960}
+
+# Waveform peaks are worked out from a mono 8 kHz copy of the decoded audio,
+# taken from the same decode as the conversion
+PEAKS_SAMPLE_RATE = 8000
+PEAKS_OPTIONS = [
+    "-vn",
+    "-ac",
+    "1",
+    "-ar",
+    str(PEAKS_SAMPLE_RATE),
+    "-c:a",
+    "pcm_s16le",
+    "-f",
+    "s16le",
+]
+
+
+def is_target_mp3(data: bytes | mmap.mmap) -> bool:
+    """Check whether audio is already an MP3 like the ones we make
+
+    :param data: The audio, or just its start
+    :return: Whether it's a CBR MP3 at MP3_SAMPLE_RATE and MP3_BIT_RATE
+    """
+    return is_cbr_mp3(data, MP3_SAMPLE_RATE, MP3_BIT_RATE)
 
-    ffmpeg_cmd = subprocess.Popen(
-        av_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=False
-    )
-    ffmpeg_cmd.communicate(media.read())
-    return output_path
+
+def spool_target_mp3(head: bytes) -> bool | None:
+    """Decide from the start of an upload whether it's an MP3 to copy
+
+    :param head: The start of the upload
+    :return: Whether it's already what we'd make, or None if the audio is
+    still behind an ID3 tag
+    """
+    if head[:3] == b"ID3" and len(head) >= 10:
+        audio_start = id3_size(head)
+        if len(head) < audio_start + MP3_CHECK_BYTES <= MAX_ID3_BYTES:
+            return None
+    return is_target_mp3(head)
+
+
+def spool_audio(head: bytes, upload_size: int, copy_mp3: bool) -> bool | None:
+    """Decide from the start of an upload whether to pipe it into ffmpeg
+
+    MP3s that are copied, and recordings long enough to be encoded in
+    segments, are uploaded first instead. The length is estimated from the
+    audio's headers and the size of the upload.
+
+    :param head: The start of the upload
+    :param upload_size: The size of the request body, which is at least
+    that of the file
+    :param copy_mp3: Whether an MP3 is wanted, so an MP3 that's already
+    what we'd make would be copied
+    :return: Whether to upload it first, or None if the audio is still
+    behind an ID3 tag
+    """
+    target_mp3 = spool_target_mp3(head)
+    if target_mp3 is None or (target_mp3 and copy_mp3):
+        return target_mp3
+    if not settings.AUDIO_SEGMENT_SECONDS or settings.AUDIO_WORKERS < 2:
+        return False
+    try:
+        duration = estimate_duration(head, upload_size)
+    except AudioProbeError:
+        return False
+    return duration > settings.AUDIO_SEGMENT_SECONDS
+
+
+def audio_command(
+    output_paths: dict[str, str],
+    input_path: str = "pipe:0",
+    pcm_tap: str | None = None,
+) -> list[str]:
+    """Make the ffmpeg command that converts audio
+
+    The input is decoded once and encoded to every output.
+
+    :param output_paths: Where to write each output format (mp3 or ogg).
+    Existing files are overwritten.
+    :param input_path: The audio to convert, stdin by default
+    :param pcm_tap: Where to also write the decoded audio as PEAKS_OPTIONS
+    says, for waveform peaks
+    :return: The command
+    """
+    command = ["ffmpeg", "-y", "-i", input_path]
+    for output_format, output_path in output_paths.items():
+        command += [*AUDIO_OUTPUT_OPTIONS[output_format], output_path]
+    if pcm_tap:
+        command += [*PEAKS_OPTIONS, pcm_tap]
+    return command
+
+
+def encode_segments(
+    pcm_path: str, output_format: str, output_path: str, workers: int
+) -> None:
+    """Encode decoded audio in segments at once, and join them
+
+    Each segment is encoded by its own ffmpeg, which reads its part of the
+    WAV and a little either side of it. The segments' frames are then
+    joined without encoding them again.
+
+    :param pcm_path: The audio, as a 16 bit WAV made with PCM_OPTIONS
+    :param output_format: mp3 or ogg
+    :param output_path: Where to write the audio
+    :param workers: How many segments to split it into
+    :return: None
+    :raises CalledProcessError: If ffmpeg fails on a segment
+    :raises SegmentError: If the segments don't join up
+    """
+    with (
+        open(pcm_path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+    ):
+        layout = wav_layout(data)
+    samples = layout.data_size // layout.block_align
+    frame = SEGMENT_FRAMES[output_format]
+    pre_roll = math.ceil(PRE_ROLL_SECONDS * layout.sample_rate / frame)
+    segments = plan_segments(samples, frame, workers, pre_roll)
+
+    def encode(segment: Segment, path: str) -> None:
+        start = layout.data_offset + segment.start * layout.block_align
+        end = layout.data_offset + segment.end * layout.block_align
+        command = [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "s16le",
+            "-ar",
+            str(layout.sample_rate),
+            "-ac",
+            str(layout.channels),
+            "-i",
+            f"subfile,,start,{start},end,{end},,:{pcm_path}",
+            *SEGMENT_OPTIONS[output_format],
+            path,
+        ]
+        subprocess.run(command, capture_output=True, check=True)
+
+    with TemporaryDirectory() as directory:
+        paths = [
+            f"{directory}/{i}.{output_format}" for i in range(len(segments))
+        ]
+        with ThreadPoolExecutor(len(segments)) as executor:
+            list(executor.map(encode, segments, paths))
+        if output_format == "ogg":
+            join_opus(paths, segments, output_path, samples)
+        else:
+            join_mp3(paths, segments, output_path)
+
+
+@timed_stage("ffmpeg")
+def convert_audio_file(
+    input_path: str,
+    output_paths: dict[str, str],
+    duration: float,
+    pcm_tap: str | None = None,
+) -> None:
+    """Convert an audio file, in segments at once if it's long
+
+    An MP3 that's already what we'd make is copied instead of being
+    encoded again. Recordings longer than AUDIO_SEGMENT_SECONDS are decoded
+    once for all the outputs, then each output is encoded in up to
+    AUDIO_WORKERS segments. Shorter ones get one ffmpeg.
+
+    :param input_path: The audio to convert
+    :param output_paths: Where to write each output format (mp3 or ogg)
+    :param duration: The recording's length in seconds, if known
+    :param pcm_tap: Where to also write the decoded audio for waveform
+    peaks, if they're wanted
+    :return: None
+    :raises CalledProcessError: If ffmpeg fails
+    :raises SegmentError: If the segments don't join up
+    """
+    if "mp3" in output_paths and os.path.getsize(input_path):
+        with (
+            open(input_path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+        ):
+            copy_mp3 = is_target_mp3(data)
+        if copy_mp3:
+            shutil.copyfile(input_path, output_paths["mp3"])
+            output_paths = {
+                f: path for f, path in output_paths.items() if f != "mp3"
+            }
+            if not output_paths and not pcm_tap:
+                return
+    if (
+        not settings.AUDIO_SEGMENT_SECONDS
+        or duration <= settings.AUDIO_SEGMENT_SECONDS
+        or settings.AUDIO_WORKERS < 2
+    ):
+        command = audio_command(output_paths, input_path, pcm_tap)
+        subprocess.run(command, capture_output=True, check=True)
+        return
+    with TemporaryDirectory() as directory:
+        pcm_paths = {f: f"{directory}/{f}.wav" for f in output_paths}
+        command = audio_command({}, input_path, pcm_tap)
+        for output_format, pcm_path in pcm_paths.items():
+            command += [
+                "-vn",
+                "-c:a",
+                "pcm_s16le",
+                *PCM_OPTIONS[output_format],
+                "-f",
+                "wav",
+                pcm_path,
+            ]
+        subprocess.run(command, capture_output=True, check=True)
+        for output_format, pcm_path in pcm_paths.items():
+            encode_segments(
+                pcm_path,
+                output_format,
+                output_paths[output_format],
+                settings.AUDIO_WORKERS,
+            )
+
+
+def save_waveform_peaks(
+    pcm_tap: str, samples_per_pixel: int, output_path: str
+) -> None:
+    """Work out waveform peaks from a PCM tap, and save them as JSON
+
+    :param pcm_tap: The audio, written by ffmpeg as PEAKS_OPTIONS says
+    :param samples_per_pixel: How many samples each min and max covers
+    :param output_path: Where to write the JSON
+    :return: None
+    """
+    peaks = waveform_peaks(pcm_tap, PEAKS_SAMPLE_RATE, samples_per_pixel)
+    with open(output_path, "w") as f:
+        json.dump(peaks, f, separators=(",", ":"))
 
 
 def set_mp3_meta_data(
@@ -542,14 +966,16 @@ def set_mp3_meta_data(
     :return: Eyed3 audio file object
     """
 
-    # Load the file, delete the old tags and create a new one.
+    # Load the file, delete the old tags and create a new one. MP3s that
+    # were copied rather than encoded may not have any.
     audio_file = eyed3.load(mp3_path)
-    # Undocumented API from eyed3.plugins.classic.ClassicPlugin#handleRemoves
-    id3.Tag.remove(
-        audio_file.tag.file_info.name,
-        id3.ID3_ANY_VERSION,
-        preserve_file_time=False,
-    )
+    if audio_file.tag is not None:
+        # Undocumented API from eyed3.plugins.classic.ClassicPlugin#handleRemoves
+        id3.Tag.remove(
+            audio_file.tag.file_info.name,
+            id3.ID3_ANY_VERSION,
+            preserve_file_time=False,
+        )
     audio_file.initTag()
     audio_file.tag.title = best_case_name(audio_data)
     date_argued = audio_data["date_argued"]
@@ -572,15 +998,19 @@ def set_mp3_meta_data(
     # Add images to the mp3. If it has a seal, use that for the Front Cover
     # and use the FLP logo for the Publisher Logo. If it lacks a seal, use the
     # Publisher logo for both the front cover and the Publisher logo.
-    url = seal(court=audio_data["court_pk"], size=ImageSizes.MEDIUM)
-
     flp_image_frames = [
         3,  # "Front Cover". Complete list at eyed3/id3/frames.py
         14,  # "Publisher logo".
     ]
 
-    if url:
-        seal_content = requests.get(url, timeout=30).content
+    try:
+        seal_content = get_seal(audio_data["court_pk"], ImageSizes.MEDIUM)
+    except requests.RequestException:
+        logger.exception(
+            "Couldn't download the seal for %s", audio_data["court_pk"]
+        )
+        seal_content = None
+    if seal_content:
         audio_file.tag.images.set(
             3,
             seal_content,
@@ -590,14 +1020,12 @@ def set_mp3_meta_data(
         flp_image_frames.remove(3)
 
     for frame in flp_image_frames:
-        cover_art_fp = os.path.join(assets_dir, "producer-300x300.png")
-        with open(cover_art_fp, "rb") as cover_art:
-            audio_file.tag.images.set(
-                frame,
-                cover_art.read(),
-                "image/png",
-                "Created for the public domain by Free Law Project",
-            )
+        audio_file.tag.images.set(
+            frame,
+            COVER_ART,
+            "image/png",
+            "Created for the public domain by Free Law Project",
+        )
 
     audio_file.tag.save()
     return audio_file
@@ -1,16 +1,101 @@
+import asyncio
 import glob
+import io
 import json
 import os
 import re
+import struct
+import sys
+import threading
+import time
 import unittest
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 from unittest.mock import patch
+from urllib.parse import urlencode
 from zipfile import ZipFile
 
+import django
 import eyed3
+import img2pdf
+import numpy as np
+import pikepdf
+import pypdfium2 as pdfium
 import requests
-
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.core.handlers.asgi import ASGIRequest
+from django.core.wsgi import get_wsgi_application
+from django.http import FileResponse
+from django.test import RequestFactory
+from PIL import Image, ImageDraw, ImageFont
+from prometheus_client import REGISTRY
+from PyPDF2 import PageObject, PdfReader, PdfWriter
+from seal_rookery.search import ImageSizes
+
+from doctor.forms import DocumentForm
+from doctor.lib.audio_info import (
+    AudioProbeError,
+    estimate_duration,
+    find_first_frame,
+    is_cbr_mp3,
+    parse_mpeg_frame,
+    probe_audio,
+)
+from doctor.lib.audio_segments import (
+    join_mp3,
+    join_opus,
+    mpeg_frames,
+    ogg_crc,
+    ogg_packets,
+    ogg_page,
+    plan_segments,
+)
+from doctor.lib.cache import ThumbnailCache, get_seal
+from doctor.lib.fetch import (
+    DownloadError,
+    DownloadTooLarge,
+    download_files,
+    download_to_file,
+    get_session,
+)
+from doctor.lib.identify import (
+    HEAD_BYTES,
+    id3_size,
+    identify,
+    trusted_extension,
+)
+from doctor.lib.metrics import timed_stage
+from doctor.lib.page_count import (
+    PdfStructureError,
+    count_pages,
+    count_pdf_pages,
+)
+from doctor.lib.pdf_writer import (
+    images_to_pdf_file,
+    iter_tiff_bands,
+    tiff_to_pdf_file,
+)
+from doctor.lib.preprocess import (
+    binarize,
+    deskew,
+    estimate_skew,
+    preprocess_tiff,
+    remove_speckles,
+)
+from doctor.lib.render import (
+    extract_page_image,
+    get_render_backend,
+    group_page_runs,
+    make_png_thumbnail_for_instance,
+    make_png_thumbnails,
+    make_sprite,
+    make_thumbnail_variants,
+)
 from doctor.lib.text_extraction import (
     adjust_caption_lines,
     cleanup_content,
@@ -18,9 +103,39 @@ from doctor.lib.text_extraction import (
     insert_whitespace,
     remove_excess_whitespace,
 )
-from doctor.lib.utils import make_buffer, make_file
+from doctor.lib.text_layer import (
+    OcrWord,
+    displayed_size,
+    find_pages_to_ocr,
+    make_page_with_text,
+    merge_text_layer,
+)
+from doctor.lib.uploads import PipeUploadHandler
+from doctor.lib.utils import (
+    file_response,
+    make_buffer,
+    make_file,
+    run_subprocess,
+    stream_zip,
+    strip_metadata,
+)
+from doctor.lib.waveform import waveform_peaks
+from doctor.tasks import (
+    COVER_ART,
+    audio_command,
+    convert_audio_file,
+    encode_segments,
+    get_pdf_page_count,
+    get_xray,
+    inspect_pages,
+    set_mp3_meta_data,
+    spool_audio,
+    spool_target_mp3,
+)
 
 asset_path = f"{Path.cwd()}/doctor/test_assets"
+# The unit tests below read settings, the integration tests don't care
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "doctor.settings")
 
 
 class HeartbeatTests(unittest.TestCase):
@@ -272,6 +387,21 @@ class ThumbnailTests(unittest.TestCase):
         )
         self.assertEqual(response.status_code, 400, msg="Wrong status code")
 
+    def test_thumbnail_etag(self):
+        """Do we answer a matching If-None-Match with a 304?"""
+        files = make_file(filename="image-pdf.pdf")
+        response = requests.post(
+            "http://doctor:5050/convert/pdf/thumbnail/", files=files
+        )
+        etag = response.headers["ETag"]
+        response = requests.post(
+            "http://doctor:5050/convert/pdf/thumbnail/",
+            files=files,
+            headers={"If-None-Match": etag},
+        )
+        self.assertEqual(response.status_code, 304, msg="Wrong status code")
+        self.assertEqual(response.content, b"")
+
     def test_thumbnail_range(self):
         """Can we generate a thumbnail for a range of pages?"""
         files = make_file(filename="vector-pdf.pdf")
@@ -297,6 +427,1245 @@ class ThumbnailTests(unittest.TestCase):
             listOfiles,
         )
 
+    def test_thumbnail_variants(self):
+        """Can we get several sizes and formats of a thumbnail at once?"""
+        files = make_file(filename="image-pdf.pdf")
+        data = {
+            "max_dimensions": json.dumps([100, 350]),
+            "formats": json.dumps(["png", "webp"]),
+        }
+        response = requests.post(
+            "http://doctor:5050/convert/pdf/thumbnail/",
+            files=files,
+            data=data,
+        )
+        with ZipFile(io.BytesIO(response.content)) as zf:
+            self.assertEqual(
+                sorted(zf.namelist()),
+                [
+                    "thumb-1-100.png",
+                    "thumb-1-100.webp",
+                    "thumb-1-350.png",
+                    "thumb-1-350.webp",
+                ],
+            )
+            image = Image.open(io.BytesIO(zf.read("thumb-1-100.webp")))
+            self.assertEqual(max(image.size), 100)
+
+    def test_thumbnail_range_variants(self):
+        """Do we get every size and format of every page in the range?"""
+        files = make_file(filename="vector-pdf.pdf")
+        data = {
+            "pages": json.dumps([1, 2]),
+            "max_dimensions": json.dumps([100, 350]),
+            "formats": json.dumps(["jpeg"]),
+        }
+        response = requests.post(
+            "http://doctor:5050/convert/pdf/thumbnails/",
+            files=files,
+            data=data,
+        )
+        with ZipFile(io.BytesIO(response.content)) as zf:
+            self.assertEqual(
+                sorted(zf.namelist()),
+                [
+                    "thumb-1-100.jpeg",
+                    "thumb-1-350.jpeg",
+                    "thumb-2-100.jpeg",
+                    "thumb-2-350.jpeg",
+                ],
+            )
+
+    def test_sprite(self):
+        """Can we tile a range of pages into one sprite?"""
+        files = make_file(filename="vector-pdf.pdf")
+        data = {"pages": json.dumps([1, 2, 3]), "columns": 2}
+        response = requests.post(
+            "http://doctor:5050/convert/pdf/sprite/",
+            files=files,
+            data=data,
+        )
+        with ZipFile(io.BytesIO(response.content)) as zf:
+            self.assertEqual(
+                sorted(zf.namelist()), ["sprite.jpeg", "sprite.json"]
+            )
+            offsets = json.loads(zf.read("sprite.json"))
+            sprite = Image.open(io.BytesIO(zf.read("sprite.jpeg")))
+        self.assertEqual(list(offsets["pages"]), ["1", "2", "3"])
+        self.assertEqual(sprite.size, (offsets["width"], offsets["height"]))
+
+
+class EmbeddedImageTests(unittest.TestCase):
+    """Can we thumbnail scans from their embedded image?"""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def make_scan(self, image_format: str, **kwargs) -> str:
+        image = Image.new("L", (1275, 1650), "white")
+        image.paste(0, (100, 100, 1175, 200))
+        buffer = io.BytesIO()
+        if image_format == "TIFF":
+            image = image.convert("1")
+        image.save(buffer, image_format, **kwargs)
+        path = f"{self.directory.name}/scan.pdf"
+        with open(path, "wb") as f:
+            f.write(img2pdf.convert(buffer.getvalue()))
+        return path
+
+    def test_jpeg_scan(self):
+        """Do we shrink a page that is one JPEG?"""
+        png = extract_page_image(self.make_scan("JPEG"), 1, 350)
+        image = Image.open(io.BytesIO(png))
+        self.assertEqual(image.format, "PNG")
+        self.assertEqual(image.size, (270, 350))
+
+    def test_ccitt_scan(self):
+        """Do we shrink a page that is one CCITT fax image?"""
+        path = self.make_scan("TIFF", compression="group4")
+        png = extract_page_image(path, 1, 350)
+        self.assertEqual(Image.open(io.BytesIO(png)).size, (270, 350))
+
+    def test_vector_page(self):
+        """Do pages with more than an image fall back to rendering?"""
+        path = f"{asset_path}/vector-pdf.pdf"
+        self.assertIsNone(extract_page_image(path, 1, 350))
+        self.assertIsNone(extract_page_image(path, 1000, 350))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serve the images the fetcher tests ask for"""
+
+    flaky_attempts = 0
+
+    def do_GET(self):
+        match self.path:
+            case "/image.png":
+                with open(f"{asset_path}/image-pdf-thumbnail.png", "rb") as f:
+                    body = f.read()
+            case "/big":
+                body = b"x" * 4096
+            case "/flaky":
+                # Fail the first time to make the client retry
+                StandInHandler.flaky_attempts += 1
+                if StandInHandler.flaky_attempts == 1:
+                    self.send_error(503)
+                    return
+                body = b"flaky"
+            case _:
+                self.send_error(404)
+                return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTests(unittest.TestCase):
+    """Can we download images safely from a local stand-in server?"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        limits = patch.multiple(
+            settings,
+            DOWNLOAD_CONCURRENCY=2,
+            DOWNLOAD_BACKOFF=0,
+            DOWNLOAD_MAX_BYTES=2048,
+            DOWNLOAD_MAX_TOTAL_BYTES=1024 * 1024,
+        )
+        limits.start()
+        self.addCleanup(limits.stop)
+        get_session.cache_clear()
+        self.addCleanup(get_session.cache_clear)
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_download_files_in_order(self):
+        """Do we get a file for every URL, in the order of the URLs?"""
+        urls = [f"{self.url}/image.png", f"{self.url}/flaky"] * 2
+        with patch.object(settings, "DOWNLOAD_MAX_BYTES", 1024 * 1024):
+            paths = asyncio.run(download_files(urls, self.directory.name))
+        self.assertEqual(len(paths), 4)
+        with open(paths[3], "rb") as f:
+            self.assertEqual(f.read(), b"flaky", msg="Didn't retry a 503")
+        self.assertEqual(Image.open(paths[2]).format, "PNG")
+
+    def test_download_too_large(self):
+        """Do we refuse files over the size limit?"""
+        with self.assertRaises(DownloadTooLarge):
+            download_to_file(f"{self.url}/big", f"{self.directory.name}/big")
+
+    def test_download_total_too_large(self):
+        """Do we refuse downloads that are too large taken together?"""
+        urls = [f"{self.url}/big"] * 3
+        with (
+            patch.multiple(
+                settings,
+                DOWNLOAD_MAX_BYTES=4096,
+                DOWNLOAD_MAX_TOTAL_BYTES=10000,
+            ),
+            self.assertRaises(DownloadTooLarge),
+        ):
+            asyncio.run(download_files(urls, self.directory.name))
+
+    def test_download_missing(self):
+        """Are HTTP errors reported as download errors?"""
+        with self.assertRaises(DownloadError):
+            download_to_file(
+                f"{self.url}/missing", f"{self.directory.name}/missing"
+            )
+
+
+class PdfImageWriterTests(unittest.TestCase):
+    """Can we assemble a clean PDF from image files a page at a time?"""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_images_to_pdf_file(self):
+        """Does each image become a page of the right size, with no metadata?"""
+        jpeg = f"{self.directory.name}/page.jpg"
+        Image.new("RGB", (850, 1100), "red").save(jpeg, dpi=(100, 100))
+        tiff = f"{self.directory.name}/page.tiff"
+        Image.new("1", (1700, 2200), 1).save(tiff, dpi=(200, 200))
+        png = f"{asset_path}/image-pdf-thumbnail.png"
+        output = f"{self.directory.name}/document.pdf"
+
+        images_to_pdf_file([jpeg, tiff, png], output)
+
+        reader = PdfReader(output)
+        self.assertEqual(len(reader.pages), 3)
+        self.assertIsNone(reader.metadata)
+        self.assertEqual(
+            [float(reader.pages[i].mediabox.width) for i in (0, 1)],
+            [612, 612],
+        )
+        image = reader.pages[0]["/Resources"]["/XObject"]["/Im0"]
+        with open(jpeg, "rb") as f:
+            self.assertEqual(
+                image._data, f.read(), msg="JPEG wasn't copied as is"
+            )
+
+    def make_tall_tiff(
+        self, mode: str, compression: str, rows_per_strip: int = 0
+    ) -> str:
+        """Make a TIFF two and a half pages tall, striped unless asked"""
+        image = Image.effect_noise((850, 2800), 64).convert(mode)
+        path = f"{self.directory.name}/tall-{compression}.tiff"
+        tiffinfo = {278: rows_per_strip} if rows_per_strip else {}
+        image.save(path, compression=compression, tiffinfo=tiffinfo)
+        return path
+
+    def test_tiff_bands_are_lossless(self):
+        """Do the bands of a TIFF put back together into the whole image?"""
+        for mode, compression in (("1", "group4"), ("L", "tiff_lzw")):
+            path = self.make_tall_tiff(mode, compression)
+            with Image.open(path) as whole, Image.open(path) as image:
+                whole.load()
+                for top, band in iter_tiff_bands(image):
+                    expected = whole.crop((0, top, 850, top + band.height))
+                    self.assertEqual(band.tobytes(), expected.tobytes())
+
+    def test_tiff_to_pdf_file(self):
+        """Is a tall TIFF split into letter pages, with a short last page?"""
+        path = self.make_tall_tiff("1", "group4")
+        output = f"{self.directory.name}/document.pdf"
+
+        tiff_to_pdf_file(path, output)
+
+        reader = PdfReader(output)
+        self.assertEqual(len(reader.pages), 3)
+        self.assertEqual(
+            [float(page.mediabox.width) for page in reader.pages],
+            [612, 612, 612],
+        )
+        self.assertEqual(float(reader.pages[0].mediabox.height), 808.56)
+        self.assertLess(float(reader.pages[2].mediabox.height), 808.56)
+        image = reader.pages[0]["/Resources"]["/XObject"]["/Im0"]
+        self.assertEqual(image["/Filter"], "/CCITTFaxDecode")
+
+    def test_single_strip_tiff(self):
+        """Is a TIFF that is one compressed strip decoded, as one band?"""
+        path = self.make_tall_tiff("1", "group4", rows_per_strip=2800)
+        with Image.open(path) as whole, Image.open(path) as image:
+            whole.load()
+            bands = list(iter_tiff_bands(image))
+        self.assertEqual(len(bands), 1)
+        self.assertEqual(bands[0][1].tobytes(), whole.tobytes())
+
+        output = f"{self.directory.name}/document.pdf"
+        tiff_to_pdf_file(path, output)
+        self.assertEqual(len(PdfReader(output).pages), 3)
+
+    def test_pixel_limit(self):
+        """Is the pixel limit held to each strip rather than the TIFF?"""
+        striped = self.make_tall_tiff("1", "group4")
+        single = self.make_tall_tiff("L", "tiff_lzw", rows_per_strip=2800)
+        output = f"{self.directory.name}/document.pdf"
+        with patch.object(Image, "MAX_IMAGE_PIXELS", 850 * 1200):
+            tiff_to_pdf_file(striped, output)
+            self.assertEqual(len(PdfReader(output).pages), 3)
+            with self.assertRaises(Image.DecompressionBombError):
+                tiff_to_pdf_file(single, output)
+
+
+class PreprocessTests(unittest.TestCase):
+    def make_page(self, skew: float) -> np.ndarray:
+        """Draw lines of 10pt text at 300 DPI, falling right by skew degrees"""
+        image = Image.new("L", (1275, 1650), 255)
+        draw = ImageDraw.Draw(image)
+        font = ImageFont.load_default(size=42)
+        for top in range(100, 1550, 70):
+            draw.text((100, top), "The quick brown fox " * 2, font=font)
+        return np.asarray(image.rotate(-skew, fillcolor=255))
+
+    def test_estimate_skew(self):
+        """Do we find the angle a page was scanned at, and level it?"""
+        for skew in (0, 1.4, -3):
+            binary = binarize(self.make_page(skew))
+            angle = estimate_skew(binary)
+            self.assertAlmostEqual(angle, skew, delta=0.2)
+            if angle:
+                self.assertEqual(estimate_skew(deskew(binary, angle)), 0)
+
+    def test_remove_speckles(self):
+        """Are specks whitened, and the text left alone?"""
+        page = binarize(self.make_page(0))
+        speckled = page.copy()
+        # Specks in the margin, where they don't touch any letters
+        speckled[20:1640:50, 1100:1270:50] = 0
+        speckled[1600:1640:5, 20:1270:5] = 0
+        cleaned = remove_speckles(speckled)
+        self.assertTrue(np.array_equal(cleaned, page))
+
+    def test_preprocess_tiff(self):
+        """Does each page of a TIFF become a black and white page?"""
+        pages = [Image.fromarray(self.make_page(2)) for _ in range(2)]
+        with TemporaryDirectory() as directory:
+            path = f"{directory}/scan.tiff"
+            pages[0].save(path, save_all=True, append_images=pages[1:])
+            with open(preprocess_tiff(path, directory)) as f:
+                page_paths = f.read().split()
+            self.assertEqual(len(page_paths), 2)
+            with Image.open(page_paths[0]) as page:
+                self.assertEqual(page.mode, "1")
+                self.assertEqual(page.size, (1275, 1650))
+
+
+class TextLayerTests(unittest.TestCase):
+    def test_find_pages_to_ocr(self):
+        """Do we skip pages that have text, and OCR scans?"""
+        # All but the last two pages, which are images, are born digital
+        self.assertEqual(
+            find_pages_to_ocr(f"{asset_path}/vector-pdf.pdf"), [29, 30]
+        )
+        path = f"{asset_path}/image-pdf.pdf"
+        self.assertEqual(
+            find_pages_to_ocr(path),
+            list(range(1, len(PdfReader(path).pages) + 1)),
+        )
+
+    def test_merge_text_layer_on_rotated_page(self):
+        """Does the text land where it's shown on a rotated page?"""
+        page = PageObject.create_blank_page(width=612, height=792)
+        page.rotate(90)
+        self.assertEqual(displayed_size(page), (792, 612))
+        # A word in the top left corner of a 100 DPI scan of the page
+        words = [OcrWord("Hello", 50, 50, 40)]
+        layer = make_page_with_text(words, (1100, 850), displayed_size(page))
+
+        merge_text_layer(page, layer)
+
+        writer = PdfWriter()
+        writer.add_page(page)
+        with io.BytesIO() as f:
+            writer.write(f)
+            pdf = pdfium.PdfDocument(f.getvalue())
+        textpage = pdf[0].get_textpage()
+        self.assertEqual(textpage.get_text_range().strip(), "Hello")
+        # The top left as displayed is the bottom left of the page itself
+        left, bottom, right, top = textpage.get_charbox(0)
+        self.assertLess(max(right, top), 100)
+        self.assertGreater(min(left, bottom), 0)
+
+
+class StripMetadataTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_strip_metadata(self):
+        """Are the Info dictionary and XMP gone, and nothing else?"""
+        path = f"{self.directory.name}/input.pdf"
+        with pikepdf.open(f"{asset_path}/vector-pdf.pdf") as pdf:
+            pdf.docinfo["/Title"] = "Secret"
+            pdf.docinfo["/CreationDate"] = "D:20200101000000Z"
+            with pdf.open_metadata() as xmp:
+                xmp["dc:title"] = "Secret"
+            pdf.save(path)
+        first = f"{self.directory.name}/first.pdf"
+        second = f"{self.directory.name}/second.pdf"
+
+        strip_metadata(path, first)
+        strip_metadata(path, second)
+
+        with pikepdf.open(first) as pdf:
+            self.assertNotIn("/Info", pdf.trailer)
+            self.assertNotIn("/Metadata", pdf.Root)
+            self.assertEqual(len(pdf.pages), len(PdfReader(path).pages))
+        with open(first, "rb") as f, open(second, "rb") as g:
+            self.assertEqual(
+                f.read(), g.read(), msg="Output isn't deterministic"
+            )
+
+
+class PageCountTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_matches_pypdf2(self):
+        """Does the quick count agree with PyPDF2 on every test PDF?"""
+        for path in glob.glob(f"{asset_path}/**/*.pdf", recursive=True):
+            try:
+                expected = len(PdfReader(path).pages)
+            except Exception:
+                continue
+            with self.subTest(path=path):
+                self.assertEqual(count_pdf_pages(path), expected)
+
+    def test_object_streams_and_updates(self):
+        """Can we follow xref streams, object streams and /Prev?"""
+        path = f"{self.directory.name}/streams.pdf"
+        with pikepdf.open(f"{asset_path}/vector-pdf.pdf") as pdf:
+            pdf.save(
+                path, object_stream_mode=pikepdf.ObjectStreamMode.generate
+            )
+        with pikepdf.open(path, allow_overwriting_input=True) as pdf:
+            del pdf.pages[-5:]
+            pdf.save(path)
+        self.assertEqual(count_pdf_pages(path), 25)
+        with open(path, "rb") as f:
+            self.assertEqual(count_pages(f.read()), 25)
+
+    def test_uncompressed_streams(self):
+        """Can we read xref and object streams that have no filter?"""
+        path = f"{self.directory.name}/uncompressed.pdf"
+        with pikepdf.open(f"{asset_path}/vector-pdf.pdf") as pdf:
+            pdf.save(
+                path,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                compress_streams=False,
+            )
+        with open(path, "rb") as f:
+            content = f.read()
+        self.assertNotIn(b"/Filter", content[content.rindex(b"/XRef") :])
+        self.assertEqual(count_pages(content), 30)
+
+    def test_broken_xref(self):
+        """Do we find the page tree when startxref points nowhere?"""
+        path = f"{self.directory.name}/broken.pdf"
+        with open(f"{asset_path}/image-pdf.pdf", "rb") as f:
+            content = f.read()
+        content = re.sub(rb"startxref\s+\d+", b"startxref\n1", content)
+        with open(path, "wb") as f:
+            f.write(content)
+        self.assertEqual(count_pdf_pages(path), 2)
+
+    def test_scan_is_capped(self):
+        """Is a big file with a broken xref left to PyPDF2, not scanned?"""
+        path = f"{self.directory.name}/broken.pdf"
+        with open(f"{asset_path}/image-pdf.pdf", "rb") as f:
+            content = f.read()
+        content = re.sub(rb"startxref\s+\d+", b"startxref\n1", content)
+        with open(path, "wb") as f:
+            f.write(content)
+        with patch("doctor.lib.page_count.SCAN_BYTES", len(content) - 1):
+            with self.assertRaises(PdfStructureError):
+                count_pdf_pages(path)
+            self.assertEqual(get_pdf_page_count(path), 2)
+
+    def test_not_a_pdf(self):
+        with self.assertRaises(PdfStructureError):
+            count_pdf_pages(f"{asset_path}/empty.pdf")
+        with self.assertRaises(PdfStructureError):
+            count_pages(b"Not a PDF")
+
+
+class IdentifyTests(unittest.TestCase):
+    def test_identify_pdf(self):
+        """Do we get the version and page count along with the type?"""
+        data = Path(asset_path, "vector-pdf.pdf").read_bytes()
+        result = identify(data)
+        self.assertEqual(result["mimetype"], "application/pdf")
+        self.assertEqual(result["extension"], ".pdf")
+        self.assertEqual(result["pdf_version"], "1.6")
+        self.assertEqual(result["page_count"], 30)
+        self.assertFalse(result["encrypted"])
+
+    def test_encrypted_pdf(self):
+        buffer = io.BytesIO()
+        with pikepdf.open(f"{asset_path}/image-pdf.pdf") as pdf:
+            pdf.save(buffer, encryption=pikepdf.Encryption(owner="secret"))
+        result = identify(buffer.getvalue())
+        self.assertTrue(result["encrypted"])
+        self.assertEqual(result["page_count"], 2)
+
+    def test_big_id3_tag(self):
+        """Do we find the audio after an ID3 tag bigger than the head?"""
+        data = Path(asset_path, "1_with_metadata.mp3").read_bytes()
+        self.assertGreater(id3_size(data), HEAD_BYTES)
+        self.assertEqual(identify(data)["extension"], ".mp3")
+
+    def test_obj_extension(self):
+        """Is a file that libmagic calls an .obj told apart by its content?"""
+        self.assertEqual(trusted_extension("model/obj", b"%PDF-1.4"), ".pdf")
+        self.assertEqual(trusted_extension("model/obj", b"\xffWPC"), ".wpd")
+
+
+class AudioInfoTests(unittest.TestCase):
+    def test_mp3_with_vbr_header(self):
+        """Is the frame count in LAME's Info header used?"""
+        data = Path(asset_path, "1.mp3").read_bytes()
+        info = probe_audio(data)
+        self.assertEqual(info.format, "mp3")
+        self.assertAlmostEqual(info.duration, 60.11, places=2)
+        self.assertEqual((info.sample_rate, info.channels), (22050, 2))
+
+    def test_cbr_mp3(self):
+        """Without a VBR header, is a constant bitrate used?"""
+        data = Path(asset_path, "1.mp3").read_bytes()
+        offset = find_first_frame(data, 0)
+        # Drop the frame holding the Info header
+        data = data[offset + parse_mpeg_frame(data, offset).length :]
+        info = probe_audio(data)
+        self.assertAlmostEqual(info.duration, 60.11, places=2)
+        self.assertEqual(info.bit_rate, 48000)
+
+    def test_vbr_mp3_without_header(self):
+        """Are the frames counted when the bitrate varies?"""
+        data = Path(asset_path, "1.mp3").read_bytes()
+        # The Info frame is 56kbps, the rest 48kbps
+        data = data.replace(b"Info", b"\0\0\0\0", 1)
+        info = probe_audio(data)
+        self.assertAlmostEqual(info.duration, 60.13, places=2)
+
+    def test_wma(self):
+        data = Path(asset_path, "1.wma").read_bytes()
+        info = probe_audio(data)
+        self.assertEqual(info.format, "wma")
+        self.assertAlmostEqual(info.duration, 59.63, places=2)
+        self.assertEqual((info.sample_rate, info.channels), (44100, 2))
+
+    def test_wav(self):
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(8000)
+            f.writeframes(bytes(8000 * 2 * 3))
+        info = probe_audio(buffer.getvalue())
+        self.assertEqual(info, ("wav", 3.0, 8000, 1, 128000))
+
+    def test_ogg_opus(self):
+        """Is the duration taken from the last page, less the pre-skip?"""
+
+        def page(granule: int, sequence: int, payload: bytes) -> bytes:
+            header = struct.pack(
+                "<4sBBqIIIB", b"OggS", 0, 0, granule, 1, sequence, 0, 1
+            )
+            return header + bytes([len(payload)]) + payload
+
+        head = struct.pack("<8sBBHIhB", b"OpusHead", 1, 2, 312, 48000, 0, 0)
+        data = page(0, 0, head) + page(48000 * 5 + 312, 1, bytes(100))
+        info = probe_audio(data)
+        self.assertEqual(info.format, "ogg")
+        self.assertEqual(info.duration, 5.0)
+        self.assertEqual(info.channels, 2)
+
+    def test_malformed_headers(self):
+        """Are headers that would divide by zero a probe error?"""
+        wav = struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF",
+            36,
+            b"WAVE",
+            b"fmt ",
+            16,
+            1,
+            1,
+            8000,
+            0,
+            2,
+            16,
+            b"data",
+            0,
+        )
+        vorbis = struct.pack(
+            "<4sBBqIIIBB7sIBI",
+            b"OggS",
+            0,
+            2,
+            0,
+            1,
+            0,
+            0,
+            1,
+            30,
+            b"\x01vorbis",
+            0,
+            1,
+            0,
+        )
+        for data in (wav, vorbis):
+            with self.assertRaises(AudioProbeError):
+                probe_audio(data)
+            with self.assertRaises(AudioProbeError):
+                estimate_duration(data, 10**6)
+        with patch.multiple(
+            settings, AUDIO_SEGMENT_SECONDS=1800, AUDIO_WORKERS=4
+        ):
+            self.assertFalse(spool_audio(wav, 10**6, True))
+
+    def test_not_audio(self):
+        data = Path(asset_path, "vector-pdf.pdf").read_bytes()
+        with self.assertRaises(AudioProbeError):
+            probe_audio(data)
+
+    def test_is_cbr_mp3(self):
+        """Is a CBR MP3 recognised from its first frames?"""
+        data = Path(asset_path, "1.mp3").read_bytes()
+        self.assertTrue(is_cbr_mp3(data[:65536], 22050, 48000))
+        self.assertFalse(is_cbr_mp3(data, 44100, 48000))
+        # A Xing header says the bitrate varies
+        vbr = data.replace(b"Info", b"Xing", 1)
+        self.assertFalse(is_cbr_mp3(vbr, 22050, 48000))
+        wma = Path(asset_path, "1.wma").read_bytes()
+        self.assertFalse(is_cbr_mp3(wma, 22050, 48000))
+
+    def test_estimate_duration(self):
+        """Can we tell how long an upload is from its first chunk?"""
+        data = Path(asset_path, "1.mp3").read_bytes()
+        # From the Info header, whatever the size
+        self.assertAlmostEqual(
+            estimate_duration(data[:65536], len(data) * 10), 60.11, places=2
+        )
+        # From the bitrate of the first frames and the size
+        offset = find_first_frame(data, 0)
+        cbr = data[offset + parse_mpeg_frame(data, offset).length :]
+        self.assertAlmostEqual(
+            estimate_duration(cbr[:65536], len(cbr)), 60.11, places=2
+        )
+        self.assertAlmostEqual(
+            estimate_duration(cbr[:65536], len(cbr) * 2), 120.22, places=2
+        )
+
+
+class AudioSegmentTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name: str, data: bytes) -> str:
+        path = f"{self.directory.name}/{name}"
+        Path(path).write_bytes(data)
+        return path
+
+    def test_plan_segments(self):
+        """Do the segments cover the recording, joining on frames?"""
+        samples = 576 * 1000 + 100
+        segments = plan_segments(samples, 576, 4, 3)
+        self.assertEqual(len(segments), 4)
+        self.assertEqual(segments[0].keep_from, 0)
+        self.assertIsNone(segments[-1].keep_to)
+        self.assertEqual(segments[-1].end, samples)
+        for before, after in zip(segments, segments[1:]):
+            self.assertEqual(before.keep_to, after.keep_from)
+            self.assertEqual(after.keep_from % 576, 0)
+            self.assertEqual(after.start, after.keep_from - 3 * 576)
+            self.assertEqual(before.end, before.keep_to + 3 * 576)
+
+    def test_join_mp3(self):
+        """Are overlapping segments joined back into the same frames?"""
+        data = Path(asset_path, "1.mp3").read_bytes()
+        frames = [frame for _, _, frame in mpeg_frames(data)][1:]
+        segments = plan_segments(len(frames) * 576, 576, 3, 2)
+        paths = [
+            self.write(
+                f"{i}.mp3",
+                b"".join(
+                    frames[segment.start // 576 : segment.end // 576 + 2]
+                ),
+            )
+            for i, segment in enumerate(segments)
+        ]
+        output = f"{self.directory.name}/joined.mp3"
+        join_mp3(paths, segments, output)
+        self.assertEqual(Path(output).read_bytes(), b"".join(frames))
+
+    def test_join_opus(self):
+        """Are the packets joined with new granules, and the padding cut?"""
+        pre_skip = 312
+        samples = 960 * 100 - 500
+        # 20ms SILK packets, each holding its number
+        packets = [b"\x08" + struct.pack("<I", i) for i in range(100)]
+        head = struct.pack(
+            "<8sBBHIhB", b"OpusHead", 1, 1, pre_skip, 48000, 0, 0
+        )
+        segments = plan_segments(samples, 960, 3, 2)
+        paths = []
+        for i, segment in enumerate(segments):
+            audio = packets[segment.start // 960 : segment.end // 960 + 1]
+            pages = [
+                ogg_page(2, 0, 7, 0, [head]),
+                ogg_page(0, 0, 7, 1, [b"T"]),
+            ]
+            pages += [ogg_page(0, 0, 7, 2, audio)]
+            paths.append(self.write(f"{i}.ogg", b"".join(pages)))
+        output = f"{self.directory.name}/joined.ogg"
+        join_opus(paths, segments, output, samples)
+
+        data = Path(output).read_bytes()
+        self.assertEqual(list(ogg_packets(data)), [head, b"T", *packets])
+        info = probe_audio(data)
+        self.assertEqual(info.duration, samples / 48000)
+        offset = 0
+        while offset < len(data):
+            page_size = (
+                27
+                + data[offset + 26]
+                + sum(data[offset + 27 : offset + 27 + data[offset + 26]])
+            )
+            page = bytearray(data[offset : offset + page_size])
+            crc = struct.unpack("<I", page[22:26])[0]
+            page[22:26] = bytes(4)
+            self.assertEqual(crc, ogg_crc(bytes(page)))
+            offset += page_size
+
+    def test_ogg_crc(self):
+        self.assertEqual(ogg_crc(b"123456789"), 0x89A1897F)
+
+    def test_encode_segments(self):
+        """Does ffmpeg's audio come back whole after being split up?"""
+        for output_format, rate, channels in (
+            ("mp3", 22050, 2),
+            ("ogg", 48000, 1),
+        ):
+            with self.subTest(output_format):
+                pcm = f"{self.directory.name}/{output_format}.wav"
+                t = np.arange(rate * 10) / rate
+                tone = (np.sin(2 * np.pi * 440 * t) * 8000).astype("<i2")
+                with wave.open(pcm, "wb") as f:
+                    f.setnchannels(channels)
+                    f.setsampwidth(2)
+                    f.setframerate(rate)
+                    f.writeframes(np.repeat(tone, channels).tobytes())
+                output = f"{self.directory.name}/out.{output_format}"
+                encode_segments(pcm, output_format, output, 4)
+                info = probe_audio(Path(output).read_bytes())
+                self.assertAlmostEqual(info.duration, 10, delta=0.2)
+
+
+class WaveformTests(unittest.TestCase):
+    def test_waveform_peaks(self):
+        """Is each pixel's min and max kept, including a short last one?"""
+        samples = [0, 1000, -3000, 256, 32767, -32768, 5]
+        with NamedTemporaryFile() as pcm:
+            pcm.write(struct.pack(f"<{len(samples)}h", *samples))
+            pcm.flush()
+            peaks = waveform_peaks(pcm.name, 8000, 3)
+        self.assertEqual(peaks["length"], 3)
+        self.assertEqual(peaks["data"], [-12, 3, -128, 127, 0, 0])
+
+    def test_no_audio(self):
+        with NamedTemporaryFile() as pcm:
+            peaks = waveform_peaks(pcm.name, 8000, 80)
+        self.assertEqual((peaks["length"], peaks["data"]), (0, []))
+
+
+class PipeUploadHandlerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.output = f"{self.directory.name}/output"
+
+    def make_handler(self, script: str) -> PipeUploadHandler:
+        command = [sys.executable, "-c", script, self.output]
+        return PipeUploadHandler(None, command)
+
+    def output_size(self) -> int:
+        try:
+            return os.path.getsize(self.output)
+        except FileNotFoundError:
+            return 0
+
+    def test_pipes_while_uploading(self):
+        """Does the command get each chunk before the next one arrives?"""
+        handler = self.make_handler(
+            "import shutil, sys\n"
+            "with open(sys.argv[1], 'wb', buffering=0) as f:\n"
+            "    shutil.copyfileobj(sys.stdin.buffer, f, 1024)"
+        )
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file("file", "1.mp3", "audio/mpeg", None)
+        chunks = [b"a" * 65536, b"b" * 65536]
+        for i, chunk in enumerate(chunks):
+            self.assertIsNone(handler.receive_data_chunk(chunk, 0))
+            # Wait for the command to write what it's been sent so far
+            for _ in range(500):
+                if self.output_size() == 65536 * (i + 1):
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self.output_size(), 65536 * (i + 1))
+        upload = handler.file_complete(131072)
+        self.assertEqual((upload.name, upload.size), ("1.mp3", 131072))
+        self.assertEqual(upload.returncode, 0)
+        self.assertEqual(Path(self.output).read_bytes(), b"".join(chunks))
+
+    def test_stage_excludes_upload(self):
+        """Is only the command's finish timed, not the wait for the client?"""
+        handler = PipeUploadHandler(
+            None,
+            [sys.executable, "-c", "import sys; sys.stdin.read()"],
+            stage="test_pipe",
+        )
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file("file", "1.mp3", "audio/mpeg", None)
+        handler.receive_data_chunk(b"a", 0)
+        # A slow client
+        time.sleep(0.5)
+        handler.file_complete(1)
+        labels = {"stage": "test_pipe"}
+        sample = "doctor_stage_duration_seconds"
+        self.assertEqual(
+            REGISTRY.get_sample_value(f"{sample}_count", labels), 1
+        )
+        self.assertLess(
+            REGISTRY.get_sample_value(f"{sample}_sum", labels), 0.5
+        )
+
+    def test_failed_command(self):
+        """Is the upload still read when the command gives up early?"""
+        handler = self.make_handler(
+            "import sys; sys.stderr.write('Invalid data'); sys.exit(1)"
+        )
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file("file", "1.mp3", "audio/mpeg", None)
+        handler.process.wait()
+        for _ in range(4):
+            handler.receive_data_chunk(b"x" * 65536, 0)
+        upload = handler.file_complete(262144)
+        self.assertEqual(upload.returncode, 1)
+        self.assertEqual(upload.stderr, "Invalid data")
+
+    def test_spool_if(self):
+        """Is the file held back until spool_if decides, then passed on?"""
+        decisions = iter([None, True])
+        handler = PipeUploadHandler(
+            None, ["false"], spool_if=lambda head: next(decisions)
+        )
+        handler.new_file("file", "1.mp3", "audio/mpeg", None)
+        self.assertIsNone(handler.receive_data_chunk(b"a", 0))
+        self.assertEqual(handler.receive_data_chunk(b"b", 1), b"ab")
+        self.assertEqual(handler.receive_data_chunk(b"c", 2), b"c")
+        self.assertIsNone(handler.file_complete(3))
+        self.assertIsNone(handler.process)
+
+    def test_spool_if_declines(self):
+        """Is the held back start piped when spool_if says not to spool?"""
+        handler = PipeUploadHandler(
+            None,
+            [
+                sys.executable,
+                "-c",
+                "import shutil, sys\n"
+                "shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1], 'wb'))",
+                self.output,
+            ],
+            spool_if=lambda head: None if len(head) < 2 else False,
+        )
+        handler.new_file("file", "1.mp3", "audio/mpeg", None)
+        for i, chunk in enumerate([b"a", b"b", b"c"]):
+            self.assertIsNone(handler.receive_data_chunk(chunk, i))
+        upload = handler.file_complete(3)
+        self.assertEqual(upload.returncode, 0)
+        self.assertEqual(Path(self.output).read_bytes(), b"abc")
+
+    def test_other_fields(self):
+        """Are other fields left to the next handler?"""
+        handler = self.make_handler("")
+        handler.new_file("other", "a.txt", "text/plain", None)
+        self.assertEqual(handler.receive_data_chunk(b"data", 0), b"data")
+        self.assertIsNone(handler.file_complete(4))
+        self.assertIsNone(handler.process)
+
+
+class SealCacheTests(unittest.TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_patch = patch.multiple(
+            settings, SEAL_CACHE_DIR=directory.name
+        )
+        settings_patch.start()
+        self.addCleanup(settings_patch.stop)
+        get_seal.cache_clear()
+        self.addCleanup(get_seal.cache_clear)
+        get_patch = patch("doctor.lib.cache.requests.get")
+        self.get = get_patch.start()
+        self.addCleanup(get_patch.stop)
+        self.get.return_value.content = b"seal"
+
+    def test_downloads_once(self):
+        """Is a seal downloaded once, then read from memory or disk?"""
+        self.assertEqual(get_seal("ca9"), b"seal")
+        self.assertEqual(get_seal("ca9"), b"seal")
+        self.assertEqual(self.get.call_count, 1)
+        # A new process finds it on disk
+        get_seal.cache_clear()
+        self.assertEqual(get_seal("ca9"), b"seal")
+        self.assertEqual(self.get.call_count, 1)
+        # Sizes are cached separately
+        self.assertEqual(get_seal("ca9", ImageSizes.SMALL), b"seal")
+        self.assertEqual(self.get.call_count, 2)
+
+    def test_no_seal(self):
+        self.assertIsNone(get_seal("not-a-court"))
+        self.get.assert_not_called()
+
+    def test_failures_not_cached(self):
+        self.get.return_value.raise_for_status.side_effect = (
+            requests.HTTPError()
+        )
+        with self.assertRaises(requests.HTTPError):
+            get_seal("ca9")
+        self.get.return_value.raise_for_status.side_effect = None
+        self.assertEqual(get_seal("ca9"), b"seal")
+
+    def test_mp3_tagging(self):
+        """Does tagging use the cached seal and fall back to the logo?"""
+        audio_data = {
+            "court_full_name": "Testing Supreme Court",
+            "court_short_name": "Testing Supreme Court",
+            "court_pk": "ca9",
+            "court_url": "http://www.example.com/",
+            "docket_number": "docket number 1 005",
+            "date_argued": "2020-01-01",
+            "date_argued_year": "2020",
+            "case_name": "SEC v. Frank J. Custable, Jr.",
+            "case_name_full": "case name full",
+            "case_name_short": "short",
+            "download_url": "http://www.example.com/1.mp3",
+        }
+        with NamedTemporaryFile(suffix=".mp3") as mp3:
+            mp3.write(Path(asset_path, "1.mp3").read_bytes())
+            mp3.flush()
+            audio_file = set_mp3_meta_data(audio_data, mp3.name)
+            images = {
+                i.picture_type: i.image_data for i in audio_file.tag.images
+            }
+            self.assertEqual(images[3], b"seal")
+            self.assertEqual(images[14], COVER_ART)
+
+            self.get.side_effect = requests.ConnectionError()
+            audio_data["court_pk"] = "ca1"
+            with self.assertLogs("doctor.tasks", "ERROR"):
+                audio_file = set_mp3_meta_data(audio_data, mp3.name)
+            self.assertEqual(
+                {i.image_data for i in audio_file.tag.images}, {COVER_ART}
+            )
+
+
+class SpriteTests(unittest.TestCase):
+    def test_make_sprite(self):
+        """Are pages tiled in order, and their offsets reported?"""
+        with TemporaryDirectory() as directory:
+            thumbnails = {}
+            for page, size in ((3, (40, 50)), (1, (40, 50)), (2, (50, 40))):
+                path = f"{directory}/thumb-{page}.png"
+                Image.new("RGB", size, "black").save(path)
+                thumbnails[page] = path
+            sprite, offsets = make_sprite(thumbnails, 2, "png")
+
+        image = Image.open(io.BytesIO(sprite))
+        self.assertEqual(image.size, (100, 100))
+        self.assertEqual((offsets["width"], offsets["height"]), (100, 100))
+        self.assertEqual(
+            offsets["pages"][2], {"x": 50, "y": 0, "width": 50, "height": 40}
+        )
+        self.assertEqual(offsets["pages"][3]["y"], 50)
+
+    def test_sprite_too_large(self):
+        """Do we refuse to make a sprite the format can't encode?"""
+        with TemporaryDirectory() as directory:
+            thumbnails = {}
+            for page in (1, 2):
+                path = f"{directory}/thumb-{page}.png"
+                Image.new("RGB", (10000, 10), "black").save(path)
+                thumbnails[page] = path
+            with self.assertRaises(ValueError):
+                make_sprite(thumbnails, 2, "webp")
+
+    def test_unreadable_pdf(self):
+        """Is a PDF we can't count the pages of refused?"""
+        request = RequestFactory().post(
+            "/convert/pdf/sprite/",
+            {"file": SimpleUploadedFile("a.pdf", b"not a pdf")},
+            HTTP_HOST="localhost",
+        )
+        statuses = []
+        application = get_wsgi_application()
+        body = application(
+            request.environ, lambda status, headers: statuses.append(status)
+        )
+        content = b"".join(body)
+        body.close()
+        self.assertEqual(statuses, ["400 Bad Request"])
+        self.assertEqual(content, b"Unable to read the PDF")
+
+
+class ThumbnailCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_get_and_set(self):
+        """Can we read back a cached thumbnail?"""
+        cache = ThumbnailCache(self.directory.name, 1000)
+        key = ThumbnailCache.make_key("abc", 1, 350, "pdftoppm", True)
+        self.assertIsNone(cache.get(key))
+        cache.set(key, b"png")
+        self.assertEqual(cache.get(key), b"png")
+
+    def test_key_depends_on_dimension(self):
+        """Do different sizes of the same page get different keys?"""
+        self.assertNotEqual(
+            ThumbnailCache.make_key("abc", 1, 350, "pdftoppm", True),
+            ThumbnailCache.make_key("abc", 1, 700, "pdftoppm", True),
+        )
+
+    def test_key_depends_on_backend(self):
+        """Do thumbnails from different backends get different keys?"""
+        self.assertNotEqual(
+            ThumbnailCache.make_key("abc", 1, 350, "pdftoppm", True),
+            ThumbnailCache.make_key("abc", 1, 350, "pdfium", True),
+        )
+
+    def test_key_depends_on_image_fast_path(self):
+        """Are scans thumbnailed from their image kept apart from renders?"""
+        self.assertNotEqual(
+            ThumbnailCache.make_key("abc", 1, 350, "pdftoppm", True),
+            ThumbnailCache.make_key("abc", 1, 350, "pdftoppm", False),
+        )
+
+    def test_directory_measured_now_and_then(self):
+        """Is the directory only measured after a sixteenth of it's written?"""
+        cache = ThumbnailCache(self.directory.name, 16000)
+        with patch("doctor.lib.cache.os.scandir", wraps=os.scandir) as scan:
+            for page in range(1, 13):
+                key = ThumbnailCache.make_key(
+                    "abc", page, 350, "pdftoppm", True
+                )
+                cache.set(key, b"x" * 100)
+        # Once on the first write, and again once 1000 more bytes are in
+        self.assertEqual(scan.call_count, 2)
+
+    def test_least_recently_used_is_evicted(self):
+        """Do we evict the entry that was read least recently?"""
+        cache = ThumbnailCache(self.directory.name, 250)
+        keys = [
+            ThumbnailCache.make_key("abc", page, 350, "pdftoppm", True)
+            for page in (1, 2)
+        ]
+        for i, key in enumerate(keys):
+            cache.set(key, b"x" * 100)
+            path = os.path.join(self.directory.name, f"{key}.png")
+            os.utime(path, (i, i))
+        # Reading the first entry makes the second one the oldest
+        cache.get(keys[0])
+        cache.set(
+            ThumbnailCache.make_key("abc", 3, 350, "pdftoppm", True),
+            b"x" * 100,
+        )
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+
+
+class PageRunTests(unittest.TestCase):
+    def test_contiguous_pages_are_grouped(self):
+        """Do contiguous pages collapse into one run?"""
+        self.assertEqual(
+            group_page_runs([5, 1, 2, 3, 7, 6, 10], 100),
+            [(1, 3), (5, 7), (10, 10)],
+        )
+
+    def test_runs_are_capped(self):
+        """Are long runs split so they can be spread across workers?"""
+        self.assertEqual(
+            group_page_runs(range(1, 11), 4),
+            [(1, 4), (5, 8), (9, 10)],
+        )
+
+    def test_duplicate_pages(self):
+        """Do repeated pages only get rendered once?"""
+        self.assertEqual(group_page_runs([2, 2, "3"], 10), [(2, 3)])
+
+
+class PdfiumRendererTests(unittest.TestCase):
+    def test_render_page(self):
+        """Does pdfium render a page with the right longest edge?"""
+        png, err, returncode = asyncio.run(
+            make_png_thumbnail_for_instance(
+                f"{asset_path}/vector-pdf.pdf", 350, "pdfium"
+            )
+        )
+        self.assertEqual(returncode, "0", msg=err)
+        image = Image.open(io.BytesIO(png))
+        self.assertEqual(image.format, "PNG")
+        self.assertEqual(max(image.size), 350)
+
+    def test_render_missing_file(self):
+        """Do we report an error instead of raising?"""
+        png, err, returncode = asyncio.run(
+            make_png_thumbnail_for_instance(
+                f"{asset_path}/missing.pdf", 350, "pdfium"
+            )
+        )
+        self.assertEqual(png, b"")
+        self.assertEqual(returncode, "1")
+
+    def test_render_pages(self):
+        """Do we render every requested page that exists, and skip the rest?"""
+
+        async def collect(directory):
+            thumbnails = make_png_thumbnails(
+                f"{asset_path}/image-pdf.pdf",
+                100,
+                [1, 2, 9],
+                directory,
+                "pdfium",
+            )
+            return [path async for path in thumbnails]
+
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        paths = asyncio.run(collect(directory))
+        self.assertEqual(
+            [os.path.basename(path) for path in paths],
+            ["thumb-1.png", "thumb-2.png"],
+        )
+
+    def test_thumbnail_variants(self):
+        """Are smaller sizes and other formats made from one rendering?"""
+        png, _, _ = asyncio.run(
+            make_png_thumbnail_for_instance(
+                f"{asset_path}/vector-pdf.pdf", 700, "pdfium"
+            )
+        )
+        variants = make_thumbnail_variants(
+            png, [700, 100, 350], ["png", "jpeg", "webp"]
+        )
+        self.assertEqual(len(variants), 9)
+        self.assertIs(variants[(700, "png")], png)
+        for (dimension, thumbnail_format), data in variants.items():
+            image = Image.open(io.BytesIO(data))
+            self.assertEqual(image.format.lower(), thumbnail_format)
+            self.assertEqual(max(image.size), dimension)
+
+    def test_unknown_backend(self):
+        """Is a typo in the backend setting reported clearly?"""
+        with self.assertRaises(ImproperlyConfigured):
+            get_render_backend("ghostscript")
+
+
+class StreamZipTests(unittest.TestCase):
+    def test_stream_zip(self):
+        """Do the streamed chunks make up a valid, uncompressed zip?"""
+
+        async def collect(paths):
+            async def files():
+                for path in paths:
+                    yield path
+
+            return [chunk async for chunk in stream_zip(files())]
+
+        with TemporaryDirectory() as directory:
+            paths = []
+            for page in (1, 2):
+                path = f"{directory}/thumb-{page}.png"
+                with open(path, "wb") as f:
+                    f.write(b"page %d" % page)
+                paths.append(path)
+            chunks = asyncio.run(collect(paths))
+
+        self.assertEqual(len(chunks), 3, msg="Expected a chunk per file")
+        with ZipFile(io.BytesIO(b"".join(chunks))) as zf:
+            self.assertEqual(zf.namelist(), ["thumb-1.png", "thumb-2.png"])
+            self.assertEqual(zf.read("thumb-2.png"), b"page 2")
+            self.assertEqual(zf.infolist()[0].compress_type, 0)
+
+    def test_streams_under_wsgi(self):
+        """Does the first chunk reach a WSGI server before rendering ends?"""
+        first_chunk = threading.Event()
+        waited = []
+
+        async def render(filepath, max_dimension, pages, directory, backend):
+            for page in pages:
+                path = f"{directory.name}/thumb-{page}.png"
+                Path(path).write_bytes(b"page %d" % page)
+                yield path
+                waited.append(await asyncio.to_thread(first_chunk.wait, 5))
+
+        request = RequestFactory().post(
+            "/convert/pdf/thumbnails/",
+            {
+                "file": SimpleUploadedFile("a.pdf", b"%PDF-1.4"),
+                "pages": "[1, 2]",
+            },
+            HTTP_HOST="localhost",
+        )
+        with patch("doctor.views.make_png_thumbnails", render):
+            application = get_wsgi_application()
+            body = application(request.environ, lambda *args: None)
+            chunks = []
+            for chunk in body:
+                first_chunk.set()
+                chunks.append(chunk)
+            body.close()
+        self.assertEqual(waited, [True, True])
+        with ZipFile(io.BytesIO(b"".join(chunks))) as zf:
+            self.assertEqual(zf.namelist(), ["thumb-1.png", "thumb-2.png"])
+
+    def test_file_response(self):
+        """Is a file sent without reading it into memory, under WSGI or ASGI?"""
+        scope = {"type": "http", "method": "GET", "path": "/", "headers": []}
+        with NamedTemporaryFile() as tmp:
+            tmp.write(b"%PDF-1.4")
+            tmp.flush()
+            with open(tmp.name, "rb") as f:
+                wsgi = file_response(RequestFactory().get("/"), f)
+                self.assertIsInstance(wsgi, FileResponse)
+                self.assertEqual(b"".join(wsgi), b"%PDF-1.4")
+            with open(tmp.name, "rb") as f:
+                asgi = file_response(ASGIRequest(scope, io.BytesIO()), f)
+                self.assertTrue(asgi.is_async)
+                self.assertEqual(asgi["Content-Length"], "8")
+
 
 class MetadataTests(unittest.TestCase):
     """Can we count page numbers in PDF files"""
@@ -309,6 +1678,24 @@ class MetadataTests(unittest.TestCase):
         ).text
         self.assertEqual(int(page_count), 2, "Failed to get page count")
 
+    def test_page_counts(self):
+        """Can we count the pages of many PDFs in one request?"""
+        files = [
+            ("file", (filename, Path(asset_path, filename).read_bytes()))
+            for filename in ("image-pdf.pdf", "vector-pdf.pdf", "empty.pdf")
+        ]
+        response = requests.post(
+            "http://doctor:5050/utils/page-count/", files=files
+        ).json()
+        self.assertEqual(
+            response["results"],
+            [
+                {"filename": "image-pdf.pdf", "page_count": 2},
+                {"filename": "vector-pdf.pdf", "page_count": 30},
+                {"filename": "empty.pdf", "page_count": 0},
+            ],
+        )
+
     def test_mime_type(self):
         """"""
         files = make_file(filename="image-pdf.pdf")
@@ -377,6 +1764,27 @@ class MetadataTests(unittest.TestCase):
         )
         self.assertEqual(response.text, ".doc", msg="Failed to get mime type")
 
+    def test_identify_files(self):
+        """Can we identify many files in one request?"""
+        files = [
+            ("file", (filename, Path(asset_path, filename).read_bytes()))
+            for filename in ("image-pdf.pdf", "word-doc.doc", "1.mp3")
+        ]
+        results = requests.post(
+            "http://doctor:5050/utils/identify/batch/", files=files
+        ).json()["results"]
+        self.assertEqual(
+            [(r["filename"], r["extension"]) for r in results],
+            [
+                ("image-pdf.pdf", ".pdf"),
+                ("word-doc.doc", ".doc"),
+                ("1.mp3", ".mp3"),
+            ],
+        )
+        self.assertEqual(results[0]["page_count"], 2)
+        self.assertEqual(results[0]["pdf_version"], "1.3")
+        self.assertIsNone(results[1]["page_count"])
+
     def test_embedding_text_to_image_pdf(self):
         """Can we embed text into an image PDF?"""
         data = {"ocr_available": False}
@@ -464,6 +1872,102 @@ class RedactionTest(unittest.TestCase):
                     else:
                         self.assertFalse(len(bb["results"]) == 0)
 
+    def test_xray_any_mode(self):
+        """Can we just ask whether there's a bad redaction in some pages?"""
+        for filename, found in (
+            ("rectangles_yes.pdf", True),
+            ("rectangles_no.pdf", False),
+        ):
+            response = requests.post(
+                "http://doctor:5050/utils/check-redactions/pdf/",
+                files=make_file(filename=f"x-ray/{filename}"),
+                data={"mode": "any", "first_page": 1, "last_page": 1},
+            )
+            self.assertTrue(response.ok)
+            self.assertEqual(bool(response.json()["results"]), found)
+
+    def test_xray_bad_page_range(self):
+        """Do we reject page ranges that end before they start?"""
+        response = requests.post(
+            "http://doctor:5050/utils/check-redactions/pdf/",
+            files=make_file(filename="x-ray/rectangles_yes.pdf"),
+            data={"first_page": 3, "last_page": 2},
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class DocumentFormTests(unittest.TestCase):
+    def setUp(self):
+        # Validation messages need the app registry
+        django.setup()
+
+    def test_upload_saved_once(self):
+        """Is an upload written to a temporary file only once?"""
+        form = DocumentForm(
+            {}, {"file": SimpleUploadedFile("a.pdf", b"%PDF-1.4")}
+        )
+        with patch.object(DocumentForm, "prep_file") as prep_file:
+            self.assertTrue(form.is_valid())
+        prep_file.assert_called_once()
+
+
+def fake_bad_redactions(page) -> list[dict]:
+    """Pretend pages 2 and 4 have dates redacted, and pages 5 and 6 text"""
+    texts = {2: "01/02/2020", 4: "3/4/21", 5: "Secret", 6: "Also secret"}
+    text = texts.get(page.number + 1)
+    return [{"bbox": [0, 0, 1, 1], "text": text}] if text else []
+
+
+@patch("doctor.tasks.get_bad_redactions", fake_bad_redactions)
+class XrayShardTests(unittest.TestCase):
+    path = f"{asset_path}/vector-pdf.pdf"
+
+    def test_all_mode(self):
+        """Do we find every redaction, in page order?"""
+        results = get_xray(self.path)
+        self.assertEqual(list(results), [2, 4, 5, 6])
+
+    def test_any_mode_stops_early(self):
+        """Do we stop at the first redaction that isn't a date?"""
+        results = get_xray(self.path, stop_at_first=True)
+        self.assertEqual(list(results), [2, 4, 5])
+
+    def test_page_range(self):
+        """Do we only look at the pages asked for, and drop dates?"""
+        self.assertEqual(list(get_xray(self.path, 5, 10)), [5, 6])
+        self.assertEqual(get_xray(self.path, 1, 4), {})
+        self.assertTrue(get_xray(self.path, 31)["error"])
+
+    def test_shards_match(self):
+        """Are shards put back together in page order?"""
+        with patch.multiple(settings, XRAY_SHARD_PAGES=2, XRAY_WORKERS=3):
+            self.assertEqual(list(get_xray(self.path)), [2, 4, 5, 6])
+            # Shards finish in any order, and the first to find a bad
+            # redaction ends the check
+            results = list(get_xray(self.path, stop_at_first=True))
+        self.assertIn(5, results)
+        self.assertEqual(results, sorted(results))
+        self.assertLessEqual(set(results), {2, 4, 5, 6})
+
+    def test_stop_path(self):
+        """Does a shard stop between pages once the stop file exists?"""
+        self.assertEqual(list(inspect_pages(self.path, 1, 30)), [2, 4, 5, 6])
+        with TemporaryDirectory() as directory:
+            stop_path = f"{directory}/stop"
+            self.assertEqual(
+                list(inspect_pages(self.path, 1, 30, False, stop_path)),
+                [2, 4, 5, 6],
+            )
+            Path(stop_path).touch()
+            self.assertEqual(
+                inspect_pages(self.path, 1, 30, False, stop_path), {}
+            )
+
+    def test_not_a_pdf(self):
+        """Do broken files get the generic error?"""
+        path = f"{asset_path}/1.wma"
+        self.assertEqual(get_xray(path), {"error": True, "msg": "Exception"})
+
 
 class ImageDisclosuresTest(unittest.TestCase):
     def test_images_to_pdf(self):
@@ -489,23 +1993,23 @@ class ImageDisclosuresTest(unittest.TestCase):
 class AudioConversionTests(unittest.TestCase):
     """Test Audio Conversion"""
 
+    audio_details = {
+        "court_full_name": "Testing Supreme Court",
+        "court_short_name": "Testing Supreme Court",
+        "court_pk": "mad",
+        "court_url": "http://www.example.com/",
+        "docket_number": "docket number 1 005",
+        "date_argued": "2020-01-01",
+        "date_argued_year": "2020",
+        "case_name": "SEC v. Frank J. Custable, Jr.",
+        "case_name_full": "case name full",
+        "case_name_short": "short",
+        "download_url": "http://media.ca7.uscourts.gov/sound/external/gw.15-1442.15-1442_07_08_2015.mp3",
+    }
+
     def test_wma_to_mp3(self):
         """Can we convert to mp3 with metadata"""
-
-        audio_details = {
-            "court_full_name": "Testing Supreme Court",
-            "court_short_name": "Testing Supreme Court",
-            "court_pk": "mad",
-            "court_url": "http://www.example.com/",
-            "docket_number": "docket number 1 005",
-            "date_argued": "2020-01-01",
-            "date_argued_year": "2020",
-            "case_name": "SEC v. Frank J. Custable, Jr.",
-            "case_name_full": "case name full",
-            "case_name_short": "short",
-            "download_url": "http://media.ca7.uscourts.gov/sound/external/gw.15-1442.15-1442_07_08_2015.mp3",
-        }
-
+        audio_details = self.audio_details
         files = make_file(filename="1.wma")
         response = requests.post(
             "http://doctor:5050/convert/audio/mp3/",
@@ -536,13 +2040,145 @@ class AudioConversionTests(unittest.TestCase):
                 msg="Audio conversion to mp3 failed.",
             )
 
+    def test_mp3_and_ogg(self):
+        """Can we get both formats from one upload?"""
+        files = make_file(filename="1.wma")
+        response = requests.post(
+            "http://doctor:5050/convert/audio/",
+            files=files,
+            params={"formats": "mp3,ogg", **self.audio_details},
+        )
+        self.assertEqual(response.status_code, 200, msg="Bad status code")
+        with ZipFile(io.BytesIO(response.content)) as zf:
+            self.assertEqual(zf.namelist(), ["audio.mp3", "audio.ogg"])
+            self.assertEqual(zf.read("audio.ogg")[:4], b"OggS")
+            with NamedTemporaryFile(suffix=".mp3") as tmp:
+                tmp.write(zf.read("audio.mp3"))
+                tmp.flush()
+                mp3_file = eyed3.load(tmp.name)
+        self.assertEqual(mp3_file.tag.publisher, "Free Law Project")
+
+    def test_mp3_pass_through(self):
+        """Is an MP3 that's already 22.05 kHz 48 kbps retagged, not encoded?"""
+        files = make_file(filename="1_with_metadata.mp3")
+        response = requests.post(
+            "http://doctor:5050/convert/audio/mp3/",
+            files=files,
+            params=self.audio_details,
+        )
+        self.assertEqual(response.status_code, 200, msg="Bad status code")
+        source = Path(asset_path, "1_with_metadata.mp3").read_bytes()
+        self.assertEqual(
+            list(mpeg_frames(response.content)), list(mpeg_frames(source))
+        )
+
+    def test_copies_target_mp3(self):
+        """Are only the formats that need it encoded?"""
+        with TemporaryDirectory() as directory:
+            output = f"{directory}/audio.mp3"
+            convert_audio_file(f"{asset_path}/1.mp3", {"mp3": output}, 60)
+            self.assertEqual(
+                Path(output).read_bytes(),
+                Path(asset_path, "1.mp3").read_bytes(),
+            )
+
+    def test_untagged_target_mp3(self):
+        """Is an MP3 we copy tagged even if it had no tags of its own?"""
+        data = Path(asset_path, "1_with_metadata.mp3").read_bytes()
+        # Drop the ID3v2 tag at the start and the ID3v1 tag at the end
+        data = data[id3_size(data[:10]) : -128]
+        request = RequestFactory().post(
+            "/convert/audio/mp3/?" + urlencode(self.audio_details),
+            {"file": SimpleUploadedFile("1.mp3", data)},
+            HTTP_HOST="localhost",
+        )
+        with patch("doctor.tasks.get_seal", return_value=None):
+            application = get_wsgi_application()
+            body = application(request.environ, lambda *args: None)
+            content = b"".join(body)
+            body.close()
+        self.assertEqual(list(mpeg_frames(content)), list(mpeg_frames(data)))
+        with NamedTemporaryFile(suffix=".mp3") as tmp:
+            tmp.write(content)
+            tmp.flush()
+            self.assertEqual(
+                eyed3.load(tmp.name).tag.publisher, "Free Law Project"
+            )
+
+    def test_spool_target_mp3(self):
+        """Do we wait for the audio after a big ID3 tag?"""
+        data = Path(asset_path, "1_with_metadata.mp3").read_bytes()
+        self.assertIsNone(spool_target_mp3(data[:65536]))
+        self.assertTrue(spool_target_mp3(data))
+        wma = Path(asset_path, "1.wma").read_bytes()
+        self.assertFalse(spool_target_mp3(wma[:65536]))
+
+    def test_spool_audio(self):
+        """Are only long recordings and MP3s to copy uploaded first?"""
+        data = Path(asset_path, "1_with_metadata.mp3").read_bytes()
+        self.assertIsNone(spool_audio(data[:65536], len(data), True))
+        self.assertTrue(spool_audio(data, len(data), True))
+        self.assertFalse(spool_audio(data, len(data), False))
+        wma = Path(asset_path, "1.wma").read_bytes()
+        with patch.multiple(
+            settings, AUDIO_SEGMENT_SECONDS=1800, AUDIO_WORKERS=4
+        ):
+            self.assertFalse(spool_audio(wma[:65536], len(wma), True))
+            with patch.object(settings, "AUDIO_SEGMENT_SECONDS", 30):
+                self.assertTrue(spool_audio(wma[:65536], len(wma), True))
+            with patch.object(settings, "AUDIO_WORKERS", 1):
+                self.assertFalse(spool_audio(data, len(data), False))
+
+    def test_audio_command(self):
+        """Is the audio decoded once for every output?"""
+        command = audio_command({"mp3": "a.mp3", "ogg": "a.ogg"})
+        self.assertEqual(command.count("-i"), 1)
+        self.assertEqual(command[command.index("-i") + 1], "pipe:0")
+        self.assertLess(command.index("a.mp3"), command.index("libopus"))
+        self.assertEqual(command[-1], "a.ogg")
+
+    def test_waveform_peaks(self):
+        """Do we get peaks alongside the audio when we ask for them?"""
+        files = make_file(filename="1.wma")
+        response = requests.post(
+            "http://doctor:5050/convert/audio/mp3/",
+            files=files,
+            params={"peaks_per_second": "10", **self.audio_details},
+        )
+        self.assertEqual(response.status_code, 200, msg="Bad status code")
+        with ZipFile(io.BytesIO(response.content)) as zf:
+            self.assertEqual(zf.namelist(), ["audio.mp3", "peaks.json"])
+            peaks = json.loads(zf.read("peaks.json"))
+        self.assertEqual(peaks["samples_per_pixel"], 800)
+        self.assertAlmostEqual(peaks["length"], 600, delta=5)
+        self.assertEqual(len(peaks["data"]), peaks["length"] * 2)
+
+    def test_audio_command_pcm_tap(self):
+        """Is the PCM tap another output of the same decode?"""
+        command = audio_command({"mp3": "a.mp3"}, pcm_tap="peaks.pcm")
+        self.assertEqual(command.count("-i"), 1)
+        self.assertEqual(command[-1], "peaks.pcm")
+        self.assertLess(command.index("a.mp3"), command.index("s16le"))
+
     def test_audio_duration(self):
         files = make_file(filename="1.mp3")
         response = requests.post(
             "http://doctor:5050/utils/audio/duration/",
             files=files,
         )
-        self.assertEqual(51.64, float(response.text), msg="Bad duration")
+        self.assertEqual(60.11, float(response.text), msg="Bad duration")
+
+    def test_audio_info(self):
+        """Can we get the details of several formats at once?"""
+        files = [
+            ("file", (filename, Path(asset_path, filename).read_bytes()))
+            for filename in ("1.mp3", "1.wma")
+        ]
+        results = requests.post(
+            "http://doctor:5050/utils/audio/info/", files=files
+        ).json()["results"]
+        self.assertEqual([r["format"] for r in results], ["mp3", "wma"])
+        self.assertEqual(results[1]["duration"], 59.628)
 
 
 class TestFailedValidations(unittest.TestCase):
@@ -574,6 +2210,75 @@ class TestFailedValidations(unittest.TestCase):
         self.assertEqual(response.status_code, 400, msg="Wrong validation")
 
 
+class MetricsTests(unittest.TestCase):
+    def test_metrics_endpoint(self):
+        """Do we expose request and stage metrics after a conversion?"""
+        files = make_file(filename="image-pdf.pdf")
+        requests.post("http://doctor:5050/utils/page-count/pdf/", files=files)
+        response = requests.get("http://doctor:5050/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'doctor_requests_total{endpoint="page_count",status="200"}',
+            response.text,
+        )
+        self.assertIn("doctor_request_pages_bucket", response.text)
+
+    def test_timed_stage(self):
+        """Does a decorated function record its duration?"""
+
+        @timed_stage("test_stage")
+        def stage():
+            return "done"
+
+        sample = "doctor_stage_duration_seconds_count"
+        labels = {"stage": "test_stage"}
+        count = REGISTRY.get_sample_value(sample, labels)
+        self.assertEqual(stage(), "done")
+        self.assertEqual(REGISTRY.get_sample_value(sample, labels), count + 1)
+
+    def test_timed_stage_async_generator(self):
+        """Is an async generator timed without the consumer's time?"""
+
+        @timed_stage("test_generator_stage")
+        async def stage():
+            for item in range(2):
+                await asyncio.sleep(0.05)
+                yield item
+
+        async def consume():
+            items = []
+            async for item in stage():
+                items.append(item)
+                await asyncio.sleep(0.5)
+            return items
+
+        labels = {"stage": "test_generator_stage"}
+        total = REGISTRY.get_sample_value(
+            "doctor_stage_duration_seconds_sum", labels
+        )
+        self.assertEqual(asyncio.run(consume()), [0, 1])
+        elapsed = REGISTRY.get_sample_value(
+            "doctor_stage_duration_seconds_sum", labels
+        ) - (total or 0)
+        self.assertGreaterEqual(elapsed, 0.1)
+        self.assertLess(elapsed, 0.5)
+
+
+class TestAsyncSubprocess(unittest.TestCase):
+    def test_run_subprocess(self):
+        """Can we run a command and collect its output from a coroutine?"""
+        stdout, stderr, returncode = asyncio.run(
+            run_subprocess(["cat"], stdin=b"foo")
+        )
+        self.assertEqual(stdout, b"foo")
+        self.assertEqual(returncode, 0)
+
+    def test_run_subprocess_failure(self):
+        """Do we get the return code of a failing command?"""
+        _, _, returncode = asyncio.run(run_subprocess(["false"]))
+        self.assertNotEqual(returncode, 0)
+
+
 class TestRecapWhitespaceInsertions(unittest.TestCase):
     """Test our whitespace insertion code"""
 
@@ -23,11 +23,20 @@ urlpatterns = [
         views.make_png_thumbnails_from_range,
         name="thumbnails",
     ),
+    path("convert/pdf/sprite/", views.make_png_sprite, name="sprite"),
     re_path(
         "convert/audio/(mp3|ogg)/", views.convert_audio, name="convert-audio"
     ),
+    path(
+        "convert/audio/",
+        views.convert_audio,
+        name="convert-audio-formats",
+    ),
     path("utils/page-count/pdf/", views.page_count, name="page_count"),
+    path("utils/page-count/", views.page_counts, name="page_counts"),
     path("utils/mime-type/", views.extract_mime_type, name="mime_type"),
+    path("utils/identify/", views.identify_file, name="identify"),
+    path("utils/identify/batch/", views.identify_files, name="identify-batch"),
     path(
         "utils/file/extension/", views.extract_extension, name="file-extension"
     ),
@@ -36,6 +45,7 @@ urlpatterns = [
         views.fetch_audio_duration,
         name="audio-duration",
     ),
+    path("utils/audio/info/", views.fetch_audio_info, name="audio-info"),
     path("utils/add/text/pdf/", views.embed_text, name="add-text-to-pdf"),
     path(
         "utils/document-number/pdf/",
@@ -43,4 +53,5 @@ urlpatterns = [
         name="document-number-pdf",
     ),
     path("utils/check-redactions/pdf/", views.xray, name="xray-pdf"),
+    re_path(r"^metrics/?$", views.metrics, name="metrics"),
 ]
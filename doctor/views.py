@@ -1,21 +1,26 @@
+import json
 import logging
-import mimetypes
-import re
-import shutil
-from http.client import BAD_REQUEST
+import os
+import subprocess
+from functools import partial
+from http.client import BAD_GATEWAY, BAD_REQUEST, REQUEST_ENTITY_TOO_LARGE
+from pathlib import Path
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 
-import eyed3
-import img2pdf
 import magic
-import pytesseract
-import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.exceptions import BadRequest
-from django.http import FileResponse, HttpResponse, JsonResponse
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    HttpResponseNotModified,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.utils.http import parse_etags
 from lxml.etree import ParserError, XMLSyntaxError
-from PIL import Image
-from PyPDF2 import PdfReader, PdfWriter
-from pytesseract import Output
 
 from doctor.forms import (
     AudioForm,
@@ -23,21 +28,54 @@ from doctor.forms import (
     DocumentForm,
     ImagePdfForm,
     MimeForm,
+    SpriteForm,
     ThumbnailForm,
+    XrayForm,
+)
+from doctor.lib.audio_info import (
+    AudioInfo,
+    AudioProbeError,
+    ffprobe,
+    probe_audio,
+)
+from doctor.lib.audio_segments import SegmentError
+from doctor.lib.cache import ThumbnailCache, get_thumbnail_cache, hash_upload
+from doctor.lib.fetch import DownloadError, DownloadTooLarge
+from doctor.lib.identify import (
+    HEAD_BYTES,
+    identify,
+    open_upload,
+    sniff,
+    trusted_extension,
+    trusted_mime,
+)
+from doctor.lib.metrics import observe_pages, render_metrics
+from doctor.lib.pdf_writer import images_to_pdf_file, tiff_to_pdf_file
+from doctor.lib.render import (
+    make_png_thumbnail_for_instance,
+    make_png_thumbnails,
+    make_sprite,
+    make_thumbnail_variant_files,
+    make_thumbnail_variants,
+    variant_name,
 )
+from doctor.lib.uploads import PipedUpload, PipeUploadHandler, upload_path
 from doctor.lib.utils import (
+    awrite_upload,
     cleanup_form,
+    file_response,
     log_sentry_event,
-    make_page_with_text,
-    make_png_thumbnail_for_instance,
-    make_png_thumbnails,
-    strip_metadata_from_path,
+    make_zip,
+    stream_zip,
+    streaming_response,
 )
 from doctor.tasks import (
-    convert_tiff_to_pdf_bytes,
-    convert_to_mp3,
-    convert_to_ogg,
+    AUDIO_OUTPUT_OPTIONS,
+    PEAKS_SAMPLE_RATE,
+    audio_command,
+    convert_audio_file,
     download_images,
+    embed_text_layer,
     extract_from_doc,
     extract_from_docx,
     extract_from_html,
@@ -47,11 +85,12 @@ from doctor.tasks import (
     extract_recap_pdf,
     get_document_number_from_pdf,
     get_page_count,
+    get_pdf_page_count,
     get_xray,
     make_pdftotext_process,
-    rasterize_pdf,
+    save_waveform_peaks,
     set_mp3_meta_data,
-    strip_metadata_from_bytes,
+    spool_audio,
 )
 
 logger = logging.getLogger(__name__)
@@ -66,20 +105,29 @@ def heartbeat(request) -> HttpResponse:
     return HttpResponse("Heartbeat detected.")
 
 
+def metrics(request) -> HttpResponse:
+    """Expose throughput and latency metrics for Prometheus
+
+    :param request: The request object
+    :return: The metrics in the Prometheus text format
+    """
+    content, content_type = render_metrics()
+    return HttpResponse(content, content_type=content_type)
+
+
 def image_to_pdf(request) -> HttpResponse:
     """"""
 
     form = DocumentForm(request.POST, request.FILES)
     if not form.is_valid():
         return HttpResponse("Failed validation", status=BAD_REQUEST)
-    image = Image.open(form.cleaned_data["fp"])
-    pdf_bytes = convert_tiff_to_pdf_bytes(image)
-    cleaned_pdf_bytes = strip_metadata_from_bytes(pdf_bytes)
     with NamedTemporaryFile(suffix=".pdf") as output:
-        with open(output.name, "wb") as f:
-            f.write(cleaned_pdf_bytes)
+        tiff_to_pdf_file(form.cleaned_data["fp"], output.name)
         cleanup_form(form)
-        return HttpResponse(cleaned_pdf_bytes)
+        return FileResponse(
+            open(output.name, "rb"),  # noqa: SIM115 FileResponse closes it
+            content_type="application/pdf",
+        )
 
 
 def extract_recap_document(request) -> JsonResponse:
@@ -181,6 +229,7 @@ def extract_doc_content(request) -> JsonResponse | HttpResponse:
 
     # Get page count if you can
     page_count = get_page_count(fp, extension)
+    observe_pages(request, page_count)
     cleanup_form(form)
     return JsonResponse(
         {
@@ -193,9 +242,17 @@ def extract_doc_content(request) -> JsonResponse | HttpResponse:
     )
 
 
-def make_png_thumbnail(request) -> HttpResponse:
+async def make_png_thumbnail(request) -> HttpResponse:
     """Make a thumbnail of the first page of a PDF and return it.
 
+    Thumbnails are cached by the content of the PDF, and the cache key is
+    sent as the ETag, so clients that send it back in If-None-Match get a
+    304 without us rendering anything.
+
+    If max_dimensions or formats are given, the page is rendered once at
+    the largest size and a zip of every size and format is returned
+    instead. Those aren't cached.
+
     :return: A response containing our file and any errors
     :type: HTTPS response
     """
@@ -203,18 +260,84 @@ def make_png_thumbnail(request) -> HttpResponse:
     if not form.is_valid():
         return HttpResponse("Failed validation", status=BAD_REQUEST)
     document = form.cleaned_data["file"]
+    max_dimension = form.cleaned_data["max_dimension"]
+    max_dimensions = form.cleaned_data["max_dimensions"]
+    if max_dimensions:
+        return await make_thumbnail_variants_response(
+            document, max_dimensions, form.cleaned_data["formats"]
+        )
+    pdf_hash = await sync_to_async(hash_upload, thread_sensitive=False)(
+        document
+    )
+    backend = settings.THUMBNAIL_BACKEND
+    key = ThumbnailCache.make_key(
+        pdf_hash,
+        1,
+        max_dimension,
+        backend,
+        settings.THUMBNAIL_IMAGE_FAST_PATH,
+    )
+    etag = f'"{key}"'
+    if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+    if etag in if_none_match or "*" in if_none_match:
+        return HttpResponseNotModified(headers={"ETag": etag})
+
+    thumbnail_cache = get_thumbnail_cache()
+    thumbnail = None
+    if thumbnail_cache:
+        thumbnail = await sync_to_async(
+            thumbnail_cache.get, thread_sensitive=False
+        )(key)
+    if thumbnail is None:
+        with NamedTemporaryFile(suffix=".pdf") as tmp:
+            await awrite_upload(document, tmp.name)
+            thumbnail, _, returncode = await make_png_thumbnail_for_instance(
+                tmp.name, max_dimension, backend
+            )
+        if thumbnail_cache and returncode == "0" and thumbnail:
+            await sync_to_async(thumbnail_cache.set, thread_sensitive=False)(
+                key, thumbnail
+            )
+    headers = {"ETag": etag} if thumbnail else {}
+    return HttpResponse(thumbnail, headers=headers)
+
+
+async def make_thumbnail_variants_response(
+    document, max_dimensions: list[int], formats: list[str]
+) -> HttpResponse:
+    """Make a zip of the first page in several sizes and formats
+
+    :param document: The uploaded PDF
+    :param max_dimensions: The longest edges wanted, in pixels
+    :param formats: The image formats wanted
+    :return: A response containing the zip, or an empty one on failure
+    """
     with NamedTemporaryFile(suffix=".pdf") as tmp:
-        with open(tmp.name, "wb") as f:
-            f.write(document.read())
-        thumbnail, _, _ = make_png_thumbnail_for_instance(
-            tmp.name, form.cleaned_data["max_dimension"]
+        await awrite_upload(document, tmp.name)
+        png, _, returncode = await make_png_thumbnail_for_instance(
+            tmp.name, max(max_dimensions), settings.THUMBNAIL_BACKEND
         )
-        return HttpResponse(thumbnail)
+    if returncode != "0" or not png:
+        return HttpResponse(png)
+    variants = await sync_to_async(
+        make_thumbnail_variants, thread_sensitive=False
+    )(png, max_dimensions, formats)
+    files = {
+        variant_name(1, dimension, thumbnail_format): data
+        for (dimension, thumbnail_format), data in variants.items()
+    }
+    return HttpResponse(make_zip(files), content_type="application/zip")
 
 
-def make_png_thumbnails_from_range(request) -> HttpResponse:
+async def make_png_thumbnails_from_range(
+    request,
+) -> StreamingHttpResponse | HttpResponse:
     """Make a zip file that contains a thumbnail for each page requested.
 
+    The zip is streamed to the client as pages finish rendering. If
+    max_dimensions or formats are given, each page is rendered once at the
+    largest size and every size and format of it is put in the zip.
+
     :return: A response containing our zip and any errors
     :type: HTTPS response
     """
@@ -223,21 +346,87 @@ def make_png_thumbnails_from_range(request) -> HttpResponse:
         return HttpResponse("Failed validation", status=BAD_REQUEST)
 
     directory = TemporaryDirectory()
-    with NamedTemporaryFile(suffix=".pdf", mode="r+b") as temp_pdf:
-        temp_pdf.write(form.cleaned_data["file"].read())
+    filepath = f"{directory.name}/document.pdf"
+    await awrite_upload(form.cleaned_data["file"], filepath)
+    observe_pages(request, len(form.cleaned_data["pages"]))
+    max_dimensions = form.cleaned_data["max_dimensions"]
+    thumbnails = make_png_thumbnails(
+        filepath,
+        max(max_dimensions or [form.cleaned_data["max_dimension"]]),
+        form.cleaned_data["pages"],
+        directory,
+        settings.THUMBNAIL_RANGE_BACKEND,
+    )
+    if max_dimensions:
+        thumbnails = make_thumbnail_variant_files(
+            thumbnails, max_dimensions, form.cleaned_data["formats"]
+        )
 
-        make_png_thumbnails(
-            temp_pdf.name,
+    async def stream():
+        try:
+            async for chunk in stream_zip(thumbnails):
+                yield chunk
+        finally:
+            directory.cleanup()
+
+    return streaming_response(
+        request, stream(), content_type="application/zip"
+    )
+
+
+async def make_png_sprite(request) -> HttpResponse:
+    """Make a contact sheet of a range of pages as one sprite image
+
+    The pages are rendered in parallel at a small size and tiled into a
+    single image, so a preview strip needs one image fetch instead of one
+    per page.
+
+    :return: A zip holding sprite.{format} and sprite.json, which gives the
+    offset and size of each page in the sprite
+    """
+    form = SpriteForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return HttpResponse("Failed validation", status=BAD_REQUEST)
+    sprite_format = form.cleaned_data["format"]
+    directory = TemporaryDirectory()
+    try:
+        filepath = f"{directory.name}/document.pdf"
+        await awrite_upload(form.cleaned_data["file"], filepath)
+        pages = form.cleaned_data["pages"]
+        if not pages:
+            page_count = await sync_to_async(
+                get_page_count, thread_sensitive=False
+            )(filepath, "pdf")
+            if not page_count:
+                return HttpResponse(
+                    "Unable to read the PDF", status=BAD_REQUEST
+                )
+            pages = range(1, page_count + 1)
+        observe_pages(request, len(pages))
+        thumbnails = {}
+        async for path in make_png_thumbnails(
+            filepath,
             form.cleaned_data["max_dimension"],
-            form.cleaned_data["pages"],
+            pages,
             directory,
-        )
-
-    with NamedTemporaryFile(suffix=".zip") as tmp_zip:
-        filename = shutil.make_archive(
-            f"{tmp_zip.name[:-4]}", "zip", directory.name
-        )
-        return FileResponse(open(filename, "rb"))
+            settings.THUMBNAIL_RANGE_BACKEND,
+        ):
+            page = int(Path(path).stem.rsplit("-", 1)[1])
+            thumbnails[page] = path
+        if not thumbnails:
+            return HttpResponse("Unable to render pages", status=BAD_REQUEST)
+        sprite, offsets = await sync_to_async(
+            make_sprite, thread_sensitive=False
+        )(thumbnails, form.cleaned_data["columns"], sprite_format)
+    except ValueError as e:
+        return HttpResponse(str(e), status=BAD_REQUEST)
+    finally:
+        directory.cleanup()
+    files = {
+        f"sprite.{sprite_format}": sprite,
+        "sprite.json": json.dumps(offsets).encode(),
+    }
+    return HttpResponse(make_zip(files), content_type="application/zip")
 
 
 def xray(request) -> JsonResponse:
@@ -245,24 +434,29 @@ def xray(request) -> JsonResponse:
 
     :return: json with bounding boxes and text
     """
+    form = XrayForm(request.POST, request.FILES)
+    if not form.is_valid():
+        if form.cleaned_data.get("fp"):
+            cleanup_form(form)
+        return JsonResponse(
+            {"error": True, "msg": "Failed validation"}, status=BAD_REQUEST
+        )
     try:
-        form = DocumentForm(request.POST, request.FILES)
-        if not form.is_valid():
-            return JsonResponse(
-                {"error": True, "msg": "Failed validation"}, status=BAD_REQUEST
-            )
         extension = form.cleaned_data["extension"]
         if extension.casefold() != "pdf":
             return JsonResponse(
                 {"error": True, "msg": "Failed file type"}, status=BAD_REQUEST
             )
-        results = get_xray(form.cleaned_data["fp"])
-        if results.get("error", False):
-            return JsonResponse(results, status=BAD_REQUEST)
-    except Exception:
-        pass
+        results = get_xray(
+            form.cleaned_data["fp"],
+            first_page=form.cleaned_data["first_page"],
+            last_page=form.cleaned_data["last_page"],
+            stop_at_first=form.cleaned_data["mode"] == "any",
+        )
     finally:
         cleanup_form(form)
+    if results.get("error", False):
+        return JsonResponse(results, status=BAD_REQUEST)
     return JsonResponse({"error": False, "results": results})
 
 
@@ -276,10 +470,39 @@ def page_count(request) -> HttpResponse:
         return HttpResponse("Failed validation", status=BAD_REQUEST)
     extension = form.cleaned_data["extension"]
     pg_count = get_page_count(form.cleaned_data["fp"], extension)
+    observe_pages(request, pg_count)
     cleanup_form(form)
     return HttpResponse(pg_count)
 
 
+def page_counts(request) -> JsonResponse:
+    """Get the page counts of many documents at once
+
+    Files come in as repeated file fields. Big uploads are counted where
+    Django spooled them to disk and small ones in memory, so nothing is
+    copied to a temp file first.
+
+    :return: The filename and page count of each file, in order
+    """
+    uploads = request.FILES.getlist("file")
+    if not uploads:
+        return JsonResponse(
+            {"error": True, "msg": "No files"}, status=BAD_REQUEST
+        )
+    results = []
+    for upload in uploads:
+        extension = upload.name.split(".")[-1].casefold()
+        if extension != "pdf":
+            pg_count = get_page_count(upload.name, extension)
+        elif isinstance(upload, TemporaryUploadedFile):
+            pg_count = get_pdf_page_count(upload.temporary_file_path())
+        else:
+            pg_count = get_pdf_page_count(upload.read())
+        observe_pages(request, pg_count)
+        results.append({"filename": upload.name, "page_count": pg_count})
+    return JsonResponse({"error": False, "results": results})
+
+
 def extract_mime_type(request) -> JsonResponse | HttpResponse:
     """Identify the mime type of a document
 
@@ -299,54 +522,54 @@ def extract_extension(request) -> HttpResponse:
     form = MimeForm(request.GET, request.FILES)
     if not form.is_valid():
         return HttpResponse("Failed validation", status=BAD_REQUEST)
-    content = form.cleaned_data["file"].read()
-
-    file_str = magic.from_buffer(content)
-    if file_str.startswith("Composite Document File V2 Document"):
-        # Workaround for issue with libmagic1==5.09-2 in Ubuntu 12.04. Fixed
-        # in libmagic 5.11-2.
-        mime = "application/msword"
-    elif file_str == "(Corel/WP)":
-        mime = "application/vnd.wordperfect"
-    elif file_str == "C source, ASCII text":
-        mime = "text/plain"
-    elif file_str.startswith("WordPerfect document"):
-        mime = "application/vnd.wordperfect"
-    elif re.findall(
-        r"(Audio file with ID3.*MPEG.*layer III)|(.*Audio Media.*)", file_str
-    ):
-        mime = "audio/mpeg"
-    else:
-        # No workaround necessary
-        mime = magic.from_buffer(content, mime=True)
-    extension = mimetypes.guess_extension(mime)
-    if extension == ".obj":
-        # It could be a wpd, if it's not a PDF
-        if "PDF" in content[0:40]:
-            # Does 'PDF' appear in the beginning of the content?
-            extension = ".pdf"
-        else:
-            extension = ".wpd"
-
-    # The extension is .bin, look in the content if we can infer the
-    # content type as pdf. See: https://bugs.astron.com/view.php?id=446
-    if extension == ".bin":
-        # Check if %PDF-X.X is in the first 1024 bytes of content
-        pattern = rb"%PDF-[0-9]+(\.[0-9]+)?"
-        matches = re.search(pattern, content[:1024])
-        if matches:
-            # Document contains a pdf version, so the file must be a pdf
-            extension = ".pdf"
-
-    fixes = {
-        ".htm": ".html",
-        ".xml": ".html",
-        ".wsdl": ".html",
-        ".ksh": ".txt",
-        ".asf": ".wma",
-        ".dot": ".doc",
-    }
-    return HttpResponse(fixes.get(extension, extension).lower())
+    with open_upload(form.cleaned_data["file"]) as data:
+        description, mime = sniff(data)
+        extension = trusted_extension(
+            trusted_mime(description, mime), data[:HEAD_BYTES]
+        )
+    return HttpResponse(extension)
+
+
+def identify_upload(request, upload) -> dict:
+    """Identify one uploaded file
+
+    :param request: The request, for metrics
+    :param upload: A file from request.FILES
+    :return: What identify found, and the file's name
+    """
+    with open_upload(upload) as data:
+        result = {"filename": upload.name, **identify(data)}
+    observe_pages(request, result["page_count"])
+    return result
+
+
+def identify_file(request) -> JsonResponse | HttpResponse:
+    """Identify a file: its mime type, extension and, for PDFs, version,
+    encryption and page count, all at once
+
+    Only the start of the file and, for PDFs, the few objects that lead
+    to the page count are read.
+
+    :return: JSON describing the file
+    """
+    form = MimeForm(request.GET, request.FILES)
+    if not form.is_valid():
+        return HttpResponse("Failed validation", status=BAD_REQUEST)
+    return JsonResponse(identify_upload(request, form.cleaned_data["file"]))
+
+
+def identify_files(request) -> JsonResponse:
+    """Identify many files at once, sent as repeated file fields
+
+    :return: JSON describing each file, in order
+    """
+    uploads = request.FILES.getlist("file")
+    if not uploads:
+        return JsonResponse(
+            {"error": True, "msg": "No files"}, status=BAD_REQUEST
+        )
+    results = [identify_upload(request, upload) for upload in uploads]
+    return JsonResponse({"error": False, "results": results})
 
 
 def pdf_to_text(request) -> JsonResponse | HttpResponse:
@@ -367,73 +590,295 @@ def pdf_to_text(request) -> JsonResponse | HttpResponse:
     )
 
 
-def images_to_pdf(request) -> HttpResponse:
-    """
+async def images_to_pdf(request) -> HttpResponse:
+    """Download images and combine them into a clean PDF
 
-    :param request:
-    :return:
+    Several URLs are downloaded a few at a time and each image becomes a
+    page. A single URL is taken to be one long tiff, which is split into
+    pages.
+
+    :param request: The request, with a JSON list of sorted_urls
+    :return: The PDF, or an error if a download failed
     """
     form = ImagePdfForm(request.GET)
     if not form.is_valid():
         raise BadRequest("Invalid form")
     sorted_urls = form.cleaned_data["sorted_urls"]
 
-    if len(sorted_urls) > 1:
-        image_list = download_images(sorted_urls)
-        with NamedTemporaryFile(suffix=".pdf") as tmp:
-            with open(tmp.name, "wb") as f:
-                f.write(img2pdf.convert(image_list))
-            cleaned_pdf_bytes = strip_metadata_from_path(tmp.name)
-    else:
-        tiff_image = Image.open(
-            requests.get(sorted_urls[0], stream=True, timeout=60 * 5).raw
-        )
-        pdf_bytes = convert_tiff_to_pdf_bytes(tiff_image)
-        cleaned_pdf_bytes = strip_metadata_from_bytes(pdf_bytes)
-    return HttpResponse(cleaned_pdf_bytes, content_type="application/pdf")
+    with TemporaryDirectory() as directory:
+        try:
+            paths = await download_images(sorted_urls, directory)
+        except DownloadTooLarge as e:
+            return HttpResponse(str(e), status=REQUEST_ENTITY_TOO_LARGE)
+        except DownloadError as e:
+            return HttpResponse(str(e), status=BAD_GATEWAY)
+        # Pages are written straight from the scratch files, without
+        # metadata, so only one page is ever in memory.
+        output_path = os.path.join(directory, "document.pdf")
+        if len(paths) == 1:
+            # A single image is a long scan to split into pages.
+            await sync_to_async(tiff_to_pdf_file, thread_sensitive=False)(
+                paths[0], output_path
+            )
+        else:
+            await sync_to_async(images_to_pdf_file, thread_sensitive=False)(
+                paths, output_path
+            )
+        # The open file outlives the directory, and the PDF is deleted
+        # when the response closes it
+        pdf = open(output_path, "rb")  # noqa: SIM115 closed by the response
+    return file_response(request, pdf, content_type="application/pdf")
+
+
+def probe_upload(upload) -> AudioInfo:
+    """Get the duration and stream details of uploaded audio
+
+    The headers are read where Django left the upload. Only if they can't
+    be understood is the file handed to ffprobe.
+
+    :param upload: A file from request.FILES
+    :return: What we found
+    :raises AudioProbeError: If neither could read it
+    """
+    with open_upload(upload) as data:
+        try:
+            return probe_audio(data)
+        except AudioProbeError:
+            pass
+    with upload_path(upload) as path:
+        return ffprobe(path)
 
 
 def fetch_audio_duration(request) -> HttpResponse:
-    """Fetch audio duration from file."""
+    """Fetch the duration of an audio file, in seconds
+
+    MP3, WAV, Ogg and WMA durations come from their headers, so this
+    takes about as long for a four hour argument as for a minute of it.
+
+    :return: The duration, rounded to hundredths of a second
+    """
+    form = AudioForm(request.GET, request.FILES)
+    if not form.is_valid():
+        return HttpResponse("Failed validation", status=BAD_REQUEST)
     try:
-        form = AudioForm(request.GET, request.FILES)
-        if not form.is_valid():
-            return HttpResponse("Failed validation", status=BAD_REQUEST)
-        with NamedTemporaryFile(suffix=".mp3") as tmp:
-            with open(tmp.name, "wb") as f:
-                for chunk in form.cleaned_data["file"].chunks():
-                    f.write(chunk)
-            mp3_file = eyed3.load(tmp.name)
-            return HttpResponse(mp3_file.info.time_secs)
-    except Exception as e:
-        return HttpResponse(str(e))
+        info = probe_upload(form.cleaned_data["file"])
+    except AudioProbeError as e:
+        return HttpResponse(str(e), status=BAD_REQUEST)
+    return HttpResponse(round(info.duration, 2))
 
 
-def convert_audio(request, output_format: str) -> FileResponse | HttpResponse:
+def fetch_audio_info(request) -> JsonResponse:
+    """Get the duration and stream details of many audio files at once,
+    sent as repeated file fields
+
+    :return: JSON describing each file, in order. Files that couldn't be
+    read have an error instead.
+    """
+    uploads = request.FILES.getlist("file")
+    if not uploads:
+        return JsonResponse(
+            {"error": True, "msg": "No files"}, status=BAD_REQUEST
+        )
+    results = []
+    for upload in uploads:
+        try:
+            info = probe_upload(upload)
+        except AudioProbeError as e:
+            results.append({"filename": upload.name, "error": str(e)})
+            continue
+        results.append({"filename": upload.name, **info._asdict()})
+    return JsonResponse({"error": False, "results": results})
+
+
+def transcode_upload(request, command: list[str], spool_if=None):
+    """Read the uploaded audio, piping it into ffmpeg as it arrives
+
+    The ffmpeg stage of the metrics only counts the time ffmpeg takes to
+    finish after the upload is over.
+
+    :param request: The request, whose body hasn't been read yet
+    :param command: The ffmpeg command, reading from stdin
+    :param spool_if: A function of the audio's first chunk that says to
+    upload it as usual instead
+    :return: request.FILES, with the audio as a PipedUpload unless it was
+    spooled
+    """
+    handler = PipeUploadHandler(
+        request, command, spool_if=spool_if, stage="ffmpeg"
+    )
+    request.upload_handlers.insert(0, handler)
+    return request.FILES
+
+
+def convert_upload(
+    upload, output_paths: dict[str, str], pcm_tap: str | None = None
+) -> str | None:
+    """Convert audio that's been uploaded, in segments if it's long
+
+    :param upload: The audio, from request.FILES
+    :param output_paths: Where to write each output format
+    :param pcm_tap: Where to also write the decoded audio for waveform
+    peaks, if they're wanted
+    :return: What went wrong, if it couldn't be converted
+    """
+    try:
+        duration = probe_upload(upload).duration
+    except AudioProbeError:
+        # Let ffmpeg have a go at it, in one piece
+        duration = 0
+    with upload_path(upload) as path:
+        try:
+            convert_audio_file(path, output_paths, duration, pcm_tap)
+        except subprocess.CalledProcessError as e:
+            return e.stderr.decode(errors="replace")
+        except SegmentError as e:
+            return str(e)
+    return None
+
+
+def get_audio_formats(request, output_format: str | None) -> list[str]:
+    """Get the formats to convert audio to
+
+    :param request: The request, whose formats parameter lists them when
+    the URL doesn't, comma separated or repeated
+    :param output_format: The format in the URL, if any
+    :return: The formats, without duplicates
+    :raises BadRequest: If there are none, or any we can't make
+    """
+    if output_format:
+        return [output_format]
+    formats = []
+    for value in request.GET.getlist("formats"):
+        formats += [f.strip() for f in value.split(",") if f.strip()]
+    formats = list(dict.fromkeys(formats))
+    if not formats or not set(formats) <= AUDIO_OUTPUT_OPTIONS.keys():
+        raise BadRequest(
+            f"formats must be some of {', '.join(AUDIO_OUTPUT_OPTIONS)}"
+        )
+    return formats
+
+
+def get_samples_per_pixel(request) -> int | None:
+    """Get how much audio each waveform peak should cover
+
+    :param request: The request, whose peaks_per_second parameter asks
+    for peaks
+    :return: The number of PEAKS_SAMPLE_RATE samples per peak, or None if
+    peaks weren't asked for
+    :raises BadRequest: If peaks_per_second isn't a whole number from 1 to
+    PEAKS_SAMPLE_RATE
+    """
+    peaks_per_second = request.GET.get("peaks_per_second")
+    if peaks_per_second is None:
+        return None
+    if (
+        not peaks_per_second.isdigit()
+        or not 1 <= int(peaks_per_second) <= PEAKS_SAMPLE_RATE
+    ):
+        raise BadRequest(
+            f"peaks_per_second must be from 1 to {PEAKS_SAMPLE_RATE}"
+        )
+    return PEAKS_SAMPLE_RATE // int(peaks_per_second)
+
+
+async def convert_audio(
+    request, output_format: str | None = None
+) -> FileResponse | HttpResponse | StreamingHttpResponse:
     """Converts an uploaded audio file to the specified output format and
     updates its metadata.
 
-    :return: Converted audio
+    The audio is converted while it's being uploaded, and never held in
+    memory or written to disk as it was sent. Recordings that look longer
+    than AUDIO_SEGMENT_SECONDS are uploaded first instead, and encoded in
+    segments on several cores, and MP3s that are already 22.05 kHz 48 kbps
+    CBR are uploaded and copied rather than encoded again.
+    To get several formats from one upload, leave the format out of the
+    URL and list them in the formats parameter. ffmpeg then decodes the
+    audio once for all of them. With peaks_per_second, the same decode
+    gives the audio's waveform peaks too.
+
+    :return: Converted audio, or a zip of audio.{format} for each format
+    if the format isn't in the URL, and peaks.json if peaks were asked for
     """
-    form = AudioForm(request.GET, request.FILES)
-    if not form.is_valid():
-        return HttpResponse("Failed validation", status=BAD_REQUEST)
-    filepath = form.cleaned_data["fp"]
-    media_file = form.cleaned_data["file"]
-    audio_data = {k: v[0] for k, v in dict(request.GET).items()}
-    match output_format:
-        case "mp3":
-            convert_to_mp3(filepath, media_file)
-            set_mp3_meta_data(audio_data, filepath)
-        case "ogg":
-            convert_to_ogg(filepath, media_file)
-        case _:
-            raise NotImplementedError
-    response = FileResponse(
-        open(filepath, "rb")  # noqa: SIM115 FileResponse closes the file
+    try:
+        formats = get_audio_formats(request, output_format)
+        samples_per_pixel = get_samples_per_pixel(request)
+    except BadRequest as e:
+        return HttpResponse(str(e), status=BAD_REQUEST)
+    directory = TemporaryDirectory()
+    outputs = {f: f"{directory.name}/audio.{f}" for f in formats}
+    pcm_tap = f"{directory.name}/peaks.pcm" if samples_per_pixel else None
+    try:
+        # MP3s that needn't be encoded again, and recordings long enough to
+        # be split, are uploaded before they're converted
+        spool_if = partial(
+            spool_audio,
+            upload_size=int(request.META.get("CONTENT_LENGTH") or 0),
+            copy_mp3="mp3" in outputs,
+        )
+        files = await sync_to_async(transcode_upload, thread_sensitive=False)(
+            request, audio_command(outputs, pcm_tap=pcm_tap), spool_if
+        )
+        form = AudioForm(request.GET, files)
+        if not form.is_valid():
+            directory.cleanup()
+            return HttpResponse("Failed validation", status=BAD_REQUEST)
+        media_file = form.cleaned_data["file"]
+        if isinstance(media_file, PipedUpload):
+            stderr = media_file.stderr if media_file.returncode else None
+        else:
+            stderr = await sync_to_async(
+                convert_upload, thread_sensitive=False
+            )(media_file, outputs, pcm_tap)
+        if stderr is not None:
+            directory.cleanup()
+            error = stderr.strip().splitlines()[-1:]
+            return HttpResponse(
+                f"Failed to convert audio: {''.join(error)}",
+                status=BAD_REQUEST,
+            )
+        if "mp3" in outputs:
+            audio_data = {
+                k: v[0]
+                for k, v in dict(request.GET).items()
+                if k not in ("formats", "peaks_per_second")
+            }
+            await sync_to_async(set_mp3_meta_data, thread_sensitive=False)(
+                audio_data, outputs["mp3"]
+            )
+        paths_to_send = list(outputs.values())
+        if pcm_tap:
+            peaks_path = f"{directory.name}/peaks.json"
+            await sync_to_async(save_waveform_peaks, thread_sensitive=False)(
+                pcm_tap, samples_per_pixel, peaks_path
+            )
+            os.remove(pcm_tap)
+            paths_to_send.append(peaks_path)
+    except BaseException:
+        directory.cleanup()
+        raise
+
+    if output_format and not pcm_tap:
+        response = FileResponse(
+            open(outputs[output_format], "rb")  # noqa: SIM115 FileResponse closes the file
+        )
+        directory.cleanup()
+        return response
+
+    async def paths():
+        for path in paths_to_send:
+            yield path
+
+    async def stream():
+        try:
+            async for chunk in stream_zip(paths()):
+                yield chunk
+        finally:
+            directory.cleanup()
+
+    return streaming_response(
+        request, stream(), content_type="application/zip"
     )
-    cleanup_form(form)
-    return response
 
 
 def embed_text(request) -> FileResponse | HttpResponse:
@@ -444,34 +889,15 @@ def embed_text(request) -> FileResponse | HttpResponse:
     form = DocumentForm(request.GET, request.FILES)
     if not form.is_valid():
         return HttpResponse("Failed validation", status=BAD_REQUEST)
-    fp = form.cleaned_data["fp"]
-    with NamedTemporaryFile(suffix=".tiff") as destination:
-        rasterize_pdf(fp, destination.name)
-        data = pytesseract.image_to_data(
-            destination.name, output_type=Output.DICT
-        )
-        image = Image.open(destination.name)
-        w, h = image.width, image.height
-        output = PdfWriter()
-        with open(fp, "rb") as f:
-            existing_pdf = PdfReader(f)
-            for page in range(0, len(existing_pdf.pages)):
-                packet = make_page_with_text(page + 1, data, h, w)
-                new_pdf = PdfReader(packet)
-                page = existing_pdf.pages[page]
-                page.merge_page(new_pdf.pages[0])
-                output.add_page(page)
-
-        with NamedTemporaryFile(suffix=".pdf") as pdf_destination:
-            with open(pdf_destination.name, "wb") as outputStream:
-                output.write(outputStream)
-            response = FileResponse(
-                open(  # noqa: SIM115 FileResponse closes the file
-                    pdf_destination.name, "rb"
-                )
+    with NamedTemporaryFile(suffix=".pdf") as pdf_destination:
+        embed_text_layer(form.cleaned_data["fp"], pdf_destination.name)
+        response = FileResponse(
+            open(  # noqa: SIM115 FileResponse closes the file
+                pdf_destination.name, "rb"
             )
-            cleanup_form(form)
-            return response
+        )
+        cleanup_form(form)
+        return response
 
 
 def get_document_number(request) -> HttpResponse:
@@ -0,0 +1,24 @@
+"""Gunicorn settings for doctor
+
+Gunicorn picks this file up automatically from its working directory.
+"""
+
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+# Every worker writes its metrics here so /metrics can aggregate them.
+multiproc_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", "/tmp/doctor-metrics"
+)
+
+
+def on_starting(server):
+    # Samples left over from a previous run would be counted again.
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)